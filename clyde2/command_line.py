@@ -3,8 +3,11 @@
 import argparse
 import pkg_resources
 import os
+import sys
+import pipes
 from clyde2.package_builder import build_package
 from clyde2.generators.generic import generate_file
+from clyde2.generators.ninja_build import LINK_POOL, HEAVY_COMPILE_POOL
 from clyde2.common import pprint_color
 
 from os.path import join
@@ -16,50 +19,104 @@ from clyde2.clyde_logging import get_logger, init_logging
 import logging
 
 from clydepm.config import load_config
+from clydepm.object_cache import ObjectCache, parse_size
+from clydepm.git_clone import CloneStrategy
+from clydepm.git_mirror import MirrorStore
+from clydepm import tracing
 
 def version():
   version = pkg_resources.require("clydepm")[0].version 
   return version
 
+def regenerate_command(namespace):
+  """
+  The command build.ninja runs to generate itself again, with the
+  same options and compiler settings as this run
+  """
+  command = [sys.executable, '-m', 'clyde2.command_line', 'gen',
+             '--variant', namespace.variant,
+             '--platform', namespace.platform]
+  for configuration in namespace.config or []:
+    command += ['--config', configuration]
+  if namespace.rtems:
+    command += ['--rtems', namespace.rtems]
+  if namespace.fast:
+    command.append('--fast')
+  if namespace.frozen:
+    command.append('--frozen')
+  environment = ['{0}={1}'.format(name, pipes.quote(os.environ[name]))
+                 for name in ['CC', 'CFLAGS'] if name in os.environ]
+  return " ".join(environment + [pipes.quote(arg) for arg in command])
+
+def configuration_traits(variant, platform, rtems = None):
+  options = {'variant' : variant, 'platform' : platform, 'rtems' : rtems}
+  if platform == 'rtems' and not rtems:
+    rtems_makefile_path = ''
+    for rtems_path in ['/arm-rtems4.11', '/arm-rtems4.12']:
+      if os.path.exists(rtems_path):
+        rtems_makefile_path = join(rtems_path, 'stm32f7x/make/')
+    if rtems_makefile_path:
+      logging.warn ("Using default RTEMS BSP {0}".format(rtems_makefile_path))
+      options['rtems'] = rtems_makefile_path
+    else:
+      raise Exception("Could not find rtems in / . No BSP specified. Specify with --rtems")
+  return options
+
 def generate_build_file(path, namespace):
+  if namespace.trace:
+    tracing.start(namespace.trace)
   try:
-    options = {}
-    if 'variant' in namespace:
-      options['variant'] = namespace.variant
-
-    if 'platform' in namespace:
-      options['platform'] = namespace.platform
-      if options['platform'] == 'rtems':
-        if not namespace.rtems:
-          rtems_makefile_path = ''
-          for rtems_path in ['/arm-rtems4.11', '/arm-rtems4.12']:
-            if os.path.exists(rtems_path):
-              rtems_makefile_path = join(rtems_path, 'stm32f7x/make/')
-          if rtems_makefile_path:
-            logging.warn ("Using default RTEMS BSP {0}".format(rtems_makefile_path))
-            options['rtems'] = rtems_makefile_path
-          else:
-            raise Exception("Could not find rtems in / . No BSP specified. Specify with --rtems")
-
-    if 'rtems' in namespace:
-      options['rtems'] = namespace.rtems
+    configurations = []
+    # variant[:platform], the platform defaulting to --platform
+    for configuration in namespace.config or []:
+      variant, _, platform = configuration.partition(':')
+      platform = platform or namespace.platform
+      configurations.append(configuration_traits(
+        variant, platform, namespace.rtems if platform == 'rtems' else None))
+    if not configurations:
+      configurations.append(configuration_traits(namespace.variant, namespace.platform,
+                                                 namespace.rtems))
     
-    build_file_contents, tree  = build_package(path,
-                                               traits = options, 
-                                               fetch_remote = not
-                                               namespace.fast,
-                                               frozen = namespace.frozen)
+    configuration = load_config(path)
+    regenerate = regenerate_command(namespace)
+    changed, trees = build_package(path,
+                                   fetch_remote = not namespace.fast,
+                                   frozen = namespace.frozen,
+                                   object_cache = ObjectCache.from_config(configuration),
+                                   tag_ttl = configuration['General']['tag-index-ttl'],
+                                   refresh = namespace.refresh,
+                                   fetch_jobs = int(configuration['General']['fetch-jobs']),
+                                   clone_strategy = CloneStrategy.from_config(configuration),
+                                   mirrors = MirrorStore.from_config(configuration,
+                                                                     namespace.refresh),
+                                   regenerate_command = regenerate,
+                                   configurations = configurations,
+                                   pool_memory = {
+                                     LINK_POOL : parse_size(
+                                       configuration['General']['link-memory']),
+                                     HEAVY_COMPILE_POOL : parse_size(
+                                       configuration['General']['heavy-compile-memory'])
+                                   })
     #build_package(path, options)
-    with open(join(path, 'build.ninja'), 'w') as f:
+    # Left alone when nothing changed, so ninja doesn't reload it
+    if changed:
       print(colored("Wrote configuration file build.ninja", 'green'))
-      f.write(build_file_contents)
+    else:
+      print(colored("build.ninja is up to date", 'green'))
     
     if namespace.verbose:
-      pprint_color(tree)
+      pprint_color(trees)
   except Exception as e:
     print (colored(str(e), "red"))
     if (namespace.verbose):
-        traceback.print_exc(e)
+        traceback.print_exc()
+    # build.ninja runs this to regenerate itself. ninja has to see
+    # it fail, or it carries on with the old build.ninja
+    sys.exit(1)
+  finally:
+    trace = tracing.stop()
+    if trace:
+      print(colored("Wrote trace to {0}".format(trace.filename), 'green'))
 
 def init(path, namespace):
   configuration = load_config(os.getcwd())
@@ -88,6 +145,14 @@ def main():
                            default = 'src',
                            help = 'Variant to build e.g.  test or linux')
 
+  parser_gen.add_argument("--config",
+                          action = 'append',
+                          default = None,
+                          help = "Put this configuration, variant or variant:platform, " +
+                                 "in build.ninja, with its outputs in prefix/variant-platform. " +
+                                 "Repeat it for more, for example --config src --config test. " +
+                                 "Replaces --variant")
+
   parser_gen.add_argument("--rtems",
                           type=str,
                           default = None,
@@ -106,7 +171,17 @@ def main():
   parser_gen.add_argument("--frozen",
                          action="store_true",
                          default = False,
-                         help = "Use the frozen dependencies in versions.txt")
+                         help = "Use the dependencies locked in clyde.lock")
+
+  parser_gen.add_argument("--refresh",
+                         action="store_true",
+                         default = False,
+                         help = "Check the remotes for new tags even if the tag index and mirrors are recent")
+
+  parser_gen.add_argument("--trace",
+                         type=str,
+                         default = None,
+                         help = "Write a Chrome trace of the generation to this file")
 
   parser_gen.add_argument('--platform', 
                            type=str, 
@@ -1,5 +1,6 @@
 import hashlib, os, sys
 from os.path import join, realpath
+from clydepm.hashing import descriptor_sha
 import shutil
 from distutils.dir_util import copy_tree
 import pkgutil
@@ -37,28 +38,10 @@ def template_resource(template):
 
 def stable_sha(data):
   """
-  Calculate a shaw of a potentailly nested dictionary of 
-  strings in a consistant way.
-
-  The dictionary is processed in sorted order recursively,
-  and hashses of the contents are appended, and then hashed 
-  again
+  Calculate a sha of a potentially nested dictionary of 
+  strings in a consistent way. See clydepm.hashing
   """
-  hash = ""
-  if isinstance(data, dict):
-    sorted_data = sorted(data.items())
-    for k, v in sorted_data:
-      hash += stable_sha(v) + "\n"
-    return hashlib.sha1(hash.encode('utf-8')).hexdigest()
-  elif isinstance(data, bytes):
-    return hashlib.sha1(data).hexdigest()
-  elif isinstance(data, str):
-    return hashlib.sha1(data.encode('utf-8')).hexdigest()
-  elif isinstance(data, list):
-    for value in data:
-      hash += stable_sha(value) + "\n"
-      return hashlib.sha1(hash.encode('utf-8')).hexdigest()
-  raise Exception("Can't hash dict containing {0}".format(type(data)))
+  return descriptor_sha(data)
 
 
 def read_template(template):
@@ -11,6 +11,7 @@ import os
 from clyde2.common import is_c, is_cpp
 from clyde2.common import pprint_color, dict_contains
 import Queue
+from clydepm import tracing
 
 
 def topological_sort(library):
@@ -36,6 +37,7 @@ def topological_sort(library):
 
 
 
+@tracing.traced('generate')
 def generate_file(tree, prefix = '', toolchain = None, root = None):
   output = StringIO.StringIO()
   print pprint_color(tree)
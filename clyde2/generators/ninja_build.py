@@ -1,21 +1,37 @@
-from ninja.ninja_syntax import Writer
-import StringIO
+from ninja.ninja_syntax import Writer, expand, escape
 from sys import stdout
-from os.path import join, splitext, relpath, split
+from os.path import join, splitext, relpath, split, dirname
 import os
 from clyde2.common import is_c, is_cpp
 from clyde2.common import pprint_color, dict_contains
 
 from clyde2.rtems import *
+from clydepm import tracing
+from clydepm.common import atomic_file, write_if_changed, stable_sha, memory_jobs
+from clydepm.compilation_database import FILENAME, compile_command, write_compilation_database
 
 # Tools to walk over the tree collecting includes
 import functools
 from clyde2.resolver import walk_tree, gather_library_names
 
+# Pools for jobs that take a lot of memory. Links of big test
+# binaries run out of memory long before compiles do, and sources
+# listed in heavy-sources in config.yaml are compiled in heavy_compile
+LINK_POOL = 'link_pool'
+HEAVY_COMPILE_POOL = 'heavy_compile'
+# Memory one job in each pool takes. clyde2 gen passes link-memory
+# and heavy-compile-memory from the clyde config
+POOL_MEMORY = {
+  LINK_POOL           : 4 << 30,
+  HEAVY_COMPILE_POOL  : 2 << 30
+}
+
 def generate_toolset(writer, 
                      prefix = '', 
                      toolchain = None, 
-                     rtems_makefile_path = None):
+                     rtems_makefile_path = None,
+                     object_cache = None,
+                     suffix = ''):
   cflags = ' -DSTM32F7_DISCOVERY'
   cflags = ''
   if rtems_makefile_path:
@@ -57,15 +73,23 @@ def generate_toolset(writer,
                                                             final_link_libs)
 
 
+  rules = dict(toolchain)
+  if object_cache:
+    # Compile through the shared object cache
+    for name in ['cc', 'cpp']:
+      rules[name] = object_cache.wrapper_command() + ' ' + rules[name]
+
   writer.comment("Tool Definitions")
-  for name, command in toolchain.iteritems():
-    writer.rule(name, 
+  for name, command in rules.iteritems():
+    # Only compiling writes a depfile. ninja rebuilds anything
+    # whose depfile is missing, so links would never be up to date
+    writer.rule(name + suffix, 
                 command, 
-                depfile = '$out.d')
+                depfile = '$out.d' if name in ['cc', 'cpp'] else None,
+                pool = LINK_POOL if name in ['main', 'link'] else None)
                 
     writer.newline()
-  # Symlink magic
-  writer.rule('symlink', 'ln -s ../../$in $out')
+  return toolchain
 
 def local(path, root = None):
   if not root:
@@ -82,27 +106,127 @@ def build_location(file, root):
   name = join('prefix', 'include', name)
   return name
 
-def make_cflags(name, info, root):
+def make_cflags(name, info, root, include = join('prefix', 'include')):
   out = []
   out.append(info['cflags'])
-  out.append('-I' + join('prefix', 'include'))
+  out.append('-I' + include)
   return " ".join(out)
 
 
-generated = set()
-linked = set()
-
-
-def generate_library_entries(w, node, info, root, top = False):
-  if info['name'] in generated:
+class Configuration(object):
+  """
+  One variant and platform in a build file: the build tree
+  create_build_tree made for it, and the compiler prefix and RTEMS
+  BSP of its platform. generate_file fills in where its outputs go
+  """
+
+  def __init__(self, name, tree, prefix = '', toolchain = None,
+               rtems_makefile_path = None):
+    self.name = name
+    self.tree = tree
+    self.prefix = prefix
+    self.toolchain = toolchain
+    self.rtems_makefile_path = rtems_makefile_path
+    # Appended to the names of the rules of its toolchain
+    self.suffix = ''
+    # Where its object files, libraries and binaries, and the
+    # include symlinks of its libraries go
+    self.objects = 'build'
+    self.output = 'prefix'
+    self.include = join('prefix', 'include')
+
+  def toolchain_key(self):
+    return (self.prefix, self.rtems_makefile_path, repr(self.toolchain))
+
+  def include_links(self, root):
+    """
+    The symlinks in its include directory, as a dictionary of
+    library name to the include directory it points at
+    """
+    libraries = set()
+    walk_tree(self.tree, functools.partial(gather_library_names, libraries))
+    paths = {}
+    walk_tree(self.tree, functools.partial(gather_library_paths, paths))
+    return dict((libname, join(local(paths[libname], root), 'include', libname))
+                for libname in libraries)
+
+
+class BuildFileContext(object):
+  """
+  Everything one generation of a build file keeps track of, so one
+  process can generate any number of them
+  """
+
+  def __init__(self, writer, filename, root = None):
+    self.writer = writer
+    self.filename = filename
+    self.root = root
+    # Every output with a build statement. Configurations with
+    # the same flags share objects and symlinks
+    self.outputs = set()
+    # Compiler commands for compile_commands.json
+    self.commands = []
+    self.start(None)
+
+  def start(self, configuration):
+    """
+    Write the build statements of configuration next
+    """
+    self.configuration = configuration
+    # Libraries whose build statements were written
+    self.generated = set()
+    # Static libraries already given to a link
+    self.linked = set()
+
+  def build_once(self, output, rule, inputs, variables = None, pool = None):
+    """
+    Write a build statement for output unless there is one.
+    Returns whether it was written
+    """
+    if output in self.outputs:
+      return False
+    self.outputs.add(output)
+    self.writer.build(output, rule, inputs, variables = variables, pool = pool)
+    return True
+
+
+def gather_library_paths(paths, library, depth):
+  # Dependencies live in per-version worktrees, not deps/<name>
+  if 'name' in library and depth != 0:
+    paths[library['name']] = library.get('path', join('deps', library['name']))
+
+
+def object_directory(configuration, rule, vars):
+  """
+  Where configuration puts the objects compiled by rule with vars.
+  With several configurations, objects are kept apart by a hash of
+  the command, so configurations with identical flags share them
+  """
+  if configuration.objects:
+    return configuration.objects
+  return join('build', stable_sha({
+    'command' : configuration.toolchain[rule],
+    'vars'    : vars
+  })[:10])
+
+
+def generate_library_entries(context, node, info, top = False):
+  """
+  Write the build statements of library node and everything it
+  depends on, for context.configuration. The compiler command of
+  each source is added to context.commands. Returns the library or
+  binary it creates
+  """
+  if info['name'] in context.generated:
     return
   else:
-    generated.add(info['name'])
+    context.generated.add(info['name'])
+  w = context.writer
+  root = context.root
+  configuration = context.configuration
 
   if top:  
-    w.build(outputs = 'prefix/include/' + node,
-            rule = 'symlink',
-            inputs = 'include/' + node)
+    context.build_once(join(configuration.include, node), 'symlink', 'include/' + node)
 
   w.newline()
   w.comment("Library {0} sources".format(node))
@@ -110,24 +234,33 @@ def generate_library_entries(w, node, info, root, top = False):
   objects = []
   if len(info['sources']) == 0:
       raise Exception("You don't have any source files in src")
-  for source in info['sources']:
+  for source in sorted(info['sources']):
+    pool = HEAVY_COMPILE_POOL if source in info.get('heavy', ()) else None
     source = local(source, root)
-    object = join('build', newext(source, '.o'))
-    objects.append(object)
     
     vars = {
-      'cflags': make_cflags(node, info, root)
+      'cflags': make_cflags(node, info, root, configuration.include)
     }
 
     if top:
       vars['cflags'] += ' -Iinclude'
 
     if is_c(source):
-      w.build(object, 'cc', source, variables = vars)
+      rule = 'cc'
     elif is_cpp(source):
-      w.build(object, 'cpp', source, variables = vars)
+      rule = 'cpp'
     else:
       raise Exception("Weird source file got through")
+    object = join(object_directory(configuration, rule, vars), newext(source, '.o'))
+    objects.append(object)
+    if not context.build_once(object, rule + configuration.suffix, source, vars, pool):
+      continue
+
+    local_vars = dict(vars)
+    local_vars.update({'in' : source, 'out' : object})
+    command = expand(configuration.toolchain[rule], {}, local_vars)
+    context.commands.append(compile_command(root or os.getcwd(), source, object,
+                                            command = command))
 
 
   w.newline()
@@ -137,29 +270,30 @@ def generate_library_entries(w, node, info, root, top = False):
   for library in info['libraries'].keys():
     libname = library + '.a'
 
-    if libname not in linked:
+    if libname not in context.linked:
       libs.append(libname)
-      linked.add(libname)
+      context.linked.add(libname)
 
   # This next few lines determines how to perform the 
   # the final link, either creating a static library or 
   # binary, depending on the type of the package.
+  lib = join(configuration.output, 'lib')
   if info['type'] == 'library':
     tool = 'link'
-    output = 'prefix/lib/' + node + '.a'
+    output = join(lib, node + '.a')
   elif info['type'] == 'application':
     tool = 'main'
     if 'variant' in info and info['variant'] == 'test':
-      output = 'prefix/bin/test-' + node
+      output = join(configuration.output, 'bin', 'test-' + node)
     else:
-      output = 'prefix/bin/' + node
+      output = join(configuration.output, 'bin', node)
   else:
     raise Exception("Error in clyde config: type is not library or application")
 
 
   w.build(outputs = output,
-          rule = tool, variables = vars,
-          inputs = ['prefix/lib/' + l for l in libs] + objects
+          rule = tool + configuration.suffix, variables = vars,
+          inputs = [join(lib, l) for l in libs] + objects
          )
 
   if not top:
@@ -169,41 +303,228 @@ def generate_library_entries(w, node, info, root, top = False):
                 inputs = 'deps/' + node + '/include')
 
   for library, contents in info['libraries'].iteritems():
-    generate_library_entries(w, library, contents, root, top = False)
-
-
+    generate_library_entries(context, library, contents, top = False)
+  return output
+
+
+
+
+def gather_source_directories(directories, library, depth):
+  for source in library.get('sources', []):
+    directories.add(dirname(source) or '.')
+
+
+# Sources in each directory with one, one per line. Saving a file
+# changes its directory's mtime, so build.ninja depends on this
+# rather than on the directories: relisting them is cheap, and it
+# only changes when a source is added or removed
+SOURCES_LIST = join('build', 'sources.list')
+SOURCE_EXTENSIONS = ['.c', '.cc', '.cpp', '.c++']
+
+
+def list_sources(directories, root = None):
+  """
+  SOURCES_LIST for directories, relative to root, the way find
+  writes it
+  """
+  lines = []
+  for directory in directories:
+    path = join(root or os.getcwd(), directory)
+    if os.path.isdir(path):
+      lines += [join(directory, f) for f in os.listdir(path)
+                if splitext(f)[1] in SOURCE_EXTENSIONS]
+  return ''.join(line + '\n' for line in sorted(lines))
+
+
+def generate_regenerate_rule(context, command, inputs, directories = ()):
+  """
+  Make build.ninja rebuild itself with command whenever one of
+  inputs changes, or a source is added to or removed from one of
+  directories. ninja checks it before anything else, so a plain
+  ninja picks up package changes without a clyde2 gen. command only
+  rewrites build.ninja when it changes, and restat stops ninja
+  from rebuilding everything when it didn't
+  """
+  w = context.writer
+  root = context.root
+  # Compilers and clyde itself live outside the project
+  def location(path):
+    path = local(path, root)
+    if path.startswith('..'):
+      path = os.path.abspath(join(root or '', path))
+    return path
+  inputs = [location(path) for path in inputs]
+  directories = sorted(set(location(path) for path in directories))
+  if directories:
+    # Written here too, so the first ninja doesn't regenerate
+    listing = join(root or os.getcwd(), SOURCES_LIST)
+    if not os.path.isdir(dirname(listing)):
+      os.makedirs(dirname(listing))
+    write_if_changed(listing, list_sources(directories, root))
+    patterns = ' -o '.join("-name '*{0}'".format(ext) for ext in SOURCE_EXTENSIONS)
+    w.comment("Sources in each source directory")
+    w.rule('list_sources',
+           "find $in -maxdepth 1 \\( {0} \\) | LC_ALL=C sort > $out.tmp && "
+           "if cmp -s $out.tmp $out; then rm $out.tmp; "
+           "else mv $out.tmp $out; fi".format(patterns),
+           description = 'Listing sources',
+           restat = True)
+    w.build(outputs = SOURCES_LIST, rule = 'list_sources', inputs = directories)
+    inputs.append(SOURCES_LIST)
+  w.comment("Regenerate this file when the packages or the toolchain change")
+  w.rule('regen',
+         escape(command),
+         description = 'Regenerating build.ninja',
+         generator = True,
+         restat = True)
+  w.build(outputs = local(context.filename, root),
+          rule = 'regen',
+          implicit = sorted(set(inputs)))
+  w.newline()
 
 
-def generate_file(tree, prefix = '', 
-                  toolchain = None, 
+def gather_pools(pools, library, depth):
+  for pool, size in (library.get('pools') or {}).items():
+    pools.setdefault(pool, []).append(int(size))
+
+
+def pool_depths(configurations, pool_memory):
+  """
+  The depth of each pool in pool_memory, a dictionary of pool to
+  the memory one of its jobs takes. It's as many jobs as fit in
+  RAM, unless packages set it with pools in their config.yaml:
+
+    pools:
+      link_pool: 2
+
+  When several packages do, the smallest depth is used
+  """
+  requested = {}
+  for configuration in configurations:
+    walk_tree(configuration.tree, functools.partial(gather_pools, requested))
+  unknown = set(requested) - set(pool_memory)
+  if unknown:
+    raise Exception("Unknown pools {0} in config.yaml. Pools are {1}".format(
+      ", ".join(sorted(unknown)), ", ".join(sorted(pool_memory))))
+  depths = {}
+  for pool, memory in pool_memory.items():
+    if pool in requested:
+      depths[pool] = min(requested[pool])
+    else:
+      depths[pool] = memory_jobs(memory)
+  return depths
+
+
+def place_configurations(configurations, root):
+  """
+  Decide where the outputs of each configuration go. A single one
+  builds into build and prefix. With several, each gets its own
+  prefix/<name>, objects are shared between configurations with the
+  same flags, and toolchains and include directories are shared
+  where they are the same
+  """
+  if len(configurations) < 2:
+    return
+  suffixes = {}
+  includes = {}
+  for configuration in configurations:
+    key = configuration.toolchain_key()
+    if key not in suffixes:
+      suffixes[key] = '_' + configuration.name if suffixes else ''
+    configuration.suffix = suffixes[key]
+
+    links = repr(sorted(configuration.include_links(root).items()))
+    if links not in includes:
+      includes[links] = join('prefix', 'include-' + configuration.name) \
+                        if includes else join('prefix', 'include')
+    configuration.include = includes[links]
+
+    configuration.objects = None
+    configuration.output = join('prefix', configuration.name)
+
+
+@tracing.traced('generate')
+def generate_file(configurations,
                   root = None, 
-                  cflags = None,
-                  rtems_makefile_path = None):
-  libraries = set()
-  walk_tree(tree, functools.partial(gather_library_names, libraries))
-
-  output = StringIO.StringIO()
-  w = Writer(output)
-
-  generate_toolset(w, prefix = prefix, 
-                   toolchain = toolchain,
-                   rtems_makefile_path = rtems_makefile_path)
-  w.newline( )
-  w.comment("Magic symlinks to make include paths way cleaner")
-  w.newline()
-  for libname in libraries:
-      w.build(outputs = 'prefix/include/' + libname,
-              rule = 'symlink',
-              inputs = join('deps', libname, 'include', libname))
-
-  for node, info in tree.iteritems():
-    
-    generate_library_entries(w, node, info, root, top = True)
-    
+                  object_cache = None,
+                  regenerate_command = None,
+                  regenerate_inputs = None,
+                  filename = None,
+                  pool_memory = None):
+  """
+  Write one ninja build file for configurations, a list of
+  Configurations, to filename, build.ninja in root by default. It
+  is written as it is generated and renamed into place at the end,
+  and left alone if it came out the same. With several
+  configurations, each gets a phony target named after it, and the
+  first is built by default. pool_memory overrides POOL_MEMORY.
+  Returns whether the file changed
+  """
+  if not filename:
+    filename = join(root or os.getcwd(), 'build.ninja')
+  place_configurations(configurations, root)
+
+  build_file = atomic_file(filename)
+  with build_file as output:
+    w = Writer(output)
+    context = BuildFileContext(w, filename, root)
+
+    memory = dict(POOL_MEMORY)
+    memory.update(pool_memory or {})
+    w.comment("Jobs that take a lot of memory")
+    for pool, depth in sorted(pool_depths(configurations, memory).items()):
+      w.pool(pool, depth)
+    w.newline()
+
+    toolchains = {}
+    for configuration in configurations:
+      if configuration.suffix not in toolchains:
+        toolchains[configuration.suffix] = generate_toolset(
+          w, prefix = configuration.prefix, 
+          toolchain = configuration.toolchain,
+          rtems_makefile_path = configuration.rtems_makefile_path,
+          object_cache = object_cache,
+          suffix = configuration.suffix)
+      configuration.toolchain = toolchains[configuration.suffix]
+    # Symlink magic
+    w.rule('symlink', 'ln -s ../../$in $out')
+    w.newline( )
+    if regenerate_command:
+      directories = set()
+      for configuration in configurations:
+        walk_tree(configuration.tree,
+                  functools.partial(gather_source_directories, directories))
+      generate_regenerate_rule(context, regenerate_command,
+                               regenerate_inputs or [], directories)
+    w.comment("Magic symlinks to make include paths way cleaner")
+    w.newline()
+    for configuration in configurations:
+      for libname, path in sorted(configuration.include_links(root).items()):
+        context.build_once(join(configuration.include, libname), 'symlink', path)
+
+    targets = []
+    for configuration in configurations:
+      context.start(configuration)
+      if len(configurations) > 1:
+        w.newline()
+        w.comment("Configuration {0}".format(configuration.name))
+      for node, info in configuration.tree.iteritems():
+        
+        targets.append((configuration.name,
+                        generate_library_entries(context, node, info, top = True)))
       
+    if len(configurations) > 1:
+      w.newline()
+      for name, target in targets:
+        w.build(name, 'phony', target)
+      w.default(targets[0][1])
+      
+  if root:
+    # Written here rather than by ninja, so editors have it
+    # before anything is built
+    write_compilation_database(join(root, FILENAME), context.commands)
 
-
-  return output.getvalue(), tree
+  return build_file.changed
 
 
 
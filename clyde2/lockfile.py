@@ -0,0 +1,128 @@
+"""
+clyde.lock, the dependencies a package was last resolved to.
+
+For every package it records the version, the commit that version
+was tagged at, a hash of its config.yaml at that commit, and the
+packages it requires:
+
+  lock-version: 2
+  root: top
+  requires:
+    src-linux:
+      a: '>=1.0.0'
+    test-linux:
+      a: '>=1.0.0'
+      cpputest: '>=3.0.0'
+  packages:
+    a:
+      version: 1.1.0
+      commit: 0f3c...
+      config: 9a41...
+      requires:
+        c: '>=2.0.0,<3.0.0'
+
+requires is what the root package asks for in each configuration
+it was resolved for, since variants can require different ranges.
+A frozen build checks those against config.yaml, then checks out
+the commits directly, so it never has to list tags or run the
+solver. Lockfiles from before lock-version 2 have one requires for
+every configuration.
+"""
+import yaml
+
+from clydepm.common import write_if_changed
+from clydepm.hashing import descriptor_sha
+
+LOCKFILE = 'clyde.lock'
+# Bump when the format changes. Older clydes refuse newer lockfiles
+LOCK_VERSION = 2
+
+
+def lock_entry(package, commit, config):
+  """
+  What clyde.lock records about package, checked out at commit,
+  where its config.yaml says config
+  """
+  return {
+    'version'   : str(package.version),
+    'commit'    : commit,
+    'config'    : descriptor_sha(config),
+    'requires'  : package_requires(package)
+  }
+
+
+def package_requires(package):
+  """
+  What package requires, as a dictionary of name to spec. A variant
+  can narrow what the package asks for, and the solver takes both,
+  so they are joined into one spec
+  """
+  requires = {}
+  for name, spec in package.get_dependency_configurations():
+    name, spec = str(name), str(spec)
+    if name in requires and spec not in requires[name].split(','):
+      spec = requires[name] + ',' + spec
+    requires[name] = spec
+  return requires
+
+
+def write_lockfile(filename, root_packages, entries):
+  """
+  root_packages is a list of the name of each configuration that
+  was resolved and its root package, and entries a dictionary of package name to lock_entry.
+  The file is only rewritten when the resolution changed, since
+  build.ninja is regenerated whenever it is newer. Returns
+  whether it was written
+  """
+  data = {
+    'lock-version'  : LOCK_VERSION,
+    'root'          : str(root_packages[0][1].name),
+    'requires'      : dict((str(configuration), package_requires(root_package))
+                           for configuration, root_package in root_packages),
+    'packages'      : dict((str(name), entry) for name, entry in entries.items())
+  }
+  return write_if_changed(filename, yaml.safe_dump(data, default_flow_style = False))
+
+
+def read_lockfile(filename):
+  """
+  The contents of a lockfile. 'packages' is a dictionary of name
+  to entry, and 'requires' what the root package required in each
+  configuration
+  """
+  with open(filename) as f:
+    data = yaml.safe_load(f)
+  if not isinstance(data, dict) or 'packages' not in data:
+    raise Exception("{0} is not a clyde lockfile".format(filename))
+  if data.get('lock-version', 0) > LOCK_VERSION:
+    raise Exception("{0} was written by a newer clyde (lock-version {1})".format(
+      filename, data['lock-version']))
+  data['packages'] = data['packages'] or {}
+  data['requires'] = data.get('requires') or {}
+  return data
+
+
+def check_lockfile(filename, lock, configuration, root_package):
+  """
+  Raise if root_package, the root package of the configuration
+  named configuration, requires something different from what it
+  did when lock was written, since the locked packages may not
+  satisfy it anymore
+  """
+  problems = []
+  requires = lock['requires']
+  if lock.get('lock-version', 0) > 1:
+    requires = requires.get(configuration)
+  if requires is None:
+    problems.append("{0} isn't locked".format(configuration))
+  else:
+    for name, spec in sorted(package_requires(root_package).items()):
+      locked = requires.get(name)
+      if locked is None or name not in lock['packages']:
+        problems.append("{0} isn't locked".format(name))
+      elif locked != str(spec):
+        problems.append("{0} is '{1}' in config.yaml but '{2}' in {3}".format(
+          name, spec, locked, LOCKFILE))
+  if problems:
+    raise Exception("{0} is out of date ({1}). Run gen without --frozen "
+                    "to update it".format(filename, ", ".join(problems)))
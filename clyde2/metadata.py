@@ -0,0 +1,108 @@
+import copy
+import json
+import os
+import threading
+from os.path import join, exists, realpath
+from subprocess import Popen, PIPE
+
+import yaml
+
+from clydepm import tracing
+from clyde2.clyde_logging import get_logger
+logger = get_logger()
+
+
+class CatFile(object):
+  """
+  A git cat-file --batch process for one repository. Objects are
+  read through its pipes, without starting git for each one
+  """
+
+  def __init__(self, repository):
+    self.repository = repository
+    self.process = Popen(['git', '-C', repository, 'cat-file', '--batch'],
+                         stdin = PIPE, stdout = PIPE)
+
+  def read(self, name):
+    """
+    Contents of the object name, such as <commit>:config.yaml,
+    or None if there is no such object
+    """
+    self.process.stdin.write((name + '\n').encode('utf-8'))
+    self.process.stdin.flush()
+    header = self.process.stdout.readline().decode('utf-8').split()
+    if len(header) != 3:
+      # "<name> missing", or the process died
+      return None
+    sha, kind, size = header
+    contents = self.process.stdout.read(int(size))
+    # Each object is followed by a newline
+    self.process.stdout.read(1)
+    return contents
+
+  def close(self):
+    self.process.stdin.close()
+    self.process.wait()
+
+
+class ConfigReader(object):
+  """
+  The config.yaml of packages at any commit, read from the git
+  object database instead of a checkout.
+
+  Commits never change, so each parsed config is kept in memory and
+  in {git_directory}/.metadata/<commit>.json, and only read from git
+  the first time.
+  """
+
+  def __init__(self, git_directory):
+    self.git_directory = realpath(git_directory)
+    self.directory = join(self.git_directory, '.metadata')
+    self.configs = {}
+    self.readers = {}
+    self.lock = threading.Lock()
+    if not exists(self.directory):
+      os.makedirs(self.directory)
+
+  def read(self, name, commit):
+    """
+    The config of package name at commit. Callers get their own
+    copy, since ClydePackage changes the config it is given
+    """
+    with self.lock:
+      if commit not in self.configs:
+        self.configs[commit] = self.load(name, commit)
+      return copy.deepcopy(self.configs[commit])
+
+  def load(self, name, commit):
+    filename = join(self.directory, commit + '.json')
+    try:
+      with open(filename) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      pass
+
+    if name not in self.readers:
+      self.readers[name] = CatFile(join(self.git_directory, name))
+    with tracing.span('git', 'config.yaml {0} {1}'.format(name, commit[:8])):
+      contents = self.readers[name].read(commit + ':config.yaml')
+    if contents is None:
+      raise Exception("{0} has no config.yaml at {1}".format(name, commit))
+    config = yaml.safe_load(contents)
+
+    temp = "{0}.{1}.tmp".format(filename, os.getpid())
+    try:
+      with open(temp, 'w') as f:
+        json.dump(config, f)
+      os.rename(temp, filename)
+    except (TypeError, ValueError):
+      # Not every YAML value has a JSON form. Such configs are
+      # read from git again next time
+      logger.debug("Not caching the config of {0} at {1}".format(name, commit))
+      os.remove(temp)
+    return config
+
+  def close(self):
+    for reader in self.readers.values():
+      reader.close()
+    self.readers = {}
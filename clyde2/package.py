@@ -19,25 +19,32 @@ class Package(object):
 
 class ClydePackage(object):
 
-  def __init__(self, path, traits = None):
-    self.path = realpath(path)
-    config_file = join(path, 'config.yaml')
+  def __init__(self, path, traits = None, config = None):
+    """
+    A package checked out at path, or, when config is given, just
+    its metadata, read without a checkout. The metadata is enough
+    for get_dependency_configurations, and path is None
+    """
+    self.path = realpath(path) if path else None
 
     self.deps = []
     self.inflated_deps = set()
 
-    with open(config_file,'r') as f:
-      self.config = yaml.load(f)
-      self.name  = self.config['name']
-      self.version  = Version(self.config['version'], partial=True)
+    if config is None:
+      with open(join(path, 'config.yaml'),'r') as f:
+        config = yaml.load(f)
 
+    self.config = config
+    self.name  = self.config['name']
+    self.version  = Version(self.config['version'], partial=True)
 
-      if 'cflags' in traits:
-        if type(self.config['cflags']) == dict:
-          self.config['cflags'] = self.config['cflags']['gcc']
-          self.config['cflags'] += traits['cflags']
-        else:
-          self.config['cflags'] += traits['cflags']
+
+    if 'cflags' in traits:
+      if type(self.config['cflags']) == dict:
+        self.config['cflags'] = self.config['cflags']['gcc']
+        self.config['cflags'] += traits['cflags']
+      else:
+        self.config['cflags'] += traits['cflags']
 
     self.evaluate_config_sugar(traits)
 
@@ -133,6 +140,23 @@ class ClydePackage(object):
     return self.config['cflags']
 
 
+  def get_pools(self):
+    """
+    Depths of the ninja pools this package asks for, such as
+    {'link_pool': 2}
+    """
+    return dict(self.config.get('pools') or {})
+
+
+  def get_heavy_sources(self):
+    """
+    Sources that take a lot of memory to compile, which are
+    compiled in the heavy_compile pool
+    """
+    return set(os.path.normpath(join(self.path, source))
+               for source in self.config.get('heavy-sources') or [])
+
+
   def make_relative(self, paths, rel):
     if rel:
       return set(map(lambda f: relpath(f, rel), paths))
@@ -240,8 +264,9 @@ class ClydePackage(object):
           if enabled:
             process_effects(name, details)
     self.variant_dirs = {}
-    for variant_name in enabled_variants:
-      self.variant_dirs[variant_name] =  join(self.path, variant_name)
+    if self.path:
+      for variant_name in enabled_variants:
+        self.variant_dirs[variant_name] =  join(self.path, variant_name)
 
     self.filtered_variants = [a for a in self.get_variants() if list(a.keys())[0] in enabled_variants]
     return self.filtered_variants
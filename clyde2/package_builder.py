@@ -1,22 +1,109 @@
 from clyde2.server import PackageServer, GerritPackageServer, TestServer
 from clyde2.package import ClydePackage, TestPackage
 from clyde2.resolver import resolve_package_dependencies, create_build_tree, get_frozen_packages
-from clyde2.generators.ninja_build import generate_file
+from clyde2.resolver import get_locked_packages
+from clyde2.lockfile import LOCKFILE, lock_entry, write_lockfile, read_lockfile
+from clyde2.lockfile import check_lockfile
+from clyde2.worktrees import git
+from clyde2.generators.ninja_build import generate_file, Configuration
 
 from clyde2.common import pprint_color, dict_contains, warn
 from clyde2.rtems import get_rtems_cflags, get_rtems_cc
 from termcolor import colored
 
-from os.path import join
+from os.path import join, realpath
 from os import getenv
+from distutils.spawn import find_executable
 import os
+import sys
+
+def configuration_name(traits):
+  return "{0}-{1}".format(traits.get('variant', 'src'), traits.get('platform', 'linux'))
+
 
 def build_package(path, 
                   traits = None, 
                   generator = None, fetch_remote = True,
-                  frozen = False):
+                  frozen = False,
+                  object_cache = None,
+                  tag_ttl = 3600,
+                  refresh = False,
+                  fetch_jobs = 8,
+                  clone_strategy = None,
+                  mirrors = None,
+                  regenerate_command = None,
+                  filename = None,
+                  configurations = None,
+                  pool_memory = None):
+  """
+  Resolve the dependencies of the package at path and write its
+  build file to filename. configurations is a list of traits, one
+  for each variant and platform to put in the build file, or just
+  traits when it isn't given. Nothing here outlives the call, so
+  one process can generate several build files. Returns whether
+  the build file changed, and the build tree of each configuration
+  by name. pool_memory is passed on to the generator
+  """
   if not generator:
     generator = generate_file
+  if not configurations:
+    configurations = [traits or {}]
+
+  server = GerritPackageServer(join(path, 'deps'), 
+                               tag_ttl = tag_ttl,
+                               refresh = refresh,
+                               clone_strategy = clone_strategy,
+                               mirrors = mirrors)
+
+  if not fetch_remote:
+    warn("Only looking at local git tags")
+
+  lockfile = join(path, LOCKFILE)
+  resolved = []
+  entries = {}
+  try:
+    for traits in configurations:
+      resolved.append(resolve_configuration(path, traits, server, fetch_remote,
+                                            frozen, fetch_jobs, entries))
+  finally:
+    server.close()
+  if not frozen:
+    write_lockfile(lockfile, [(configuration_name(traits), top_package)
+                              for traits, top_package, _ in resolved], entries)
+
+  trees = {}
+  builds = []
+  regenerate_inputs = []
+  for traits, top_package, packages in resolved:
+    name = configuration_name(traits)
+    trees[name] = create_build_tree(top_package)
+    compiler_prefix, rtems_makefile_path = compiler(traits)
+    builds.append(Configuration(name, trees[name],
+                                prefix = compiler_prefix,
+                                rtems_makefile_path = rtems_makefile_path))
+    regenerate_inputs += regeneration_inputs(path, packages.values(), compiler_prefix,
+                                             rtems_makefile_path)
+    
+  changed = generator(builds,
+                      root = path,
+                      object_cache = object_cache,
+                      regenerate_command = regenerate_command,
+                      regenerate_inputs = regenerate_inputs if regenerate_command else None,
+                      filename = filename,
+                      pool_memory = pool_memory)
+  return changed, trees
+
+
+def resolve_configuration(path, traits, server, fetch_remote, frozen, fetch_jobs,
+                          entries):
+  """
+  Choose and check out the packages the package at path needs with
+  traits, and inflate them. Unless frozen, what clyde.lock should
+  say about them is added to entries. Returns the traits with the
+  cflags filled in, the top package, and the packages by name
+  """
+  # Filled in with the cflags below, which are only for this run
+  traits = dict(traits)
 
   if 'rtems' in traits and traits['rtems'] and 'CFLAGS' in os.environ:
     raise Exception("CFLAGS and --rtems specified. Please only specify one")
@@ -29,9 +116,6 @@ def build_package(path,
 
   elif 'CFLAGS' in os.environ:
     extra_flags = os.environ['CFLAGS']
-    # Delete CFLAGS so they don't affect
-    # foreign packages
-    del os.environ['CFLAGS']
   
 
 
@@ -42,7 +126,6 @@ def build_package(path,
   traits['cflags']  = ' ' + extra_flags + ' -fdiagnostics-color=always'
 
   top_package = ClydePackage(path, traits)
-  server = GerritPackageServer(join(path, 'deps'))
 
 
   new_traits = traits.copy()
@@ -52,38 +135,56 @@ def build_package(path,
   if 'variant' in new_traits and new_traits['variant'] == 'test':
     del new_traits['variant']
 
-  if not fetch_remote:
-    warn("Only looking at local git tags")
-
-  if frozen:
+  lockfile = join(path, LOCKFILE)
+  if frozen and os.path.exists(lockfile):
+    print (colored("Using packages specified in {0}".format(LOCKFILE), 'yellow'))
+    lock = read_lockfile(lockfile)
+    check_lockfile(lockfile, lock, configuration_name(traits), top_package)
+    packages = get_locked_packages(lock['packages'], server, new_traits,
+                                   fetch_jobs)
+    packages.add(top_package)
+  elif frozen:
+    # Written by clydes older than clyde.lock
     print (colored("Using packages specified in versions.txt", 'yellow'))
-    with open("versions.txt") as f:
+    with open(join(path, "versions.txt")) as f:
       tuples = [line.strip().split("=") for line in f]
       frozen_packages = {tuple[0]: tuple[1] for tuple in tuples}
-      packages = get_frozen_packages(frozen_packages, server, new_traits)
+      packages = get_frozen_packages(frozen_packages, server, new_traits,
+                                     fetch_jobs)
       
       # Add the top package since it's excluded from versions.txt
       packages.add(top_package)
   else:
-    packages = resolve_package_dependencies(top_package, server, new_traits, fetch_remote)
+    packages = resolve_package_dependencies(top_package, server, new_traits, fetch_remote,
+                                            fetch_jobs)
 
   packages = {package.name:package for package in packages}
   print packages
 
   if not frozen: 
-    with open(join(path, 'versions.txt'),'w') as f:
-      for name, package in packages.iteritems():
-        if name != top_package.name:
-          f.write("{0}={1}\n".format(name, package.version))
-        package.inflate(packages)
+    for name, package in packages.iteritems():
+      if name != top_package.name:
+        commit = git(package.path, 'rev-parse', 'HEAD')
+        entry = lock_entry(package, commit, server.metadata.read(name, commit))
+        # clyde.lock has one version of each package. Configurations
+        # that need others can't be frozen
+        if name in entries and entries[name]['commit'] != commit:
+          warn("{0} is {1} in {2}, but {3} is locked".format(
+            name, package.version, configuration_name(traits),
+            entries[name]['version']))
+        entries.setdefault(name, entry)
+      package.inflate(packages)
   else:
     for name, package in packages.iteritems():
       print(colored("{0}={1}".format(name, package.version), 'green'))
       package.inflate(packages)
+  return traits, top_package, packages
 
 
-
-  tree = create_build_tree(top_package)
+def compiler(traits):
+  """
+  The compiler prefix for traits, and the RTEMS BSP if there is one
+  """
   rtems_makefile_path = None
   
   if getenv('CC'):
@@ -97,10 +198,27 @@ def build_package(path,
       compiler_prefix = ''
   else:
     compiler_prefix = ''
-    
-  return generator(tree, 
-                   prefix = compiler_prefix,
-                   root = path,
-                   cflags = extra_flags,
-                   rtems_makefile_path = rtems_makefile_path)
+  return compiler_prefix, rtems_makefile_path
+
+
+def regeneration_inputs(path, packages, compiler_prefix, rtems_makefile_path = None):
+  """
+  The files build.ninja has to be generated again after changing:
+  the config.yaml of every package in the build, the lockfile, the
+  compilers, the RTEMS BSP makefile the flags come from and the
+  generator itself
+  """
+  inputs = [join(package.path, 'config.yaml') for package in packages]
+  if rtems_makefile_path:
+    inputs.append(realpath(rtems_makefile_path))
+  for name in [LOCKFILE, 'versions.txt']:
+    if os.path.exists(join(path, name)):
+      inputs.append(join(path, name))
+  for compiler in ['gcc', 'g++']:
+    executable = find_executable(compiler_prefix + compiler)
+    if executable:
+      inputs.append(realpath(executable))
+  generator = sys.modules[generate_file.__module__].__file__
+  inputs.append(os.path.splitext(generator)[0] + '.py')
+  return inputs
 
@@ -2,83 +2,95 @@ from semantic_version import Version, Spec
 from clyde2.common import pprint_color, dict_contains
 from os.path import join, abspath, relpath
 import functools
+from multiprocessing.pool import ThreadPool
+from clydepm import tracing
+from clyde2.solver import Solver, ServerSource
+
 def insert_dependency(candidates, new_dependency, server): 
   pass
 
-class SpecException(Exception):
-
-  def __init__(self, package, dep_name, spec):
-    self.package = package
-    self.dep_name = dep_name
-    self.spec = spec
-
-  def __str__(self):
-    return "Package {0} requires version {1} of {2}. This is an invalid specification".format(
-      self.package.name,
-      self.spec, 
-      self.dep_name
-    )
-
-
-
-def get_spec(candidates, name):
-  specs = []
-  for package in candidates:
-    deps = package.get_dependency_configurations()
-    for d_name, spec in deps:
-      if name == d_name:
-        specs.append(spec)
-        try:
-          spec = Spec(*specs)
-        except ValueError as e:
-          raise SpecException(package, d_name, spec)
-  if not specs:
-    return None
-  spec = Spec(*specs)
-  return spec
-      
-
-
-def replace_by_name(candidates, new_candidate):
-  to_delete = None
-  for package in candidates:
-    if package.name == new_candidate.name:
-      to_delete = package
-  if to_delete:
-    candidates.remove(to_delete)
-  candidates.add(new_candidate)
-      
-def get_frozen_packages(frozen_packages, server, traits):
+def parallel_map(function, items, jobs = 8):
+  """
+  map, on at most jobs threads. Most of the time goes to cloning,
+  fetching and checking out, so this is bound by git, not the CPU
+  """
+  items = list(items)
+  if jobs <= 1 or len(items) <= 1:
+    return list(map(function, items))
+
+  pool = ThreadPool(min(jobs, len(items)))
+  try:
+    return pool.map(function, items)
+  finally:
+    pool.close()
+    pool.join()
+
+
+@tracing.traced('resolve')
+def get_frozen_packages(frozen_packages, server, traits, jobs = 8):
+  """
+  Packages listed in an old versions.txt, as name to version
+  """
+  specs = dict((name, Spec('==' + version))
+               for name, version in frozen_packages.iteritems())
   output = set()
-  for name, version in frozen_packages.iteritems():
-    spec = Spec('==' + version)
-    
-    best  = server.best(name,  spec, traits, False)
+  for name, best in sorted(fetch_best(server, specs, traits, False, jobs).items()):
     if not best:
-      raise Exception("Could not satisfy {0} Version {1}".format(name, spec))
+      raise Exception("Could not satisfy {0} Version {1}".format(name, specs[name]))
     output.add(best)
   return output
 
 
-def resolve_package_dependencies(root_package, server, traits, fetch_remote):
-  pass
-  
+@tracing.traced('resolve')
+def get_locked_packages(locked_packages, server, traits, jobs = 8):
+  """
+  Check out the commits in a lockfile, by up to jobs threads.
+  Tags aren't looked at, and nothing is fetched unless a commit
+  is missing from its clone
+  """
+  def checkout(item):
+    name, entry = item
+    with tracing.span('fetch', name):
+      return server.get_locked_project(name, entry['commit'], traits,
+                                       entry.get('config'))
+
+  return set(parallel_map(checkout, sorted(locked_packages.items()), jobs))
+
+
+def fetch_best(server, specs, traits, fetch_remote, jobs = 8):
+  """
+  Call server.best for every name, spec pair in specs at the same
+  time, on at most jobs threads.
+
+  Returns a dictionary of name to package
+  """
+  def best(item):
+    name, spec = item
+    with tracing.span('fetch', name):
+      return name, server.best(name, spec, traits, fetch_remote)
+
+  return dict(parallel_map(best, sorted(specs.items()), jobs))
+
+
+@tracing.traced('resolve')
+def resolve_package_dependencies(root_package, server, traits, fetch_remote,
+                                 jobs = 8):
+  """
+  Choose a version of every package root_package needs with the
+  solver in clyde2.solver. Tags are listed by up to jobs threads.
+  Candidates are only looked at through their config.yaml in git,
+  and just the chosen versions are checked out, also by up to jobs
+  threads.
+
+  Raises a ResolutionError explaining the conflict if there's no
+  set of versions that works
+  """
+  source = ServerSource(server, traits, fetch_remote, jobs)
+  versions = Solver(source).solve(root_package.name,
+                                  root_package.get_dependency_configurations())
   candidates = set([root_package])
-  new_candidates = candidates.copy()
-
-  while True: 
-    for package in candidates:
-      for name, version in package.get_dependency_configurations():
-        spec = get_spec(candidates, name)
-        best = server.best(name, spec, traits, fetch_remote)
-        if not best:
-          raise Exception("Could not satisfy {0} Version {1}".format(name, spec))
-        replace_by_name(new_candidates, best)
-    if candidates == new_candidates:
-      break
-    else:
-      candidates = new_candidates.copy()
-
+  candidates.update(parallel_map(lambda item: source.package(*item),
+                                 sorted(versions.items()), jobs))
   return candidates
 
 def insert_per_dependency_include(libinfo):
@@ -120,6 +132,7 @@ def walk_tree(tree, visitor, depth = 0):
       walk_tree({libname: libinfo}, visitor, depth + 1)
 
 
+@tracing.traced('resolve')
 def create_build_tree(package, top = True, visited = None):
   if not visited:
     visited = set()
@@ -147,6 +160,7 @@ def create_build_tree(package, top = True, visited = None):
   output  = {
     name : {
       'name'      : package.config['name'],
+      'path'      : package.path,
       'type'      : package.config['type'],
       'version'   : package.config['version'],
       'platform'  : package.traits['platform'],
@@ -154,6 +168,8 @@ def create_build_tree(package, top = True, visited = None):
       'headers'   : package.get_header_files(),
       'include'   : package.get_include_paths(),
       'cflags'    : package.get_cflags(),
+      'pools'     : package.get_pools(),
+      'heavy'     : package.get_heavy_sources(),
       'libraries' : new_libraries
     }
   }
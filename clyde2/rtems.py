@@ -3,6 +3,7 @@ from subprocess import Popen, PIPE
 from termcolor import colored
 from clyde2.common import *
 import shutil
+from clydepm import tracing
 
 from clyde2.clyde_logging import get_logger
 logger = get_logger()
@@ -10,6 +11,10 @@ logger = get_logger()
 
 
 def makefile_target(rtems_makefile_path, target):
+  with tracing.span('rtems', target):
+    return _makefile_target(rtems_makefile_path, target)
+
+def _makefile_target(rtems_makefile_path, target):
   rtems_makefile_path  = os.path.realpath(rtems_makefile_path)
   with temp_dir() as d:
     with temp_cwd(d):
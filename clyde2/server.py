@@ -9,6 +9,12 @@ from subprocess import Popen, PIPE
 
 from .common import stable_sha, temp_cwd
 from .package import ClydePackage
+from clydepm import tracing
+from .worktrees import WorktreePool
+from .tag_index import TagIndex
+from .metadata import ConfigReader
+from clydepm.hashing import descriptor_sha
+from clydepm.git_clone import CloneStrategy
 
 class PackageServer(object):
 
@@ -19,11 +25,28 @@ class PackageServer(object):
 
 class GerritPackageServer(object):
 
-  def __init__(self, git_directory = "/home/igutek/clyde2/git"):
+  def __init__(self, git_directory = "/home/igutek/clyde2/git", 
+               max_worktrees = 32, tag_ttl = 3600, refresh = False,
+               clone_strategy = None, mirrors = None):
     self.git_directory = git_directory
+    # How packages are cloned. See clydepm.git_clone
+    self.clone_strategy = clone_strategy or CloneStrategy()
+    # Mirrors shared with other projects, or None. See clydepm.git_mirror
+    self.mirrors = mirrors
+    if mirrors and not self.clone_strategy.full:
+      # Clones of a mirror have every object already
+      print (colored("Ignoring clone-strategy {0}, packages are cloned from {1}".format(
+        self.clone_strategy, mirrors.directory), 'yellow'))
+      self.clone_strategy = CloneStrategy()
     if not os.path.exists(self.git_directory):
       os.makedirs(self.git_directory)
     self.tags = {}
+    # Commit of each tagged version, by package name
+    self.commits = {}
+    self.worktrees = WorktreePool(self.git_directory, max_worktrees)
+    self.tag_index = TagIndex(self.git_directory, tag_ttl, refresh,
+                              self.clone_strategy)
+    self.metadata = ConfigReader(self.git_directory)
 
 
   def lsremote(self, url):
@@ -40,7 +63,8 @@ class GerritPackageServer(object):
       repo = git.Repo(path)
       origin = repo.remotes.origin
       if fetch_remote:
-        origin.fetch()
+        with tracing.span('git', 'fetch ' + name):
+          origin.fetch()
       tags = [Version(str(tag)) for tag in repo.tags]
       return tags
 
@@ -57,7 +81,13 @@ class GerritPackageServer(object):
     
     #print (colored(self.lslocal(name), "red"))
     #versions = [Version(s[10:], partial=True) for s in filter(istag, self.lsremote(path))]
-    self.tags[name] = self.lslocal(name, fetch_remote)
+    if self.mirrors and fetch_remote:
+      # Tags are listed and fetched from the mirror
+      with tracing.span('git', 'mirror ' + name):
+        self.mirrors.update_origin(os.path.join(self.git_directory, name))
+    versions = self.tag_index.versions(name, fetch_remote)
+    self.tags[name] = [version for version, sha in versions]
+    self.commits[name] = dict((str(version), sha) for version, sha in versions)
     return self.tags[name]
 
 
@@ -98,24 +128,80 @@ class GerritPackageServer(object):
       self.checkout_remote_project(name)
     if not version:
       return None
-    g = git.Git(dir)
-    repo = git.Repo(dir)
-    if remote_fetch:
-      repo.remotes.origin.fetch()
+    # list_tags already fetched the tags if they changed.
+    # Each version has its own worktree, so the clone itself
+    # is never checked out
+    refspec = self.commits.get(name, {}).get(str(version))
+    if refspec is None:
+      refspec = str(version)
+    else:
+      self.ensure_commit(name, refspec, str(version))
+    return ClydePackage(self.worktrees.get(name, refspec), traits)
+
+
+  def ensure_commit(self, name, commit, tag = None):
+    """
+    Fetch commit into the clone of name if a partial clone doesn't
+    have it yet. One fetch at a time per repository
+    """
+    dir = os.path.join(self.git_directory, name)
+    with self.worktrees.repository_lock(os.path.realpath(dir)):
+      if self.clone_strategy.has_commit(dir, commit):
+        return
+      with tracing.span('git', 'fetch {0} {1}'.format(name, tag or commit[:8])):
+        try:
+          self.clone_strategy.ensure_commit(dir, commit, tag)
+        except Exception:
+          # The mirror may not have fetched it yet
+          if not (self.mirrors and self.mirrors.update_origin(dir, force = True)):
+            raise
+          self.clone_strategy.ensure_commit(dir, commit, tag)
+
+
+  def get_metadata(self, name, version, traits):
+    """
+    The package at version, made from its config.yaml only, which
+    is read from git without a checkout. Enough to resolve
+    dependencies, but it has no path, sources or headers
+    """
+    self.list_tags(name, False)
+    commit = self.commits[name].get(str(version))
+    if commit is None:
+      raise Exception("{0} has no version {1}".format(name, version))
+    self.ensure_commit(name, commit, str(version))
+    return ClydePackage(None, traits, self.metadata.read(name, commit))
+
+
+  def get_locked_project(self, name, commit, traits, config_sha = None):
+    """
+    The package checked out at commit, without looking at tags.
+    The clone is only fetched if it doesn't have the commit yet.
+    If config_sha is given, config.yaml at commit has to match it
+    """
+    dir = os.path.join(self.git_directory, name)
+    if not os.path.exists(dir):
+      self.checkout_remote_project(name)
+    self.ensure_commit(name, commit)
+    path = self.worktrees.get(name, commit)
+
+    if config_sha and descriptor_sha(self.metadata.read(name, commit)) != config_sha:
+      raise Exception("config.yaml of {0} at {1} doesn't match the lockfile".format(
+        name, commit))
+    return ClydePackage(path, traits)
 
-    g.checkout(version)
-    return ClydePackage(dir, traits)
+
+  def close(self):
+    self.metadata.close()
 
 
   def checkout_remote_repo(self, repo_path):
+    # Clone into an absolute path rather than changing directory,
+    # so several packages can be cloned at the same time
     name = os.path.split(repo_path)[1]
-    with temp_cwd(self.git_directory):
-      args = ['git','clone', repo_path]
-      git = Popen(args, stdout=PIPE, stderr=PIPE)
-      stdout, stderr = git.communicate()
-      if git.returncode == 0:
-        return True
-      return False
+    with tracing.span('git', 'clone ' + name):
+      if self.mirrors:
+        return self.mirrors.clone(repo_path, os.path.join(self.git_directory, name))
+      return self.clone_strategy.clone(repo_path, os.path.join(self.git_directory, name))
 
 
   def checkout_remote_project(self, project_name):
@@ -153,6 +239,12 @@ class TestServer(object):
     return results
 
 
+  def versions(self, name):
+    return list(self.packages.get(name, {}).keys())
+
+  def dependencies(self, name, version):
+    return self.packages[name][version].get_dependencies()
+
   def best(self, name, spec):
     if not spec:
       raise Exception("Need a spec")
@@ -171,8 +263,9 @@ class TestServer(object):
 
 class LocalGitServer(object):
 
-  def __init__(self, git_directory = "/home/igutek/clyde2/git"):
+  def __init__(self, git_directory = "/home/igutek/clyde2/git", clone_strategy = None):
     self.git_directory = git_directory
+    self.clone_strategy = clone_strategy or CloneStrategy()
     if not os.path.exists(self.git_directory):
       os.makedirs(self.git_directory)
   
@@ -230,13 +323,8 @@ class LocalGitServer(object):
 
   def checkout_remote_repo(self, repo_path):
     name = os.path.split(repo_path)[1]
-    with temp_cwd(self.git_directory):
-      args = ['git','clone', repo_path]
-      git = Popen(args, stdout=PIPE, stderr=PIPE)
-      stdout, stderr = git.communicate()
-      if git.returncode == 0:
-        return True
-      return False
+    with tracing.span('git', 'clone ' + name):
+      return self.clone_strategy.clone(repo_path, os.path.join(self.git_directory, name))
 
 
   def checkout_remote_project(self, project_name):
@@ -0,0 +1,693 @@
+#!/usr/bin/env python
+"""
+A conflict driven version solver.
+
+Every version of every package the solver has heard of is a
+yes/no choice, and the requirements are clauses over them:
+
+  the root requires a >=1.0.0      a 1.0.0 or a 1.1.0 or ...
+  a 1.1.0 requires b <2.0.0        not a 1.1.0, or b 1.0.0 or ...
+  one version per package          not b 1.0.0, or not b 1.2.0
+
+A package's requirements are only read once one of its versions is
+chosen, so only the part of the graph that matters gets loaded.
+
+The solver picks the newest version that meets an open requirement,
+starting with the packages that were part of recent conflicts, and
+after each choice follows every requirement that has only one way
+left to be met. When a requirement can't be met at all, it works out
+which earlier choices caused it, remembers that combination as a new
+clause so no other branch walks into it again, and jumps back to the
+latest of those choices rather than the previous one.
+
+If the conflict doesn't depend on any choice, there's no solution.
+The error lists the requirements that were used to prove it, cut
+down until leaving out any one of them would allow a solution.
+
+The solver works with any source of packages that has
+
+  versions(name)               every version of name
+  dependencies(name, version)  list of (name, spec string) it requires
+
+and, optionally, prefetch(names), called with packages that are
+about to be asked for, so a source can look them up concurrently.
+
+Run this module to time it on generated graphs:
+
+  python -m clyde2.solver
+"""
+import heapq
+import random
+import time
+from multiprocessing.pool import ThreadPool
+
+from semantic_version import Version, Spec
+
+from clydepm import tracing
+
+ROOT = None
+
+
+class ResolutionError(Exception):
+
+  def __init__(self, explanation):
+    self.explanation = explanation
+    Exception.__init__(self, "\n".join(explanation))
+
+
+class Solver(object):
+  """
+  Variables are numbered from 1, and a literal is a variable number,
+  negated when it means the version is not used.
+  """
+
+  def __init__(self, source, minimize = True):
+    self.source = source
+    # Whether errors are cut down to the requirements they need
+    self.minimize = minimize
+    self.specs = {}
+    # Variable number -> (name, version)
+    self.choices = [None]
+    # name -> variables of its versions, newest first
+    self.package_variables = {}
+
+    self.value = [None]
+    self.level = [None]
+    self.reason = [None]
+    self.trail = []
+    self.trail_limits = []
+    self.propagated = 0
+
+    self.clauses = []
+    # Why each clause exists: ('root', dep, spec), ('dependency', name,
+    # version, dep, spec), ('one version', name) or ('learned', clauses)
+    self.origins = []
+    self.watches = {}
+
+    # Requirement clauses: the versions that meet them, newest first,
+    # and the version whose requirement they are (None for the root)
+    self.targets = {}
+    self.target_sets = {}
+    self.dependency_names = {}
+    self.guards = {}
+    self.requirements = {}
+    # Requirements that may not be met yet, in a heap by the activity
+    # of the package they require, and requirements met at each
+    # decision level, reopened when that level is undone
+    self.open = []
+    self.queued = set()
+    self.met = []
+    # Chosen versions whose dependencies haven't been read yet
+    self.unexpanded = []
+    self.expanded = set()
+    # name -> the variable of its chosen version, and of the
+    # version it had last
+    self.chosen = {}
+    self.saved = {}
+    self.steps = 0
+    self.conflicts = 0
+    # Conflicts that would undo more levels than this only go back
+    # one level
+    self.longest_jump = 100
+    # name -> how often it took part in conflicts, recent ones
+    # counting for more
+    self.activity = {}
+    self.bump = 1.0
+
+  def spec(self, text):
+    if text not in self.specs:
+      self.specs[text] = Spec(text)
+    return self.specs[text]
+
+  def literal_value(self, literal):
+    value = self.value[abs(literal)]
+    if value is None or literal > 0:
+      return value
+    return not value
+
+  def decision_level(self):
+    return len(self.trail_limits)
+
+  def variables_of(self, name):
+    """
+    The variables of every version of name. The first time name
+    comes up, its versions are listed and only one is allowed
+    """
+    if name not in self.package_variables:
+      variables = []
+      for version in sorted(self.source.versions(name), reverse = True):
+        self.choices.append((name, version))
+        self.value.append(None)
+        self.level.append(None)
+        self.reason.append(None)
+        variables.append(len(self.choices) - 1)
+      self.package_variables[name] = variables
+      for i, a in enumerate(variables):
+        for b in variables[i + 1:]:
+          self.add_clause([-a, -b], ('one version', name))
+    return self.package_variables[name]
+
+  def matching(self, name, text, requirer):
+    try:
+      spec = self.spec(text)
+    except ValueError:
+      raise ResolutionError(["{0} requires version {1} of {2}. This is an invalid "
+                             "specification".format(requirer, text, name)])
+    return [v for v in self.variables_of(name) if self.choices[v][1] in spec]
+
+  def implied_level(self, literals):
+    """
+    The level a clause's first literal is implied at, the latest level
+    of the others. It can be below the current level, and then the
+    literal stays assigned if the search goes back to that level
+    """
+    return max([self.level[abs(l)] for l in literals[1:]] or [0])
+
+  def assign(self, literal, reason, level = None):
+    variable = abs(literal)
+    self.value[variable] = literal > 0
+    self.level[variable] = self.decision_level() if level is None else level
+    self.reason[variable] = reason
+    self.trail.append(literal)
+    if literal > 0:
+      self.chosen[self.choices[variable][0]] = variable
+      self.saved[self.choices[variable][0]] = variable
+      if variable in self.expanded:
+        self.reopen(self.requirements[variable])
+      else:
+        self.unexpanded.append(variable)
+
+  def backtrack(self, level):
+    if self.decision_level() <= level:
+      return
+    limit = self.trail_limits[level]
+    kept = []
+    for literal in self.trail[limit:]:
+      variable = abs(literal)
+      if self.level[variable] <= level:
+        kept.append(literal)
+        continue
+      self.value[variable] = None
+      self.level[variable] = None
+      self.reason[variable] = None
+    del self.trail[limit:]
+    del self.trail_limits[level:]
+    self.trail.extend(kept)
+    for name, variable in list(self.chosen.items()):
+      if not self.value[variable]:
+        # Two versions can be chosen for a moment, until the clause
+        # allowing only one is propagated
+        others = [v for v in self.package_variables[name] if self.value[v]]
+        if others:
+          self.chosen[name] = others[0]
+        else:
+          del self.chosen[name]
+    self.propagated = min(self.propagated, limit)
+    for requirements in self.met[level + 1:]:
+      self.reopen(requirements)
+    del self.met[level + 1:]
+    self.unexpanded = [v for v in self.unexpanded if self.value[v]]
+
+  def reopen(self, requirements):
+    for requirement in requirements:
+      if requirement not in self.queued:
+        self.queued.add(requirement)
+        name = self.dependency_names[requirement]
+        heapq.heappush(self.open, (-self.activity.get(name, 0), requirement))
+
+  def watch(self, literal, clause):
+    self.watches.setdefault(literal, []).append(clause)
+
+  def add_clause(self, literals, origin):
+    """
+    Add a clause, which may already be unit or false under the
+    current assignment. Returns it if it is false
+    """
+    clause = len(self.clauses)
+    self.clauses.append(literals)
+    self.origins.append(origin)
+
+    if len(literals) <= 1:
+      # Only the root's requirements and learned facts, at level 0,
+      # or a requirement nothing matches, which is false
+      if not literals or self.literal_value(literals[0]) is False:
+        return clause
+      if self.literal_value(literals[0]) is None:
+        self.assign(literals[0], clause)
+      return None
+
+    def rank(literal):
+      value = self.literal_value(literal)
+      if value is None:
+        return (1, 0)
+      if value:
+        return (0, self.level[abs(literal)])
+      return (2, -self.level[abs(literal)])
+    literals.sort(key = rank)
+    self.watch(literals[0], clause)
+    self.watch(literals[1], clause)
+
+    first = self.literal_value(literals[0])
+    if first is None and self.literal_value(literals[1]) is False:
+      self.assign(literals[0], clause, self.implied_level(literals))
+    elif first is False:
+      return clause
+    return None
+
+  def propagate(self):
+    """
+    Assign every literal that is the last way to satisfy a clause.
+    Returns a clause that can't be satisfied, or None
+    """
+    while self.propagated < len(self.trail):
+      false_literal = -self.trail[self.propagated]
+      self.propagated += 1
+      watching = self.watches.get(false_literal, [])
+      self.watches[false_literal] = kept = []
+      for i, clause in enumerate(watching):
+        literals = self.clauses[clause]
+        if literals[0] == false_literal:
+          literals[0], literals[1] = literals[1], literals[0]
+        if self.literal_value(literals[0]):
+          kept.append(clause)
+          continue
+        for k in range(2, len(literals)):
+          if self.literal_value(literals[k]) is not False:
+            literals[1], literals[k] = literals[k], literals[1]
+            self.watch(literals[1], clause)
+            break
+        else:
+          kept.append(clause)
+          if self.literal_value(literals[0]) is False:
+            kept.extend(watching[i + 1:])
+            self.propagated = len(self.trail)
+            return clause
+          self.assign(literals[0], clause, self.implied_level(literals))
+    return None
+
+  def require(self, guard, name, targets, origin):
+    """
+    Add the clause that guard, if it is chosen, needs one of targets.
+    Returns it if it is false
+    """
+    false = self.add_clause(([-guard] if guard else []) + list(targets), origin)
+    requirement = len(self.clauses) - 1
+    self.targets[requirement] = targets
+    self.target_sets[requirement] = set(targets)
+    self.dependency_names[requirement] = name
+    self.guards[requirement] = guard
+    if guard:
+      self.requirements[guard].append(requirement)
+    self.reopen([requirement])
+    return false
+
+  def expand(self):
+    """
+    Add the requirements of versions that were just chosen.
+    Returns a clause that can't be satisfied, or None
+    """
+    while self.unexpanded:
+      variable = self.unexpanded.pop()
+      if not self.value[variable] or variable in self.expanded:
+        continue
+      name, version = self.choices[variable]
+      dependencies = self.source.dependencies(name, version)
+      new_names = [dep for dep, text in dependencies
+                   if dep not in self.package_variables]
+      if len(new_names) > 1 and hasattr(self.source, 'prefetch'):
+        self.source.prefetch(new_names)
+
+      self.expanded.add(variable)
+      self.requirements[variable] = []
+      conflict = None
+      requirer = "{0} {1}".format(name, version)
+      for dep, text in dependencies:
+        false = self.require(variable, dep, self.matching(dep, text, requirer),
+                             ('dependency', name, version, dep, text))
+        if conflict is None:
+          conflict = false
+      if conflict is not None:
+        return conflict
+    return None
+
+  def select(self):
+    """
+    The open requirement on the package that took part in the most
+    recent conflicts, since it is the most likely to fail. Picks the
+    version of that package used last time, if it is still allowed,
+    otherwise its newest version.
+
+    Returns (literal, None), or (None, clause) for a requirement that
+    can't be met any more, or (None, None) when everything is met
+    """
+    while self.open:
+      priority, requirement = self.open[0]
+      guard = self.guards[requirement]
+      name = self.dependency_names[requirement]
+      chosen = self.chosen.get(name)
+      if guard and not self.value[guard]:
+        # Reopened when its version is chosen again
+        heapq.heappop(self.open)
+        self.queued.discard(requirement)
+      elif chosen in self.target_sets[requirement]:
+        heapq.heappop(self.open)
+        self.queued.discard(requirement)
+        self.met[self.level[chosen]].append(requirement)
+      elif -priority < self.activity.get(name, 0):
+        # Activities only go up, so this one was queued too low
+        heapq.heapreplace(self.open, (-self.activity[name], requirement))
+      else:
+        left = [l for l in self.targets[requirement] if self.value[l] is None]
+        if not left:
+          return None, requirement
+        saved = self.saved.get(name)
+        return (saved if saved in left else left[0]), None
+    return None, None
+
+  def analyze(self, conflict):
+    """
+    Resolve the conflict clause with the reasons for its literals
+    until one literal from the current level is left. Returns the
+    learned clause, with that literal first, the level to jump to,
+    and the clauses it was derived from
+    """
+    level = self.decision_level()
+    seen = set()
+    learned = [None]
+    antecedents = [conflict]
+    count = 0
+    index = len(self.trail) - 1
+    literals = self.clauses[conflict]
+    resolved = None
+    while True:
+      for literal in literals:
+        variable = abs(literal)
+        if variable == resolved or variable in seen:
+          continue
+        seen.add(variable)
+        name = self.choices[variable][0]
+        self.activity[name] = self.activity.get(name, 0) + self.bump
+        if self.level[variable] == level:
+          count += 1
+        elif self.level[variable] > 0:
+          learned.append(literal)
+        elif self.reason[variable] is not None:
+          # Kept so the error can explain facts it relies on
+          antecedents.append(self.reason[variable])
+      while (abs(self.trail[index]) not in seen or
+             self.level[abs(self.trail[index])] != level):
+        index -= 1
+      literal = self.trail[index]
+      resolved = abs(literal)
+      index -= 1
+      count -= 1
+      if count == 0:
+        break
+      antecedents.append(self.reason[resolved])
+      literals = self.clauses[self.reason[resolved]]
+
+    self.bump /= 0.95
+    learned[0] = -literal
+    jump = max([self.level[abs(l)] for l in learned[1:]] or [0])
+    return learned, jump, antecedents
+
+  @tracing.traced('resolve', 'solve')
+  def solve(self, root_name, dependencies):
+    """
+    Choose a version of every package needed by root_name, which
+    requires dependencies, a list of (name, spec string).
+
+    Returns a dictionary of name to version, or raises a
+    ResolutionError explaining why that's impossible
+    """
+    self.root_name = root_name
+    self.met = [[]]
+    if hasattr(self.source, 'prefetch'):
+      self.source.prefetch([dep for dep, text in dependencies])
+    for dep, text in dependencies:
+      conflict = self.require(None, dep, self.matching(dep, text, root_name),
+                              ('root', dep, text))
+      if conflict is not None:
+        self.fail(conflict)
+
+    while True:
+      conflict = self.propagate()
+      if conflict is None:
+        conflict = self.expand()
+        if conflict is None and self.propagated < len(self.trail):
+          continue
+
+      if conflict is None:
+        literal, conflict = self.select()
+
+      if conflict is not None:
+        self.conflicts += 1
+        # Clauses added during the search can be false at a level
+        # below the current one
+        level = max([self.level[abs(l)] for l in self.clauses[conflict]] or [0])
+        if level == 0:
+          self.fail(conflict)
+        self.backtrack(level)
+        learned, jump, antecedents = self.analyze(conflict)
+        if level - jump > self.longest_jump:
+          # Jumping far back throws away many decisions that will
+          # just be made again. Going back one level is enough to
+          # assign the learned clause's literal, at the level it
+          # really belongs to
+          jump = level - 1
+        self.backtrack(jump)
+        if self.add_clause(learned, ('learned', antecedents)) is not None:
+          self.fail(len(self.clauses) - 1)
+        continue
+
+      if literal is None:
+        return dict(self.choices[v] for v in range(1, len(self.choices))
+                    if self.value[v])
+      self.steps += 1
+      self.trail_limits.append(len(self.trail))
+      self.met.append([])
+      self.assign(literal, None)
+
+  def fail(self, conflict):
+    """
+    Raise an error listing the requirements that can't all be met
+    """
+    requirements = self.used_requirements(conflict)
+    # Each requirement left out costs a solve, so huge conflicts are
+    # shown as they were found
+    if self.minimize and len(requirements) <= 100:
+      requirements = self.minimize_requirements(requirements)
+
+    explanation = ["Could not resolve the dependencies of {0}:".format(self.root_name)]
+    names = set()
+    for name, version, dep, text in sorted(requirements, key = lambda r: r[0] is not ROOT):
+      if name is ROOT:
+        explanation.append("  {0} requires {1} {2}".format(self.root_name, dep, text))
+      else:
+        explanation.append("  {0} {1} requires {2} {3}".format(name, version, dep, text))
+      names.add(dep)
+    for name in sorted(names):
+      versions = sorted(self.choices[v][1] for v in self.package_variables[name])
+      explanation.append("  {0} has versions {1}".format(
+        name, ", ".join(str(v) for v in versions) or 'none'))
+    raise ResolutionError(explanation)
+
+  def used_requirements(self, conflict):
+    """
+    The requirements the conflict was derived from, following learned
+    clauses and the reasons for facts back to the clauses that were
+    given, as (name, version, dep, spec), with ROOT for the root's
+    """
+    used = set()
+    stack = [conflict]
+    for literal in self.clauses[conflict]:
+      if self.reason[abs(literal)] is not None:
+        stack.append(self.reason[abs(literal)])
+    while stack:
+      clause = stack.pop()
+      if clause in used:
+        continue
+      used.add(clause)
+      origin = self.origins[clause]
+      if origin[0] == 'learned':
+        stack.extend(origin[1])
+      for literal in self.clauses[clause]:
+        if self.level[abs(literal)] == 0 and self.reason[abs(literal)] is not None:
+          stack.append(self.reason[abs(literal)])
+
+    requirements = []
+    for clause in sorted(used):
+      origin = self.origins[clause]
+      if origin[0] == 'root':
+        requirements.append((ROOT, None) + origin[1:])
+      elif origin[0] == 'dependency':
+        requirements.append(origin[1:])
+    return requirements
+
+  def minimize_requirements(self, requirements):
+    """
+    Leave out each requirement in turn, and keep it out if the rest
+    still can't be met, so that every requirement left is needed
+    """
+    versions = dict((name, [self.choices[v][1] for v in variables])
+                    for name, variables in self.package_variables.items())
+    needed = list(requirements)
+    for requirement in requirements:
+      rest = [r for r in needed if r != requirement]
+      solver = Solver(RequirementSubset(versions, rest), minimize = False)
+      try:
+        solver.solve(self.root_name, [(dep, text) for name, version, dep, text in rest
+                                      if name is ROOT])
+      except ResolutionError:
+        needed = rest
+    return needed
+
+
+class RequirementSubset(object):
+  """
+  Known versions, and only some of the requirements between them,
+  to find out which requirements a conflict needs
+  """
+
+  def __init__(self, versions, requirements):
+    self.all_versions = versions
+    self.requirements = {}
+    for name, version, dep, text in requirements:
+      if name is not ROOT:
+        self.requirements.setdefault((name, version), []).append((dep, text))
+
+  def versions(self, name):
+    return self.all_versions.get(name, [])
+
+  def dependencies(self, name, version):
+    return self.requirements.get((name, version), [])
+
+
+class ServerSource(object):
+  """
+  Lets the solver use a GerritPackageServer. Tags are listed for
+  several packages at once, by up to jobs threads. Dependencies are
+  read from each version's config.yaml in git, so nothing is checked
+  out until package is called for the versions that were chosen.
+  """
+
+  def __init__(self, server, traits, fetch_remote, jobs = 8):
+    self.server = server
+    self.traits = traits
+    self.fetch_remote = fetch_remote
+    self.jobs = jobs
+    self.tags = {}
+    self.packages = {}
+    self.metadata = {}
+
+  def prefetch(self, names):
+    names = [n for n in names if n not in self.tags]
+    if len(names) <= 1 or self.jobs <= 1:
+      return
+    pool = ThreadPool(min(self.jobs, len(names)))
+    try:
+      for name, tags in pool.map(self.list_tags, names):
+        self.tags[name] = tags
+    finally:
+      pool.close()
+      pool.join()
+
+  def list_tags(self, name):
+    with tracing.span('fetch', name):
+      return name, self.server.list_tags(name, self.fetch_remote)
+
+  def versions(self, name):
+    if name not in self.tags:
+      self.tags[name] = self.list_tags(name)[1]
+    return self.tags[name]
+
+  def package(self, name, version):
+    key = (name, str(version))
+    if key not in self.packages:
+      self.packages[key] = self.server.get_project(name, version, self.traits,
+                                                   self.fetch_remote)
+    return self.packages[key]
+
+  def dependencies(self, name, version):
+    key = (name, str(version))
+    if key not in self.metadata:
+      self.metadata[key] = self.server.get_metadata(name, version, self.traits)
+    return self.metadata[key].get_dependency_configurations()
+
+
+def generate_graph(packages = 2000, versions = 5, dependencies = 3, seed = 0):
+  """
+  A TestServer full of packages p0 ... pN. Each pI depends on a few
+  packages pJ with J > I, so the graph has no cycles.
+
+  Like real packages, most releases are minor ones with an occasional
+  new major version, most requirements allow any later release of
+  the same major version, and newer versions tend to require newer
+  versions of the same dependencies. Packages that need different
+  major versions of a dependency are what make the solver backtrack.
+
+  One version of each package is picked up front, and its
+  requirements always allow the picked versions of its dependencies,
+  so there is a solution. Most of the picked versions are the newest,
+  but the rest have to be found by backtracking.
+  """
+  from clyde2.server import TestServer
+  from clyde2.package import TestPackage
+  rng = random.Random(seed)
+  releases = []
+  for i in range(packages):
+    major, minor = 1, 0
+    releases.append([])
+    for v in range(versions):
+      releases[i].append(Version('{0}.{1}.0'.format(major, minor)))
+      if rng.random() < 0.2:
+        major, minor = major + 1, 0
+      else:
+        minor += 1
+  # Usually the newest version, sometimes an older one
+  picked = [versions - 1 if rng.random() < 0.7 else rng.randrange(versions)
+            for i in range(packages)]
+
+  def requirement(version, caret):
+    if caret:
+      return '>={0},<{1}.0.0'.format(version, version.major + 1)
+    return '>={0}'.format(version)
+
+  server = TestServer()
+  for i in range(packages):
+    targets = range(i + 1, min(packages, i + 50))
+    requires = rng.sample(targets, min(dependencies, len(targets)))
+    low = dict((j, 0) for j in requires)
+    for v in range(versions):
+      deps = []
+      for j in requires:
+        caret = rng.random() < 0.8
+        if v == picked[i]:
+          wanted = releases[j][picked[j]]
+          same_major = [r for r in releases[j][:picked[j] + 1]
+                        if r.major == wanted.major]
+          spec = requirement(rng.choice(same_major), caret)
+        else:
+          if rng.random() < 0.3:
+            low[j] = rng.randint(low[j], versions - 1)
+          spec = requirement(releases[j][low[j]], caret)
+        deps.append(('p{0}'.format(j), spec))
+      server.add_package(TestPackage('p{0}'.format(i), releases[i][v], deps))
+  return server
+
+
+def benchmark(packages = 2000, versions = 5, dependencies = 3, seed = 0):
+  server = generate_graph(packages, versions, dependencies, seed)
+  solver = Solver(server)
+  start = time.time()
+  solution = solver.solve('root', [('p0', '>=0.0.0')])
+  elapsed = time.time() - start
+  return len(solution), solver.steps, solver.conflicts, elapsed
+
+
+if __name__ == '__main__':
+  for packages, versions in [(100, 5), (1000, 5), (3000, 10)]:
+    solved, steps, conflicts, elapsed = benchmark(packages, versions)
+    print("{0} packages x {1} versions: chose {2} packages in {3} steps "
+          "and {4} conflicts, {5:.3f}s".format(packages, versions, solved,
+                                              steps, conflicts, elapsed))
@@ -0,0 +1,129 @@
+import json
+import os
+import time
+from os.path import join, exists, realpath
+
+from semantic_version import Version
+
+from clydepm import tracing
+from clydepm.git_clone import CloneStrategy
+from clyde2.worktrees import git
+from clyde2.clyde_logging import get_logger
+logger = get_logger()
+
+
+def parse_tag_refs(output):
+  """
+  Parse the output of git ls-remote --tags or git show-ref --tags
+  into a dictionary of tag name to commit sha. Annotated tags are
+  listed twice, and the peeled (^{}) line names the commit.
+  """
+  tags = {}
+  for line in output.splitlines():
+    if not line.strip():
+      continue
+    sha, ref = line.split()
+    if not ref.startswith('refs/tags/'):
+      continue
+    name = ref[len('refs/tags/'):]
+    if name.endswith('^{}'):
+      tags[name[:-3]] = sha
+    elif name not in tags:
+      tags[name] = sha
+  return tags
+
+
+class TagIndex(object):
+  """
+  The versions tagged in each package repository, kept on disk in
+  {git_directory}/.tags/<name>.json between runs.
+
+  Each entry has the parsed, sorted versions and the commit each
+  one points at. An index is trusted for ttl seconds. After that,
+  or when refresh is set, git ls-remote is compared to it, and the
+  repository is only fetched if a tag was added, moved or deleted.
+
+  Without fetch_remote, the tags of the local clone are used, and
+  the index they make isn't trusted by later runs that do fetch.
+  A shallow clone only has the tags that were used before.
+
+  Tags are fetched the way clone_strategy says, a CloneStrategy.
+  """
+
+  def __init__(self, git_directory, ttl = 3600, refresh = False,
+               clone_strategy = None):
+    self.git_directory = realpath(git_directory)
+    self.clone_strategy = clone_strategy or CloneStrategy()
+    self.directory = join(self.git_directory, '.tags')
+    self.ttl = float(ttl)
+    self.refresh = refresh
+    if not exists(self.directory):
+      os.makedirs(self.directory)
+
+  def index_file(self, name):
+    return join(self.directory, name + '.json')
+
+  def read(self, name):
+    try:
+      with open(self.index_file(name)) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def write(self, name, index):
+    filename = self.index_file(name)
+    temp = "{0}.{1}.tmp".format(filename, os.getpid())
+    with open(temp, 'w') as f:
+      json.dump(index, f, indent = 2)
+    os.rename(temp, filename)
+
+  def is_fresh(self, index, fetch_remote):
+    if index is None or self.refresh:
+      return False
+    if fetch_remote and not index.get('remote'):
+      return False
+    return time.time() - index['updated'] < self.ttl
+
+  def versions(self, name, fetch_remote = True):
+    """
+    Sorted list of (Version, commit sha) tagged in package name
+    """
+    index = self.read(name)
+    if not self.is_fresh(index, fetch_remote):
+      index = self.update(name, index, fetch_remote)
+    return [(Version(version), sha) for version, sha in index['versions']]
+
+  def update(self, name, index, fetch_remote):
+    repository = join(self.git_directory, name)
+    old_tags = index['tags'] if index else None
+
+    if fetch_remote:
+      with tracing.span('git', 'ls-remote ' + name):
+        tags = parse_tag_refs(git(repository, 'ls-remote', '--tags', 'origin'))
+      if tags != old_tags:
+        logger.debug("Tags of {0} changed. Fetching".format(name))
+        with tracing.span('git', 'fetch ' + name):
+          self.clone_strategy.fetch_tags(repository)
+    else:
+      try:
+        tags = parse_tag_refs(git(repository, 'show-ref', '--tags', '-d'))
+      except Exception:
+        # show-ref fails when there are no tags at all
+        tags = {}
+
+    versions = []
+    for tag, sha in tags.items():
+      try:
+        versions.append((Version(tag), sha))
+      except ValueError:
+        logger.debug("Ignoring tag {0} of {1}".format(tag, name))
+    versions.sort()
+
+    index = {
+      'updated'   : time.time(),
+      'remote'    : fetch_remote,
+      'tags'      : tags,
+      'versions'  : [[str(version), sha] for version, sha in versions]
+    }
+    self.write(name, index)
+    return index
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+import threading
+import time
+from os.path import join, exists, realpath
+from subprocess import Popen, PIPE
+
+from clydepm import tracing
+from clyde2.clyde_logging import get_logger
+logger = get_logger()
+
+
+def git(repository, *args):
+  """
+  Run a git command in repository. Returns stdout, or raises
+  if git fails
+  """
+  args = ['git', '-C', repository] + list(args)
+  process = Popen(args, stdout=PIPE, stderr=PIPE)
+  stdout, stderr = process.communicate()
+  if process.returncode != 0:
+    raise Exception("{0} failed: {1}".format(" ".join(args),
+                                             stderr.decode('utf-8', 'replace').strip()))
+  return stdout.decode('utf-8').strip()
+
+
+class WorktreePool(object):
+  """
+  Checked out versions of packages, one git worktree per
+  (package, commit), kept under {git_directory}/.worktrees
+
+  The clone in {git_directory}/<name> is never checked out to a
+  different version. Instead each version gets its own worktree,
+  created the first time it is needed, and reused by later runs.
+  Several versions of one package can be on disk at once, so
+  candidates can be looked at side by side.
+
+  Once there are more than max_worktrees, the least recently used
+  worktrees are removed, except the ones handed out by this pool.
+  """
+
+  def __init__(self, git_directory, max_worktrees = 32):
+    self.git_directory = realpath(git_directory)
+    self.directory = join(self.git_directory, '.worktrees')
+    self.index_file = join(self.directory, 'index.json')
+    self.max_worktrees = max_worktrees
+    self.lock = threading.Lock()
+    # Worktrees of different repositories are added at the same time
+    self.repository_locks = {}
+    # Worktrees returned during this run. They are never evicted
+    self.in_use = set()
+    if not exists(self.directory):
+      os.makedirs(self.directory)
+
+  def read_index(self):
+    try:
+      with open(self.index_file) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return {}
+
+  def write_index(self, index):
+    temp = "{0}.{1}.tmp".format(self.index_file, os.getpid())
+    with open(temp, 'w') as f:
+      json.dump(index, f, indent = 2, sort_keys = True)
+    os.rename(temp, self.index_file)
+
+  def get(self, name, refspec):
+    """
+    Path to a worktree of package name at refspec
+    """
+    repository = join(self.git_directory, name)
+    commit = git(repository, 'rev-parse', '--verify', refspec + '^{commit}')
+    path = join(self.directory, name, commit)
+    with self.lock:
+      # Before it exists, so no other thread can evict it
+      self.in_use.add(path)
+
+    with self.repository_lock(repository):
+      if not exists(join(path, '.git')):
+        if exists(path):
+          # Left over from an interrupted add
+          shutil.rmtree(path)
+          git(repository, 'worktree', 'prune')
+        with tracing.span('git', 'worktree {0} {1}'.format(name, refspec)):
+          git(repository, 'worktree', 'add', '--detach', path, commit)
+        logger.debug("Created worktree {0}".format(path))
+
+    with self.lock:
+      index = self.read_index()
+      index[path] = {'repository' : repository, 'last-used' : time.time()}
+      evicted = self.evict(index)
+      self.write_index(index)
+
+    for old_path, old_repository in evicted:
+      with self.repository_lock(old_repository):
+        self.remove(old_path, old_repository)
+    return path
+
+  def repository_lock(self, repository):
+    with self.lock:
+      if repository not in self.repository_locks:
+        self.repository_locks[repository] = threading.Lock()
+      return self.repository_locks[repository]
+
+  def evict(self, index):
+    """
+    Take least recently used worktrees out of index until there are
+    at most max_worktrees. Returns the (path, repository) of each,
+    to be removed
+    """
+    candidates = sorted((entry['last-used'], path)
+                        for path, entry in index.items()
+                        if path not in self.in_use)
+    excess = len(index) - self.max_worktrees
+    evicted = []
+    for last_used, path in candidates[:max(0, excess)]:
+      evicted.append((path, index.pop(path)['repository']))
+    return evicted
+
+  def remove(self, path, repository):
+    logger.debug("Removing worktree {0}".format(path))
+    try:
+      git(repository, 'worktree', 'remove', '--force', path)
+    except Exception:
+      # The repository or the worktree was deleted by hand
+      if exists(path):
+        shutil.rmtree(path)
+      if exists(repository):
+        git(repository, 'worktree', 'prune')
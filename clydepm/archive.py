@@ -0,0 +1,315 @@
+"""
+Package tarballs, with a choice of compression.
+
+  gz    gzip. Uses pigz to compress on every core when it is installed
+  zst   zstandard. Uses the zstd command with one thread per core, or
+        the zstandard python package
+  none  Plain tar, for package servers on the same host where
+        compression costs more time than it saves
+
+Tarballs are always written and read as a stream, so memory use
+doesn't depend on the size of the package. The codec is part of
+the file name (<sha>.tar.gz, <sha>.tar.zst, <sha>.tar), so cached
+tarballs made with one codec are never mistaken for another.
+"""
+import gzip
+import os
+import tarfile
+import tempfile
+import threading
+from distutils.spawn import find_executable
+from os.path import join, split
+from subprocess import Popen, PIPE
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+EXTENSIONS = {
+  'gz'    : '.tar.gz',
+  'zst'   : '.tar.zst',
+  'none'  : '.tar'
+}
+
+# Compressed files are read and written in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+
+
+def tarball_name(directory, sha, codec):
+  if codec not in EXTENSIONS:
+    raise Exception("Unknown archive codec {0}. Use one of {1}".format(
+      codec, ", ".join(sorted(EXTENSIONS))))
+  return join(directory, sha + EXTENSIONS[codec])
+
+
+def split_tarball_name(tarball_path):
+  """
+  Returns the (sha, codec) encoded in a tarball's file name
+  """
+  filename = split(tarball_path)[1]
+  for codec, extension in EXTENSIONS.items():
+    if filename.endswith(extension):
+      return filename[:-len(extension)], codec
+  raise Exception("{0} is not a package tarball".format(tarball_path))
+
+
+class ProcessWriter(object):
+  """
+  A file-like object that pipes everything written to it
+  through a compressor process into filename
+  """
+
+  def __init__(self, args, filename):
+    self.args = args
+    self.output = open(filename, 'wb')
+    self.process = Popen(args, stdin=PIPE, stdout=self.output)
+
+  def write(self, data):
+    self.process.stdin.write(data)
+
+  def close(self):
+    self.process.stdin.close()
+    returncode = self.process.wait()
+    self.output.close()
+    if returncode != 0:
+      raise Exception("{0} failed with {1}".format(" ".join(self.args),
+                                                   returncode))
+
+
+class ProcessReader(object):
+  """
+  A file-like object that reads the output of a decompressor process
+  """
+
+  def __init__(self, args):
+    self.args = args
+    self.process = Popen(args, stdout=PIPE)
+
+  def read(self, size = -1):
+    return self.process.stdout.read(size)
+
+  def close(self):
+    self.process.stdout.close()
+    returncode = self.process.wait()
+    if returncode != 0:
+      raise Exception("{0} failed with {1}".format(" ".join(self.args),
+                                                   returncode))
+
+
+class ZstandardWriter(object):
+
+  def __init__(self, filename):
+    self.output = open(filename, 'wb')
+    compressor = zstandard.ZstdCompressor(threads = -1)
+    self.writer = compressor.stream_writer(self.output)
+
+  def write(self, data):
+    self.writer.write(data)
+
+  def close(self):
+    self.writer.flush(zstandard.FLUSH_FRAME)
+    self.output.close()
+
+
+class ZstandardReader(object):
+
+  def __init__(self, filename):
+    self.input = open(filename, 'rb')
+    self.reader = zstandard.ZstdDecompressor().stream_reader(self.input)
+
+  def read(self, size = -1):
+    return self.reader.read(size)
+
+  def close(self):
+    self.input.close()
+
+
+def open_writer(filename, codec):
+  """
+  Open filename for writing, compressing with codec
+  """
+  if codec == 'none':
+    return open(filename, 'wb')
+  elif codec == 'gz':
+    if find_executable('pigz'):
+      return ProcessWriter(['pigz', '-c'], filename)
+    return gzip.GzipFile(filename, 'wb')
+  elif codec == 'zst':
+    if find_executable('zstd'):
+      return ProcessWriter(['zstd', '-T0', '-q', '-c'], filename)
+    if zstandard:
+      return ZstandardWriter(filename)
+    raise Exception("The zst archive codec needs the zstd command "
+                    "or the zstandard python package")
+  raise Exception("Unknown archive codec {0}".format(codec))
+
+
+def open_reader(filename, codec):
+  """
+  Open filename for reading, decompressing with codec
+  """
+  if codec == 'none':
+    return open(filename, 'rb')
+  elif codec == 'gz':
+    if find_executable('pigz'):
+      return ProcessReader(['pigz', '-d', '-c', filename])
+    return gzip.GzipFile(filename, 'rb')
+  elif codec == 'zst':
+    if find_executable('zstd'):
+      return ProcessReader(['zstd', '-d', '-q', '-c', filename])
+    if zstandard:
+      return ZstandardReader(filename)
+    raise Exception("The zst archive codec needs the zstd command "
+                    "or the zstandard python package")
+  raise Exception("Unknown archive codec {0}".format(codec))
+
+
+def temporary_name(filename):
+  return "{0}.{1}.{2}.tmp".format(filename, os.getpid(),
+                                  threading.current_thread().ident)
+
+
+def write_tarball(output_filename, write):
+  """
+  Call write with a file-like object that compresses everything
+  written to it into output_filename, with the codec taken from
+  output_filename. It goes to a temporary name first, so a reader
+  never finds half a tarball, and nothing is left behind when
+  writing fails
+  """
+  sha, codec = split_tarball_name(output_filename)
+  temp = temporary_name(output_filename)
+  try:
+    output = open_writer(temp, codec)
+    try:
+      write(output)
+    finally:
+      output.close()
+    os.rename(temp, output_filename)
+  except Exception:
+    if os.path.exists(temp):
+      os.remove(temp)
+    raise
+
+
+def create_tarball(output_filename, source_dir, base = './', exclude = None):
+  """
+  Creates a tarball named output_filename from a directory
+  named source_dir. The codec is taken from output_filename.
+
+  The contents of source_dir will be placed inside a directory
+  called base inside of the tarball.
+  """
+  if exclude is None:
+    exclude = ['.git']
+
+  def write(output):
+    with tarfile.open(fileobj = output, mode = 'w|') as tar:
+      for f in sorted(os.listdir(source_dir)):
+        if f not in exclude:
+          tar.add(join(source_dir, f), arcname = join(base, f))
+  write_tarball(output_filename, write)
+
+
+def compress_stream(stream, output_filename):
+  """
+  Compress an uncompressed tar stream, for example the output of
+  git archive, into output_filename. The codec is taken from
+  output_filename.
+  """
+  def write(output):
+    while True:
+      chunk = stream.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      output.write(chunk)
+  write_tarball(output_filename, write)
+
+
+def git_archive(repository, refspec, output_filename, base):
+  """
+  Export the tree at refspec in the git repository into a tarball,
+  with everything inside a directory called base. The codec is
+  taken from output_filename.
+
+  git archive reads straight from the object database, so the
+  working tree is never touched, and any number of versions of one
+  repository can be exported at the same time.
+  """
+  args = ['git', '-C', repository, 'archive', '--format=tar',
+          '--prefix=' + base.rstrip('/') + '/', refspec]
+  # Not a pipe: git would stop once it filled up, while we're
+  # still waiting for the end of the archive
+  stderr = tempfile.TemporaryFile()
+  try:
+    git = Popen(args, stdout=PIPE, stderr=stderr)
+    try:
+      compress_stream(git.stdout, output_filename)
+    finally:
+      git.stdout.close()
+      git.wait()
+    stderr.seek(0)
+    errors = stderr.read()
+  finally:
+    stderr.close()
+  if git.returncode != 0:
+    if os.path.exists(output_filename):
+      os.remove(output_filename)
+    raise Exception("git archive of {0} at {1} failed: {2}".format(
+      repository, refspec, errors.decode('utf-8', 'replace').strip()))
+
+
+def unsafe_member(member, base = None):
+  """
+  Why extracting member could write outside the directory it's
+  extracted into, or outside base within it. None if it's safe
+  """
+  name = os.path.normpath(member.name)
+  if os.path.isabs(member.name) or name == '..' or name.startswith('../'):
+    return "it is outside the archive"
+  if base is not None and name != base and not name.startswith(base + '/'):
+    return "it is outside {0}/".format(base)
+  if member.isdev():
+    return "it is a device"
+  if member.issym() or member.islnk():
+    if os.path.isabs(member.linkname):
+      return "it links to an absolute path"
+    if member.issym():
+      # Relative to the directory the link is in
+      target = os.path.normpath(join(os.path.dirname(name), member.linkname))
+    else:
+      target = os.path.normpath(member.linkname)
+    if target == '..' or target.startswith('../') or \
+       (base is not None and target != base and not target.startswith(base + '/')):
+      return "it links outside the archive"
+  return None
+
+
+def extract_tarball(tarball_path, directory, base = None):
+  """
+  Extract a tarball into directory, one member at a time.
+
+  Tarballs can come from other machines, so members that would
+  end up outside directory, or outside directory/base when base
+  is given, aren't extracted. Raises an exception instead
+  """
+  sha, codec = split_tarball_name(tarball_path)
+  stream = open_reader(tarball_path, codec)
+
+  def checked(tar):
+    for member in tar:
+      reason = unsafe_member(member, base)
+      if reason:
+        raise Exception("Refusing to extract {0} from {1}: {2}".format(
+          member.name, tarball_path, reason))
+      yield member
+
+  try:
+    with tarfile.open(fileobj = stream, mode = 'r|') as tar:
+      if hasattr(tarfile, 'data_filter'):
+        tar.extractall(directory, members = checked(tar), filter = 'data')
+      else:
+        tar.extractall(directory, members = checked(tar))
+  finally:
+    stream.close()
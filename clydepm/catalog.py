@@ -0,0 +1,143 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import yaml
+from os.path import join, exists, isdir
+
+
+class PackageCatalog(object):
+  """
+  An index of the packages stored in a package directory (.packages).
+
+  The catalog is a SQLite database mapping each descriptor sha to
+  where the package lives, its name, version, traits, size and the
+  last time it was used. Looking up a package is a single indexed
+  query instead of listing a directory that can hold tens of
+  thousands of packages.
+
+  The directory is the source of truth. If a catalog entry points at
+  a directory that is gone, the entry is dropped, and a package
+  directory the catalog doesn't know about is added the first time
+  it is looked up. rebuild() rescans the whole directory.
+  """
+
+  def __init__(self, filename, package_directory):
+    self.filename = filename
+    self.package_directory = package_directory
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(filename,
+                                      timeout = 30,
+                                      check_same_thread = False)
+    with self.connection:
+      self.connection.execute("""
+        CREATE TABLE IF NOT EXISTS packages (
+          hash      TEXT PRIMARY KEY,
+          path      TEXT NOT NULL,
+          name      TEXT,
+          version   TEXT,
+          traits    TEXT,
+          size      INTEGER,
+          last_used REAL
+        )""")
+
+  def lookup(self, hash):
+    """
+    Returns the path of the package with descriptor sha hash,
+    or None if it isn't stored
+    """
+    with self.lock:
+      row = self.connection.execute(
+        "SELECT path FROM packages WHERE hash = ?", (hash,)).fetchone()
+      if row and isdir(row[0]):
+        with self.connection:
+          self.connection.execute(
+            "UPDATE packages SET last_used = ? WHERE hash = ?",
+            (time.time(), hash))
+        return row[0]
+
+    if row:
+      # Deleted behind our back
+      self.remove(hash)
+
+    path = join(self.package_directory, hash)
+    if isdir(path):
+      # Stored by something that didn't update the catalog
+      self.add(hash, path)
+      return path
+    return None
+
+  def add(self, hash, path, descriptor = None):
+    """
+    Record the package stored at path. If no descriptor is passed,
+    it is read from the package itself.
+    """
+    if descriptor is None:
+      descriptor = read_descriptor(path)
+
+    size = 0
+    for root, dirs, filenames in os.walk(path):
+      for filename in filenames:
+        try:
+          size += os.lstat(join(root, filename)).st_size
+        except OSError:
+          pass
+
+    with self.lock:
+      with self.connection:
+        self.connection.execute(
+          "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?, ?)",
+          (hash, path,
+           descriptor.get('name'),
+           str(descriptor.get('version')),
+           json.dumps(descriptor.get('traits'), sort_keys = True),
+           size,
+           time.time()))
+
+  def remove(self, hash):
+    with self.lock:
+      with self.connection:
+        self.connection.execute("DELETE FROM packages WHERE hash = ?", (hash,))
+
+  def clear(self):
+    with self.lock:
+      with self.connection:
+        self.connection.execute("DELETE FROM packages")
+
+  def entries(self):
+    with self.lock:
+      return self.connection.execute(
+        "SELECT hash, path, name, version, size, last_used "
+        "FROM packages ORDER BY name, version").fetchall()
+
+  def rebuild(self):
+    """
+    Throw away the catalog and recreate it from the package directory.
+    Returns the number of packages found.
+    """
+    self.clear()
+    count = 0
+    if not exists(self.package_directory):
+      return count
+    for hash in os.listdir(self.package_directory):
+      path = join(self.package_directory, hash)
+      if isdir(path) and not hash.startswith('.'):
+        self.add(hash, path)
+        count += 1
+    return count
+
+
+def read_descriptor(path):
+  """
+  Binary packages have a descriptor.yaml, source packages
+  only have their config.yaml
+  """
+  for filename in ['descriptor.yaml', 'config.yaml']:
+    config = join(path, filename)
+    if exists(config):
+      with open(config) as f:
+        descriptor = yaml.load(f)
+      if isinstance(descriptor, dict):
+        return descriptor
+  return {}
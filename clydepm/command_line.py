@@ -15,6 +15,9 @@ import getpass
 from clydepm.template import fetch
 
 from clydepm.config import load_config
+from clydepm.object_cache import ObjectCache
+from clydepm.http_package_server import serve as serve_packages
+from clydepm import tracing
 
 import sys
 from colorama import init
@@ -120,6 +123,9 @@ def make(builder, variant = 'src', platform = 'linux', show_graph = False):
     traceback.print_exc(file=sys.stdout)
     print (unicode(e))
     sys.exit(1)
+  finally:
+    # Even when the build failed, so editors can help fix it
+    builder.write_compilation_database()
   if show_graph:
     builder.u.view()
   return package
@@ -161,6 +167,28 @@ def test(builder):
   binary = package.get_binary()
   run_binary(binary)
 
+def cache(configuration, clear = False):
+  general = configuration['General']
+  object_cache = ObjectCache(general['object-cache-dir'], 
+                             general['object-cache-size'])
+  if clear:
+    print('Clearing {0}'.format(object_cache.directory))
+    object_cache.clear()
+  object_cache.print_stats()
+
+def serve(configuration, host, port, directory = None):
+  if directory is None:
+    directory = configuration['General']['package-cache-dir']
+  serve_packages(directory, host, port)
+
+def catalog(builder, rebuild = False):
+  if rebuild:
+    count = builder.catalog.rebuild()
+    print('Indexed {0} packages in {1}'.format(count, builder.package_directory))
+  for hash, path, name, version, size, last_used in builder.catalog.entries():
+    print('{0:<30} {1:<12} {2} {3:.1f} MB'.format(name, version, hash,
+                                                  size / 1024.0 ** 2))
+
 def init(builder, package_type = 'application'):
   print('initializing')
   builder.create_new_package(os.getcwd(), package_type)
@@ -189,6 +217,35 @@ def main():
   parser_run      = subparsers.add_parser('run')
   parser_flush    = subparsers.add_parser('flush')
   parser_fetch    = subparsers.add_parser('fetch')
+  parser_cache    = subparsers.add_parser('cache')
+  parser_catalog  = subparsers.add_parser('catalog')
+  parser_serve    = subparsers.add_parser('serve')
+
+  parser_serve.add_argument('--bind',
+                            type=str,
+                            default = '127.0.0.1',
+                            help = 'Address to listen on')
+
+  parser_serve.add_argument('--port',
+                            type=int,
+                            default = 8750,
+                            help = 'Port to listen on')
+
+  parser_serve.add_argument('--directory',
+                            type=str,
+                            default = None,
+                            help = 'Directory of package tarballs to serve '
+                                   '(defaults to package-cache-dir)')
+
+  parser_catalog.add_argument('--rebuild', 
+                              action='store_true',
+                              default = False,
+                              help = 'Rescan the local package store')
+
+  parser_cache.add_argument('--clear', 
+                            action='store_true',
+                            default = False,
+                            help = 'Delete all cached objects')
 
   parser_init.add_argument('type', 
                            type=str, 
@@ -220,6 +277,26 @@ def main():
                            default = 'linux',
                            help = 'platform to build e.g.  linux, rtems')
 
+  for p in [parser_make, parser_test, parser_run]:
+    p.add_argument('-j', '--jobs',
+                   type=int,
+                   default = None,
+                   help = 'Number of files to compile in parallel '
+                          '(defaults to the number of CPUs)')
+    p.add_argument('--incremental',
+                   action='store_true',
+                   default = False,
+                   help = 'Only recompile files whose sources, headers '
+                          'or flags changed')
+    p.add_argument('--parallel-deps',
+                   action='store_true',
+                   default = False,
+                   help = 'Build independent dependencies at the same time')
+    p.add_argument('--trace',
+                   type=str,
+                   default = None,
+                   help = 'Write a Chrome trace of the build to this file')
+
   commands = {
     'build'    : make,
     'clean'   : clean,
@@ -229,6 +306,9 @@ def main():
     'run'     : run,
     'fetch'   : fetch,
     'flush'   : flush,
+    'cache'   : cache,
+    'catalog' : catalog,
+    'serve'   : serve,
   }
   
   namespace = parser.parse_args()
@@ -239,25 +319,46 @@ def main():
       options = {}
 
       configuration = load_config(getcwd())
-      package_builder = PackageBuilder(configuration)
-
-      if 'type' in namespace:
-        commands[command](package_builder, namespace.type)
-
-      elif 'variant' in namespace or 'platform' in namespace:
-        commands[command](package_builder, 
-                          namespace.variant, 
-                          namespace.platform,
-                          namespace.graph)
-      elif command == 'fetch':
-        project_root = getcwd()
-        temp_package = Package(project_root, form = 'source')
-        commands[command](namespace.name, configuration['General'],
-                          temp_package.config, namespace.list)
-
+      if 'jobs' in namespace:
+        jobs = namespace.jobs
       else:
-        commands[command](package_builder)
-
+        jobs = None
+      incremental = 'incremental' in namespace and namespace.incremental
+      parallel_deps = 'parallel_deps' in namespace and namespace.parallel_deps
+      if 'trace' in namespace and namespace.trace:
+        tracing.start(namespace.trace)
+
+      try:
+        package_builder = PackageBuilder(configuration, jobs, incremental,
+                                         parallel_deps)
+
+        if 'type' in namespace:
+          commands[command](package_builder, namespace.type)
+
+        elif 'variant' in namespace or 'platform' in namespace:
+          commands[command](package_builder, 
+                            namespace.variant, 
+                            namespace.platform,
+                            namespace.graph)
+        elif command == 'cache':
+          commands[command](configuration, namespace.clear)
+        elif command == 'serve':
+          commands[command](configuration, namespace.bind, namespace.port,
+                            namespace.directory)
+        elif command == 'catalog':
+          commands[command](package_builder, namespace.rebuild)
+        elif command == 'fetch':
+          project_root = getcwd()
+          temp_package = Package(project_root, form = 'source')
+          commands[command](namespace.name, configuration['General'],
+                            temp_package.config, namespace.list)
+
+        else:
+          commands[command](package_builder)
+      finally:
+        trace = tracing.stop()
+        if trace:
+          print(colored("Wrote trace to {0}".format(trace.filename), 'green'))
 
 
 if __name__ == '__main__':
@@ -1,31 +1,15 @@
 import hashlib, os, sys
+import multiprocessing
 from os.path import join
+from .hashing import descriptor_sha
 from distutils.dir_util import copy_tree
 
 def stable_sha(data):
   """
-  Calculate a shaw of a potentailly nested dictionary of 
-  strings in a consistant way.
-
-  The dictionary is processed in sorted order recursively,
-  and hashses of the contents are appended, and then hashed 
-  again
-  """
-  hash = ""
-  if isinstance(data, dict):
-    sorted_data = sorted(data.items())
-    for k, v in sorted_data:
-      hash += stable_sha(v) + "\n"
-    return hashlib.sha1(hash.encode('utf-8')).hexdigest()
-  elif isinstance(data, bytes):
-    return hashlib.sha1(data).hexdigest()
-  elif isinstance(data, str):
-    return hashlib.sha1(data.encode('utf-8')).hexdigest()
-  elif isinstance(data, list):
-    for value in data:
-      hash += stable_sha(value) + "\n"
-      return hashlib.sha1(hash.encode('utf-8')).hexdigest()
-  raise Exception("Can't hash dict containing {0}".format(type(data)))
+  Calculate a sha of a potentially nested dictionary of 
+  strings in a consistent way. See clydepm.hashing
+  """
+  return descriptor_sha(data)
 
 
 class temporary_path(object):
@@ -62,6 +46,93 @@ class temp_cwd(object):
 
 
 
+def same_contents(a, b, chunk_size = 1 << 16):
+  """
+  Whether files a and b hold the same bytes
+  """
+  if os.path.getsize(a) != os.path.getsize(b):
+    return False
+  with open(a, 'rb') as f, open(b, 'rb') as g:
+    while True:
+      chunk = f.read(chunk_size)
+      if chunk != g.read(chunk_size):
+        return False
+      if not chunk:
+        return True
+
+
+class atomic_file(object):
+  """
+  A context manager for writing a file in place of filename.
+  Readers never see half a file: it is renamed into place at the
+  end, and removed if writing it fails. When it turns out the same
+  as the existing file, that one is kept so its mtime doesn't move.
+  changed says whether filename was replaced
+  """
+
+  def __init__(self, filename, mode = 'w'):
+    self.filename = filename
+    self.mode = mode
+    self.temp = "{0}.{1}.tmp".format(filename, os.getpid())
+    self.changed = False
+
+  def __enter__(self):
+    self.file = open(self.temp, self.mode)
+    return self.file
+
+  def __exit__(self, type, value, traceback):
+    self.file.close()
+    if type is not None or (os.path.exists(self.filename) and
+                            same_contents(self.temp, self.filename)):
+      os.remove(self.temp)
+    else:
+      os.rename(self.temp, self.filename)
+      self.changed = True
+
+
+def write_if_changed(filename, contents):
+  """
+  Write contents to filename unless it already holds exactly that.
+  Returns whether the file was written
+  """
+  output = atomic_file(filename)
+  with output as f:
+    f.write(contents)
+  return output.changed
+
+
+def default_jobs():
+  """
+  Number of parallel jobs used when the user doesn't
+  specify one with -j. This is the number of CPUs on the machine.
+  """
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+
+def physical_memory():
+  """
+  Bytes of RAM on this machine, or None if it can't be told
+  """
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (AttributeError, ValueError, OSError):
+    return None
+
+
+def memory_jobs(memory_per_job):
+  """
+  How many jobs that need memory_per_job bytes each fit in the RAM
+  of this machine. At least one, and at most default_jobs
+  """
+  memory = physical_memory()
+  if not memory:
+    return default_jobs()
+  return int(max(1, min(default_jobs(), memory // memory_per_job)))
+
+
 def dict_contains(superset, subset):
   return all(item in list(superset.items()) for item in list(subset.items()))
 
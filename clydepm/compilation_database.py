@@ -0,0 +1,62 @@
+"""
+compile_commands.json, the JSON compilation database clangd,
+YouCompleteMe and clang-tidy read the flags of each file from.
+See http://clang.llvm.org/docs/JSONCompilationDatabase.html
+
+Each entry is one compiler invocation:
+
+  {
+    "directory" : "/home/me/foo",
+    "file"      : "/home/me/foo/src/foo.cpp",
+    "output"    : "/home/me/foo/build/foo.o",
+    "arguments" : ["g++", "-c", "-o", "build/foo.o", "src/foo.cpp", "-Iinclude"]
+  }
+
+with either arguments, a list, or command, a shell command line.
+"""
+import json
+from os.path import join
+
+from .common import write_if_changed
+
+FILENAME = 'compile_commands.json'
+
+
+def compile_command(directory, source, output, arguments = None, command = None):
+  entry = {
+    'directory' : directory,
+    'file'      : join(directory, source),
+    'output'    : join(directory, output)
+  }
+  if arguments is not None:
+    entry['arguments'] = list(arguments)
+  else:
+    entry['command'] = command
+  return entry
+
+
+def read_compilation_database(filename):
+  """
+  The entries in filename, or an empty list if there is no
+  readable database there
+  """
+  try:
+    with open(filename) as f:
+      entries = json.load(f)
+  except (IOError, ValueError):
+    return []
+  if not isinstance(entries, list):
+    return []
+  return entries
+
+
+def write_compilation_database(filename, entries):
+  """
+  Write entries to filename, sorted so the file only changes
+  when a command does. Editors reindex every file when it
+  changes, so an identical file isn't rewritten. Returns
+  whether the file was written
+  """
+  entries = sorted(entries, key = lambda entry: (entry['file'], entry.get('output', '')))
+  return write_if_changed(filename, json.dumps(entries, indent = 2, sort_keys = True,
+                                               separators = (',', ': ')) + '\n')
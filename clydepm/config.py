@@ -23,7 +23,41 @@ def load_config(exec_root):
       'package-root'    : join(expanduser('~'), '.clyde', 'packages'),
       'git-root'        : join(expanduser('~'), '.clyde', 'git'),
       'user.name'       : getpass.getuser(),
-      'user.email'      : None
+      'user.email'      : None,
+      'object-cache'    : 'false',
+      'object-cache-dir': join(expanduser('~'), '.clyde', 'objects'),
+      'object-cache-size': '5G',
+      # copy, hardlink, reflink or symlink. See clydepm/install.py
+      'install-mode'    : 'copy',
+      # gz, zst or none. See clydepm/archive.py
+      'archive-codec'   : 'gz',
+      # Seconds clyde2 trusts its index of package tags before
+      # checking the remotes again
+      'tag-index-ttl'   : '3600',
+      # Packages fetched at the same time, by clyde2 while resolving
+      # and by clyde from package-cache-url
+      'fetch-jobs'      : '8',
+      # full, or some of blobless, tags and shallow. See
+      # clydepm/git_clone.py
+      'clone-strategy'  : 'full',
+      # Bare mirrors of package repositories, shared by every
+      # project clyde2 builds on this host. See clydepm/git_mirror.py
+      'git-mirrors'     : 'false',
+      'git-mirror-dir'  : join(expanduser('~'), '.clyde', 'mirrors'),
+      # Seconds between fetches of a mirror
+      'git-mirror-ttl'  : '3600',
+      # http://host:port of a clyde serve with binary packages, which
+      # are downloaded instead of built. See clydepm/http_package_server.py
+      'package-cache-url'     : None,
+      # Upload the packages built here to package-cache-url, e.g. on CI
+      'package-cache-upload'  : 'false',
+      # Where clyde serve keeps the packages it serves
+      'package-cache-dir'     : join(expanduser('~'), '.clyde', 'package-cache'),
+      # Memory one link, or one compile of a heavy-sources file,
+      # takes. clyde2 runs as many at once as fit in RAM, unless
+      # a config.yaml sets pools. See clyde2/generators/ninja_build.py
+      'link-memory'           : '4G',
+      'heavy-compile-memory'  : '2G'
     }
   
   }
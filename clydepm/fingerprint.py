@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+from os.path import join, relpath, exists, dirname
+
+# Files larger than this are hashed a chunk at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+  """
+  Calculate the sha1 of a file's contents without reading
+  the whole file into memory
+  """
+  sha = hashlib.sha1()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      sha.update(chunk)
+  return sha.hexdigest()
+
+
+def stat_key(st):
+  """
+  The parts of a stat result that change when a file is modified.
+  Python 2 doesn't have st_mtime_ns, so fall back to the float mtime.
+  """
+  mtime_ns = getattr(st, 'st_mtime_ns', None)
+  if mtime_ns is None:
+    mtime_ns = int(st.st_mtime * 1e9)
+  return [st.st_size, mtime_ns, st.st_ino]
+
+
+class StatCache(object):
+  """
+  A persistent map of (path, size, mtime_ns, inode) -> digest.
+
+  Files are only read and hashed when their stat information
+  has changed since the last time they were seen, so fingerprinting
+  an unchanged tree costs one stat() per file.
+
+  The cache is stored as JSON in filename, and written back
+  by save() if anything changed.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.entries = {}
+    self.dirty = False
+    if exists(filename):
+      try:
+        with open(filename) as f:
+          self.entries = json.load(f)
+      except ValueError:
+        # Corrupt cache. Start over
+        self.entries = {}
+
+  def digest(self, path):
+    key = stat_key(os.stat(path))
+    entry = self.entries.get(path)
+    if entry and entry[0] == key:
+      return entry[1]
+
+    digest = file_digest(path)
+    self.entries[path] = [key, digest]
+    self.dirty = True
+    return digest
+
+  def save(self):
+    if not self.dirty:
+      return
+    directory = dirname(self.filename)
+    if directory and not exists(directory):
+      os.makedirs(directory)
+    # Write to a temporary file and rename, so an interrupted
+    # build never leaves a truncated cache behind
+    temp_filename = self.filename + '.tmp'
+    with open(temp_filename, 'w') as f:
+      json.dump(self.entries, f)
+    os.rename(temp_filename, self.filename)
+    self.dirty = False
+
+
+def list_files(directories):
+  """
+  Every file below directories, in a stable order
+  """
+  files = []
+  for directory in directories:
+    if os.path.isfile(directory):
+      files.append(directory)
+      continue
+    for root, dirs, filenames in os.walk(directory):
+      dirs.sort()
+      for filename in sorted(filenames):
+        files.append(join(root, filename))
+  return files
+
+
+def fingerprint(directories, root, cache = None, method = 'content'):
+  """
+  Calculate a single sha1 over every file in directories.
+
+  The fingerprint covers each file's path relative to root and
+  either its contents (method = 'content') or its size and
+  modification time (method = 'timestamp'). A StatCache
+  avoids rehashing file contents that haven't changed.
+  """
+  sha = hashlib.sha1()
+  prefix = os.path.join(root, '')
+  for path in list_files(directories):
+    if method == 'content':
+      if cache:
+        digest = cache.digest(path)
+      else:
+        digest = file_digest(path)
+    elif method == 'timestamp':
+      digest = str(stat_key(os.stat(path))[:2])
+    else:
+      raise Exception("Unknown fingerprint method {0}".format(method))
+
+    # relpath() is slow, and almost every file is below root
+    if path.startswith(prefix):
+      name = path[len(prefix):]
+    else:
+      name = relpath(path, root)
+    sha.update(name.encode('utf-8'))
+    sha.update(b'\0')
+    sha.update(digest.encode('utf-8'))
+    sha.update(b'\n')
+
+  if cache:
+    cache.save()
+  return sha.hexdigest()
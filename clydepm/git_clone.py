@@ -0,0 +1,176 @@
+"""
+How package repositories are cloned, and how the objects a clone
+doesn't have yet are fetched when they are needed.
+
+A clone strategy is a comma separated list of
+
+  full      A plain git clone with every branch, tag and blob. The
+            default, and what clyde always did
+  blobless  Only commits and trees (--filter=blob:none). The files of
+            a version are fetched when it is exported or checked out
+  tags      Only fetch tags (refs/tags/*), never branches
+  shallow   Only the tagged commits that are used, without history
+            (--depth 1). Other versions are fetched one at a time
+            when they are selected
+
+blobless, tags and shallow can be combined, e.g. blobless,shallow.
+Partial clones need a server that allows filters (uploadpack.allowFilter).
+Servers that don't send everything, as if the strategy was full.
+"""
+import os
+import shutil
+from os.path import exists
+from subprocess import Popen, PIPE
+
+CLONE_STRATEGIES = ['full', 'blobless', 'tags', 'shallow']
+
+
+def git(repository, *args, **kwargs):
+  """
+  Run a git command in repository. Returns stdout, or raises
+  if git fails. input is written to its stdin
+  """
+  args = ['git', '-C', repository] + list(args)
+  process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+  stdout, stderr = process.communicate(kwargs.get('input', '').encode('utf-8'))
+  if process.returncode != 0:
+    raise Exception("{0} failed: {1}".format(" ".join(args),
+                                             stderr.decode('utf-8', 'replace').strip()))
+  return stdout.decode('utf-8').strip()
+
+
+class CloneStrategy(object):
+
+  def __init__(self, strategy = 'full'):
+    options = set(option.strip() for option in strategy.split(',') if option.strip())
+    unknown = options - set(CLONE_STRATEGIES)
+    if unknown:
+      raise Exception("Unknown clone-strategy {0}. Use some of {1}".format(
+        ", ".join(sorted(unknown)), ", ".join(CLONE_STRATEGIES)))
+    if 'full' in options and len(options) > 1:
+      raise Exception("clone-strategy full can't be combined with {0}".format(
+        ", ".join(sorted(options - set(['full'])))))
+    self.blobless = 'blobless' in options
+    self.tags_only = 'tags' in options
+    self.shallow = 'shallow' in options
+
+  @staticmethod
+  def from_config(configuration):
+    """
+    Create a CloneStrategy from the [General] section of the
+    clyde config
+    """
+    return CloneStrategy(configuration['General'].get('clone-strategy', 'full'))
+
+  @property
+  def full(self):
+    return not (self.blobless or self.tags_only or self.shallow)
+
+  def __str__(self):
+    options = [option for option, enabled in [('blobless', self.blobless),
+                                              ('tags', self.tags_only),
+                                              ('shallow', self.shallow)]
+               if enabled]
+    return ",".join(options) or 'full'
+
+  def fetch_options(self):
+    options = []
+    if self.blobless:
+      options.append('--filter=blob:none')
+    if self.shallow:
+      options.append('--depth=1')
+    return options
+
+  def clone(self, url, path, tag = None):
+    """
+    Clone url into path. A shallow clone only fetches tag, or
+    nothing at all if there is no tag yet. Returns whether the
+    clone worked. A failed clone leaves nothing behind
+    """
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    if exists(temp):
+      shutil.rmtree(temp)
+    try:
+      if self.full:
+        git('.', 'clone', '--quiet', url, temp)
+      else:
+        os.makedirs(temp)
+        git(temp, 'init', '--quiet')
+        git(temp, 'remote', 'add', 'origin', url)
+        if self.tags_only:
+          git(temp, 'config', 'remote.origin.fetch', '+refs/tags/*:refs/tags/*')
+        if not self.shallow:
+          git(temp, 'fetch', '--quiet', '--tags', *(self.fetch_options() + ['origin']))
+        elif tag is not None:
+          if not self.fetch_tag(temp, tag):
+            raise Exception("{0} has no tag {1}".format(url, tag))
+        else:
+          # Nothing is fetched until a version is selected, but
+          # the remote has to exist
+          git(temp, 'ls-remote', '--tags', 'origin')
+      os.rename(temp, path)
+      return True
+    except Exception:
+      if exists(temp):
+        shutil.rmtree(temp)
+      return False
+
+  def fetch_tags(self, repository):
+    """
+    Bring the tags of repository up to date. In a shallow clone
+    they are only fetched once they are used, see ensure_commit
+    """
+    if self.shallow:
+      return
+    git(repository, 'fetch', '--quiet', '--tags', '--force',
+        *(self.fetch_options() + ['origin']))
+
+  def fetch_tag(self, repository, tag):
+    """
+    Fetch the tag called tag. Returns False if origin doesn't have it
+    """
+    refspec = '+refs/tags/{0}:refs/tags/{0}'.format(tag)
+    try:
+      git(repository, 'fetch', '--quiet', '--no-tags',
+          *(self.fetch_options() + ['origin', refspec]))
+      return True
+    except Exception:
+      return False
+
+  def has_commit(self, repository, commit):
+    try:
+      git(repository, 'cat-file', '-e', commit + '^{commit}')
+      return True
+    except Exception:
+      return False
+
+  def ensure_commit(self, repository, commit, tag = None):
+    """
+    Fetch commit if repository doesn't have it yet. tag is fetched
+    instead when it is known, otherwise commit is fetched by sha
+    and kept under refs/clyde/commits
+    """
+    if self.has_commit(repository, commit):
+      return
+    if tag is not None and self.fetch_tag(repository, tag) and \
+       self.has_commit(repository, commit):
+      return
+    refspec = '{0}:refs/clyde/commits/{0}'.format(commit)
+    git(repository, 'fetch', '--quiet', '--no-tags',
+        *(self.fetch_options() + ['origin', refspec]))
+
+  def prefetch(self, repository, commit):
+    """
+    Fetch the files of commit that a blobless clone is missing,
+    all at once. git would otherwise fetch them one by one as
+    they are read
+    """
+    if not self.blobless:
+      return
+    listing = git(repository, 'rev-list', '--objects', '--no-walk',
+                  '--missing=print', commit)
+    missing = [line[1:] for line in listing.splitlines() if line.startswith('?')]
+    if missing:
+      git(repository, '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', '--quiet',
+          '--no-tags', '--no-write-fetch-head', '--recurse-submodules=no',
+          '--filter=blob:none', '--stdin', 'origin', input = "\n".join(missing) + "\n")
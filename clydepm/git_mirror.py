@@ -0,0 +1,147 @@
+"""
+A store of bare mirrors of package repositories, shared by every
+project on a host.
+
+Each remote is mirrored once, in {directory}/<name>-<sha of url>.git.
+The clones of a project borrow the mirror's objects through
+alternates (git clone --shared), and fetch from the mirror rather
+than the remote, so cloning a package for one more project costs
+almost no disk or network.
+
+A mirror is fetched from its remote at most once every ttl seconds,
+under a file lock, so projects built at the same time don't fetch
+it twice. Mirrors never prune unreachable objects, because clones
+may still be using them.
+"""
+import fcntl
+import hashlib
+import os
+import shutil
+import threading
+import time
+from os.path import join, exists, realpath, dirname, basename
+
+from .git_clone import git
+
+# Touched every time a mirror is fetched
+STAMP = 'clyde-updated'
+
+
+class MirrorStore(object):
+
+  def __init__(self, directory, ttl = 3600, refresh = False):
+    self.directory = realpath(directory)
+    self.ttl = float(ttl)
+    # Fetch each mirror once, whatever the ttl says
+    self.refresh = refresh
+    # Mirrors fetched by this process
+    self.updated = set()
+    self.lock = threading.Lock()
+    self.mirror_locks = {}
+    if not exists(self.directory):
+      os.makedirs(self.directory)
+
+  @staticmethod
+  def from_config(configuration, refresh = False):
+    """
+    Create a MirrorStore from the [General] section of the clyde
+    config, or return None if mirrors are disabled
+    """
+    general = configuration['General']
+    if str(general.get('git-mirrors', 'false')).lower() not in ['true', 'yes', 'on', '1']:
+      return None
+    return MirrorStore(general['git-mirror-dir'], general.get('git-mirror-ttl', 3600),
+                       refresh)
+
+  def mirror_path(self, url):
+    name = basename(url.rstrip('/'))
+    if name.endswith('.git'):
+      name = name[:-len('.git')]
+    sha = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    return join(self.directory, "{0}-{1}.git".format(name, sha))
+
+  def mirror_lock(self, path):
+    with self.lock:
+      if path not in self.mirror_locks:
+        self.mirror_locks[path] = threading.Lock()
+      return self.mirror_locks[path]
+
+  def is_fresh(self, path):
+    if path in self.updated:
+      return True
+    if self.refresh:
+      return False
+    try:
+      return time.time() - os.path.getmtime(join(path, STAMP)) < self.ttl
+    except OSError:
+      return False
+
+  def update(self, url, force = False):
+    """
+    Create or fetch the mirror of url, unless it was fetched less
+    than ttl seconds ago. force fetches it anyway. Returns its path
+    """
+    path = self.mirror_path(url)
+    if exists(path) and not force and self.is_fresh(path):
+      return path
+
+    with self.mirror_lock(path):
+      with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+          # Another thread or process may have just done it
+          if not exists(path):
+            self.create(url, path)
+          elif force or not self.is_fresh(path):
+            git(path, 'fetch', '--quiet', '--prune', 'origin')
+          with open(join(path, STAMP), 'w'):
+            pass
+          self.updated.add(path)
+        finally:
+          fcntl.flock(lock, fcntl.LOCK_UN)
+    return path
+
+  def create(self, url, path):
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    if exists(temp):
+      shutil.rmtree(temp)
+    try:
+      git(self.directory, 'clone', '--quiet', '--mirror', url, temp)
+      # Clones borrow objects from the mirror, so nothing it has
+      # may be deleted
+      git(temp, 'config', 'gc.pruneExpire', 'never')
+      git(temp, 'config', 'gc.reflogExpireUnreachable', 'never')
+      # Clones can still be partial, see clydepm.git_clone
+      git(temp, 'config', 'uploadpack.allowFilter', 'true')
+      os.rename(temp, path)
+    except Exception:
+      if exists(temp):
+        shutil.rmtree(temp)
+      raise
+
+  def clone(self, url, path):
+    """
+    Clone url into path, borrowing the objects of its mirror.
+    Returns whether the clone worked
+    """
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+      mirror = self.update(url)
+      git(self.directory, 'clone', '--quiet', '--shared', '--no-checkout', mirror, temp)
+      os.rename(temp, path)
+      return True
+    except Exception:
+      if exists(temp):
+        shutil.rmtree(temp)
+      return False
+
+  def update_origin(self, repository, force = False):
+    """
+    Update the mirror a clone fetches from, if it was cloned from one.
+    Returns whether it was
+    """
+    origin = git(repository, 'config', '--get', 'remote.origin.url')
+    if dirname(realpath(origin)) != self.directory or not exists(origin):
+      return False
+    self.update(git(origin, 'config', '--get', 'remote.origin.url'), force)
+    return True
@@ -1,9 +1,12 @@
 from .common import stable_sha, temp_cwd
+from .hashing import thaw
 from os.path import splitext, join, realpath
 import os
-import tarfile
 from git import Repo
 from .package import Package
+from .archive import create_tarball, tarball_name, git_archive
+from .git_clone import CloneStrategy
+from . import tracing
 from subprocess import Popen, PIPE
 import getpass
 from termcolor import colored
@@ -13,7 +16,7 @@ class PackageServer(object):
   """
   Base class for package servers.
 
-  Package servers are responsible for furnishing tar.gz files
+  Package servers are responsible for furnishing tarballs
   given a package descriptor.
 
   They can do so using any technique.
@@ -25,9 +28,12 @@ class PackageServer(object):
 
   After a build has completed, it is acceptable for a PackageServer to flush 
   it's cache.
+
+  codec is the compression used for tarballs. See clydepm.archive
   
   """
-  def __init__(self, root_directory):
+  def __init__(self, root_directory, codec = 'gz'):
+    self.codec = codec
     if root_directory is None:
       self.root_directory = os.getcwd()
     else:
@@ -53,14 +59,14 @@ class PackageServer(object):
     from a directory named source_dir.
 
     The contents of source_dir will be placed inside a directory
-    called base inside of the tarball.
+    called base inside of the tarball. The compression is chosen
+    by the extension of output_filename.
     """
+    with tracing.span('pack', os.path.split(output_filename)[1]):
+      create_tarball(output_filename, source_dir, base)
 
-    with tarfile.open(output_filename, "w:gz") as tar:
-      for f in os.listdir(source_dir):
-        if f != '.git':
-          path = join(source_dir, f)
-          tar.add(path, arcname=join(base, f) )
+  def tarball_name(self, hash):
+    return tarball_name(self.package_directory, hash, self.codec)
 
 class LocalGitPackageServer(PackageServer):
   """
@@ -75,12 +81,18 @@ class LocalGitPackageServer(PackageServer):
 
   {package_directory}
 
+  Repositories are cloned with clone_strategy, a CloneStrategy.
+  Versions a partial clone doesn't have are fetched when they are
+  asked for.
+
   """
 
-  def __init__(self, root_directory):
-    PackageServer.__init__(self, root_directory)
+  def __init__(self, root_directory, codec = 'gz', clone_strategy = None):
+    PackageServer.__init__(self, root_directory, codec)
+    self.clone_strategy = clone_strategy or CloneStrategy()
 
 
+  @tracing.traced('git', 'checkout')
   def checkout_tag(self, repo, spec):
     
     commit = repo.create_head('master')
@@ -90,24 +102,51 @@ class LocalGitPackageServer(PackageServer):
     else:
       raise Exception("Tag {0} not found".format(tag))
 
-  def checkout_remote_repo(self, repo_path):
-    name = os.path.split(repo_path)[1]
-    with temp_cwd(self.git_directory):
-      args = ['git','clone', repo_path]
-      git = Popen(args, stdout=PIPE, stderr=PIPE)
+  def resolve_refspec(self, path, version):
+    """
+    Find the commit a package version refers to. Versions are
+    usually tags, with or without a leading v, but any refspec works
+    """
+    for refspec in [version, 'v' + version]:
+      git = Popen(['git', '-C', path, 'rev-parse', '--verify', '--quiet',
+                   refspec + '^{commit}'], stdout=PIPE, stderr=PIPE)
       stdout, stderr = git.communicate()
       if git.returncode == 0:
-        return True
-      return False
+        return stdout.decode('utf-8').strip()
+    return None
+
+  def fetch_version(self, path, version):
+    """
+    Fetch the tag of version into a clone that doesn't have it yet.
+    Returns its commit, or None if origin doesn't have it either
+    """
+    for tag in [version, 'v' + version]:
+      with tracing.span('git', 'fetch {0} {1}'.format(os.path.split(path)[1], tag)):
+        fetched = self.clone_strategy.fetch_tag(path, tag)
+      if fetched:
+        return self.resolve_refspec(path, tag)
+    return None
+
+  def checkout_remote_repo(self, repo_path, version = None):
+    """
+    Clone repo_path into {git_directory}. A shallow clone only
+    fetches version
+    """
+    name = os.path.split(repo_path)[1]
+    with tracing.span('git', 'clone ' + name):
+      if version is not None and self.clone_strategy.shallow:
+        return (self.clone_strategy.clone(repo_path, join(self.git_directory, name), version) or
+                self.clone_strategy.clone(repo_path, join(self.git_directory, name), 'v' + version))
+      return self.clone_strategy.clone(repo_path, join(self.git_directory, name))
 
-  def checkout_remote_project(self, project_name):
+  def checkout_remote_project(self, project_name, version = None):
     username = username = getpass.getuser()
     if username == 'igutek':
         username = "isaac.gutekunst"
     base_url = 'ssh://{0}@git.crl.vecna.com:29418/clyde/packages/{1}'.format(username,
                                                                   project_name)
     print((colored('Checking out {0}'.format(base_url),'green')))
-    return self.checkout_remote_repo(base_url)
+    return self.checkout_remote_repo(base_url, version)
 
   def get_package_tarball_by_descriptor(self, descriptor):
     """
@@ -122,27 +161,33 @@ class LocalGitPackageServer(PackageServer):
     if descriptor['form'] != 'source':
         return None
     hash = stable_sha(descriptor)
-    package_paths = [d for d in os.listdir(self.git_directory) ]
     name = descriptor['name']
 
-    package_tar_name = join(self.package_directory, hash + '.tar.gz')
+    package_tar_name = self.tarball_name(hash)
     package_version =  descriptor['version']
 
-    if name in package_paths:
+    if os.path.isdir(join(self.git_directory, name)):
       pass
     else:
-      if not self.checkout_remote_project(name):
+      if not self.checkout_remote_project(name, package_version):
         raise Exception("failed to checkout")
 
 
-    # TODO make this export from a git repo
     path = join(self.git_directory, name)
-    repo = Repo(path)
-    self.checkout_tag(repo, package_version)
-    # There is a potential race condition if multiple builds
-    # Require different versions of git dependency and try to get 
-    # it simultaneously
-    self.make_tarfile(package_tar_name, path, hash)
+    commit = self.resolve_refspec(path, package_version)
+    if commit is None:
+      commit = self.fetch_version(path, package_version)
+    if commit is None:
+      raise Exception("Version {0} of {1} not found in {2}".format(
+        package_version, name, path))
+
+    # Export straight from the object database. The working tree
+    # is left alone, so builds that need different versions of
+    # the same package don't race each other
+    with tracing.span('git', 'prefetch {0} {1}'.format(name, package_version)):
+      self.clone_strategy.prefetch(path, commit)
+    with tracing.span('pack', '{0} {1}'.format(name, package_version)):
+      git_archive(path, commit, package_tar_name, hash)
     return package_tar_name
 
 
@@ -150,8 +195,8 @@ class LocalGitPackageServer(PackageServer):
 
 class LocalForeignPackagerServer(PackageServer):
 
-  def __init__(self, root_directory):
-    PackageServer.__init__(self, root_directory)
+  def __init__(self, root_directory, codec = 'gz'):
+    PackageServer.__init__(self, root_directory, codec)
     
     self.foreign_package_directory = self.package_directory
     self.package_directory = join(self.root_directory, 'compiled-packages') 
@@ -159,6 +204,7 @@ class LocalForeignPackagerServer(PackageServer):
   def foreign_build(self, path, descriptor):
     package = Package(path, form = 'source', traits = descriptor['traits']) 
     package.build()
+    descriptor = thaw(descriptor)
     descriptor['form'] = 'binary'
     package.create_archive(descriptor)
     return package
@@ -200,19 +246,19 @@ class LocalForeignPackagerServer(PackageServer):
     hash = stable_sha(descriptor)
     if not os.path.exists(self.foreign_package_directory):
         return None
-    package_paths = [d for d in os.listdir(self.foreign_package_directory) ]
     name = descriptor['name']
 
-    package_tar_name = join(self.package_directory, hash + '.tar.gz')
+    package_tar_name = self.tarball_name(hash)
     package_version =  descriptor['version']
 
     if os.path.exists(package_tar_name):
         return package_tar_name
 
-    if name in package_paths:
+    if os.path.isdir(join(self.foreign_package_directory, name)):
       # TODO make this export from a git repo
       path = join(self.foreign_package_directory, name)
-      package = self.foreign_build(path, descriptor)
+      with tracing.span('build', name):
+        package = self.foreign_build(path, descriptor)
       hash = stable_sha(descriptor)
       self.make_tarfile(package_tar_name, package.get_archive_dir(), hash)
       return package_tar_name
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Hashing of package descriptors.
+
+A descriptor is serialized once, in a canonical form (JSON with
+sorted keys and no whitespace), and the result is hashed with a
+single SHA-1. The serialization keeps keys, types and every list
+element, unlike the old nested stable_sha which ignored keys and
+only looked at the first element of a list.
+
+SCHEMA_VERSION is hashed in front of every descriptor. Bump it
+whenever the serialization or the meaning of a descriptor changes,
+so packages stored under the old addresses are never mistaken for
+new ones.
+
+Descriptors that get hashed over and over can be wrapped in a
+FrozenDescriptor, which can't be modified and computes its sha
+only once. PackageBuilder hands dependency descriptors around
+frozen, so the catalog, the servers and the scheduler all share
+one sha per descriptor.
+
+Run this module to see what hashing costs per dependency graph node:
+
+  python -m clydepm.hashing
+"""
+import hashlib
+import json
+import timeit
+
+try:
+  from collections.abc import Mapping
+except ImportError:
+  from collections import Mapping
+
+SCHEMA_VERSION = 1
+
+_prefix = "clyde-descriptor-v{0}\n".format(SCHEMA_VERSION).encode('utf-8')
+
+
+def _default(data):
+  if isinstance(data, FrozenDescriptor):
+    return data._data
+  if isinstance(data, bytes):
+    return data.decode('utf-8')
+  if isinstance(data, (set, frozenset)):
+    return sorted(data)
+  raise Exception("Can't hash dict containing {0}".format(type(data)))
+
+
+def canonical(data):
+  """
+  The canonical serialization of data, as bytes
+  """
+  return json.dumps(data, sort_keys = True, separators = (',', ':'),
+                    default = _default).encode('utf-8')
+
+
+def descriptor_sha(data):
+  """
+  Hex SHA-1 of a (possibly nested) dictionary of strings,
+  lists and numbers. The same data always gives the same sha,
+  whatever order its keys were inserted in.
+  """
+  if isinstance(data, FrozenDescriptor):
+    return data.sha
+  sha = hashlib.sha1(_prefix)
+  sha.update(canonical(data))
+  return sha.hexdigest()
+
+
+_name_hashes = {}
+
+def name_hash(name):
+  """
+  Python hash() for objects identified only by a package name, like
+  Package and EmptyPackage. Memoized, because dependency sets test
+  membership far more often than new names show up.
+  """
+  h = _name_hashes.get(name)
+  if h is None:
+    h = _name_hashes[name] = int(descriptor_sha({'name' : name}), 16)
+  return h
+
+
+def _freeze(data):
+  if isinstance(data, dict):
+    return FrozenDescriptor(data)
+  if isinstance(data, (list, tuple)):
+    return tuple(_freeze(v) for v in data)
+  return data
+
+
+def _thaw(data):
+  if isinstance(data, FrozenDescriptor):
+    return data.thaw()
+  if isinstance(data, tuple):
+    return [_thaw(v) for v in data]
+  return data
+
+
+def thaw(descriptor):
+  """
+  A plain dictionary copy of descriptor, frozen or not, that
+  can be modified
+  """
+  if isinstance(descriptor, FrozenDescriptor):
+    return descriptor.thaw()
+  return dict(descriptor)
+
+
+class FrozenDescriptor(Mapping):
+  """
+  A read only descriptor. Nested dictionaries and lists are frozen
+  too, so the sha can be computed once and kept.
+
+  Use thaw() to get back a plain dictionary that can be modified.
+  """
+  __slots__ = ['_data', '_sha', '_hash']
+
+  def __init__(self, data):
+    self._data = dict((k, _freeze(v)) for k, v in data.items())
+    self._sha = None
+    self._hash = None
+
+  @property
+  def sha(self):
+    if self._sha is None:
+      sha = hashlib.sha1(_prefix)
+      sha.update(canonical(self._data))
+      self._sha = sha.hexdigest()
+    return self._sha
+
+  def thaw(self):
+    return dict((k, _thaw(v)) for k, v in self._data.items())
+
+  def __getitem__(self, key):
+    return self._data[key]
+
+  def __iter__(self):
+    return iter(self._data)
+
+  def __len__(self):
+    return len(self._data)
+
+  def __hash__(self):
+    if self._hash is None:
+      self._hash = int(self.sha[:16], 16)
+    return self._hash
+
+  def __eq__(self, other):
+    if isinstance(other, FrozenDescriptor):
+      return self.sha == other.sha
+    return Mapping.__eq__(self, other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return "FrozenDescriptor({0!r})".format(self._data)
+
+
+def benchmark(nodes = 1000, repeat = 5):
+  """
+  Time hashing a dependency graph of nodes descriptors, the way the
+  package builder sees them. Returns microseconds per node for plain
+  dictionaries, for the first hash of a FrozenDescriptor, and for
+  every hash after that.
+  """
+  descriptors = []
+  for i in range(nodes):
+    descriptors.append({
+      'name'     : 'package-{0}'.format(i),
+      'version'  : 'v1.{0}.0'.format(i % 10),
+      'form'     : 'binary',
+      'traits'   : {'cflags' : {'gcc' : ['-O2', '-g', '-Wall'],
+                                'g++' : ['-O2', '-std=c++11']},
+                    'platform' : 'linux'},
+      'dependencies' : dict(('package-{0}'.format(j), {'version' : 'v1.0.0'})
+                            for j in range(max(0, i - 3), i))
+    })
+
+  def per_node(statement):
+    return min(timeit.repeat(statement, number = 1, repeat = repeat)) * 1e6 / nodes
+
+  plain = per_node(lambda: [descriptor_sha(d) for d in descriptors])
+  first = per_node(lambda: [FrozenDescriptor(d).sha for d in descriptors])
+  frozen = [FrozenDescriptor(d) for d in descriptors]
+  [d.sha for d in frozen]
+  cached = per_node(lambda: [descriptor_sha(d) for d in frozen])
+  return plain, first, cached
+
+
+if __name__ == '__main__':
+  plain, first, cached = benchmark()
+  print("Microseconds per graph node")
+  print("\tdict                 {0:.2f}".format(plain))
+  print("\tFrozenDescriptor     {0:.2f}".format(first))
+  print("\tFrozenDescriptor sha {0:.2f} (cached)".format(cached))
@@ -0,0 +1,406 @@
+"""
+A cache of binary packages served over HTTP, so packages built once,
+for example by CI, don't have to be built again on every machine.
+
+The server keeps package tarballs in one directory, named by the
+sha of their descriptor (<sha>.tar.gz, <sha>.tar.zst or <sha>.tar,
+see clydepm.archive):
+
+  GET  /<sha>.tar.gz   The tarball
+  GET  /<sha>          The tarball with any codec. Content-Location
+                       says which
+  HEAD                 The same, without the tarball
+  PUT  /<sha>.tar.gz   Store a tarball
+
+GETs answer If-None-Match with 304 Not Modified when the ETag
+matches. Run it with clyde serve.
+
+HttpPackageServer is the client side, a PackageServer for the
+package-cache-url in the clyde config. It keeps connections open
+between requests, downloads several packages at once (prefetch),
+and only downloads a tarball again if it changed on the server.
+"""
+import os
+import re
+import socket
+import threading
+from os.path import join, exists
+from multiprocessing.pool import ThreadPool
+
+try:
+  from http.client import HTTPConnection, HTTPSConnection, HTTPException
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import urlparse
+except ImportError:
+  from httplib import HTTPConnection, HTTPSConnection, HTTPException
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urlparse import urlparse
+
+from termcolor import colored
+
+from .archive import (EXTENSIONS, CHUNK_SIZE, split_tarball_name, tarball_name,
+                      create_tarball, temporary_name)
+from .common import stable_sha
+from .git_package_server import PackageServer
+from . import tracing
+
+SHA = re.compile('^[0-9a-f]{40}$')
+
+
+def copy_stream(source, destination, length = None):
+  """
+  Copy length bytes, or everything, from source to destination
+  in chunks
+  """
+  while length is None or length > 0:
+    size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length)
+    chunk = source.read(size)
+    if not chunk:
+      break
+    destination.write(chunk)
+    if length is not None:
+      length -= len(chunk)
+  if length:
+    raise Exception("Connection closed with {0} bytes to go".format(length))
+
+
+def etag(path):
+  stat = os.stat(path)
+  return '"{0:x}-{1:x}"'.format(stat.st_size, int(stat.st_mtime * 1000000))
+
+
+class PackageRequestHandler(BaseHTTPRequestHandler):
+  # Keep connections open between requests
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  def tarball(self):
+    """
+    The path of the tarball a request is for, or None if the path
+    isn't the name of a package tarball
+    """
+    name = self.path.lstrip('/')
+    if SHA.match(name):
+      for codec in sorted(EXTENSIONS):
+        path = tarball_name(self.server.directory, name, codec)
+        if exists(path):
+          return path
+      return tarball_name(self.server.directory, name, 'gz')
+    try:
+      sha, codec = split_tarball_name(name)
+    except Exception:
+      return None
+    if not SHA.match(sha) or name != sha + EXTENSIONS[codec]:
+      return None
+    return join(self.server.directory, name)
+
+  def reply(self, code, message = '', close = False):
+    body = message.encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(body)))
+    if close:
+      self.send_header('Connection', 'close')
+      self.close_connection = True
+    self.end_headers()
+    if body and self.command != 'HEAD':
+      self.wfile.write(body)
+
+  def do_HEAD(self):
+    self.do_GET()
+
+  def do_GET(self):
+    path = self.tarball()
+    if path is None:
+      return self.reply(400, "Not a package tarball\n")
+    try:
+      f = open(path, 'rb')
+    except IOError:
+      return self.reply(404, "No such package\n")
+    with f:
+      tag = etag(path)
+      if self.headers.get('If-None-Match') == tag:
+        self.send_response(304)
+        self.send_header('ETag', tag)
+        self.end_headers()
+        return
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/octet-stream')
+      self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+      self.send_header('Content-Location', '/' + os.path.split(path)[1])
+      self.send_header('ETag', tag)
+      self.end_headers()
+      if self.command != 'HEAD':
+        copy_stream(f, self.wfile)
+
+  def do_PUT(self):
+    path = self.tarball()
+    length = self.headers.get('Content-Length')
+    # The body isn't read when a PUT is refused, so the
+    # connection can't be used again
+    if path is None or SHA.match(self.path.lstrip('/')):
+      return self.reply(400, "Not a package tarball\n", close = True)
+    if length is None:
+      return self.reply(411, "Content-Length required\n", close = True)
+    # Readers never see half a tarball
+    temp = temporary_name(path)
+    try:
+      with open(temp, 'wb') as f:
+        copy_stream(self.rfile, f, int(length))
+      os.rename(temp, path)
+    except Exception:
+      if exists(temp):
+        os.remove(temp)
+      raise
+    self.reply(201)
+
+
+class PackageCacheServer(ThreadingMixIn, HTTPServer):
+  """
+  Serves the package tarballs in directory, one thread per connection
+  """
+  daemon_threads = True
+
+  def __init__(self, directory, address = ('127.0.0.1', 8750), verbose = False):
+    self.directory = os.path.realpath(directory)
+    self.verbose = verbose
+    if not exists(self.directory):
+      os.makedirs(self.directory)
+    HTTPServer.__init__(self, address, PackageRequestHandler)
+
+
+def serve(directory, host = '127.0.0.1', port = 8750):
+  server = PackageCacheServer(directory, (host, port), verbose = True)
+  print(colored("Serving {0} on http://{1}:{2}/".format(server.directory, host,
+                                                        server.server_address[1]),
+                'green'))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+class ConnectionPool(object):
+  """
+  Open connections to one HTTP server, reused between requests.
+  At most size of them are kept open while idle
+  """
+
+  def __init__(self, url, size = 8, timeout = 60):
+    parsed = urlparse(url)
+    if parsed.scheme not in ['http', 'https']:
+      raise Exception("package-cache-url has to be http or https: {0}".format(url))
+    self.scheme = parsed.scheme
+    self.host = parsed.hostname
+    self.port = parsed.port
+    self.base = parsed.path.rstrip('/')
+    self.size = size
+    self.timeout = timeout
+    self.idle = []
+    self.lock = threading.Lock()
+
+  def connect(self):
+    if self.scheme == 'https':
+      return HTTPSConnection(self.host, self.port, timeout = self.timeout)
+    return HTTPConnection(self.host, self.port, timeout = self.timeout)
+
+  def acquire(self):
+    with self.lock:
+      if self.idle:
+        return self.idle.pop(), True
+    return self.connect(), False
+
+  def release(self, connection):
+    with self.lock:
+      if len(self.idle) < self.size:
+        self.idle.append(connection)
+        return
+    connection.close()
+
+  def request(self, method, path, headers = None, body = None, output = None):
+    """
+    Send a request, and write the response body to output if it
+    succeeded. Returns the response status and headers.
+
+    A connection that was reused may have been closed by the server
+    since its last request, so the request is sent again on a new
+    one when it fails
+    """
+    while True:
+      connection, reused = self.acquire()
+      try:
+        for stream in [body, output]:
+          if hasattr(stream, 'seek'):
+            stream.seek(0)
+        if hasattr(output, 'truncate'):
+          output.truncate()
+        connection.request(method, self.base + path, body, headers or {})
+        response = connection.getresponse()
+        if 200 <= response.status < 300 and output is not None:
+          length = response.getheader('Content-Length')
+          copy_stream(response, output, None if length is None else int(length))
+        else:
+          response.read()
+        result = (response.status, dict((key.lower(), value)
+                                        for key, value in response.getheaders()))
+      except (HTTPException, socket.error):
+        connection.close()
+        if reused:
+          continue
+        raise
+      except Exception:
+        connection.close()
+        raise
+      if response.getheader('Connection', '').lower() == 'close':
+        connection.close()
+      else:
+        self.release(connection)
+      return result
+
+  def close(self):
+    with self.lock:
+      for connection in self.idle:
+        connection.close()
+      self.idle = []
+
+
+class HttpPackageServer(PackageServer):
+  """
+  Binary packages from a package cache server. See PackageCacheServer.
+
+  Downloaded tarballs are kept in {package_directory} with their
+  ETag, and only downloaded again if they changed on the server.
+
+  With upload set, packages built here are sent to the server too.
+  """
+  # get_package_tarball_by_descriptor can run on several threads
+  thread_safe = True
+
+  def __init__(self, root_directory, url, codec = 'gz', jobs = 8, upload = False):
+    PackageServer.__init__(self, root_directory, codec)
+    self.url = url
+    self.jobs = jobs
+    self.upload = upload
+    self.pool = ConnectionPool(url, jobs)
+    # Tarballs already checked with the server during this run
+    self.fetched = {}
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def from_config(configuration, root_directory, codec = 'gz'):
+    """
+    Create an HttpPackageServer from the [General] section of the
+    clyde config, or return None if there is no package-cache-url
+    """
+    general = configuration['General']
+    if not general.get('package-cache-url'):
+      return None
+    return HttpPackageServer(root_directory, general['package-cache-url'], codec,
+                             int(general.get('fetch-jobs', 8)),
+                             str(general.get('package-cache-upload', 'false')).lower()
+                             in ['true', 'yes', 'on', '1'])
+
+  def get_package_tarball_by_descriptor(self, descriptor):
+    """
+    Download the binary package descriptor describes, if the server
+    has it. Returns the path of the tarball, or None
+    """
+    if descriptor['form'] != 'binary' or descriptor['version'] == 'local':
+      return None
+    return self.get_tarball(stable_sha(descriptor))
+
+  def get_tarball(self, sha):
+    with self.lock:
+      if sha in self.fetched:
+        return self.fetched[sha]
+
+    existing = [tarball_name(self.package_directory, sha, codec)
+                for codec in sorted(EXTENSIONS)]
+    existing = [path for path in existing if exists(path) and exists(path + '.etag')]
+    headers = {}
+    if existing:
+      with open(existing[0] + '.etag') as f:
+        headers['If-None-Match'] = f.read().strip()
+
+    temp = temporary_name(join(self.package_directory, sha))
+    try:
+      with tracing.span('download', sha[:8]):
+        with open(temp, 'wb') as output:
+          status, response_headers = self.pool.request('GET', '/' + sha, headers,
+                                                       output = output)
+      if status == 304:
+        path = existing[0]
+      elif status == 200:
+        name = response_headers['content-location'].split('/')[-1]
+        if split_tarball_name(name)[0] != sha:
+          raise Exception("asked for {0}, but got {1}".format(sha, name))
+        path = join(self.package_directory, name)
+        os.rename(temp, path)
+        with open(path + '.etag', 'w') as f:
+          f.write(response_headers.get('etag', ''))
+      elif status == 404:
+        path = None
+      else:
+        raise Exception("{0} answered {1} for {2}".format(self.url, status, sha))
+    except Exception as e:
+      # Packages can always be built from source instead
+      print(colored("Couldn't download {0} from {1}: {2}".format(sha, self.url, e),
+                    'yellow'))
+      path = None
+    finally:
+      if exists(temp):
+        os.remove(temp)
+
+    with self.lock:
+      self.fetched[sha] = path
+    return path
+
+  def prefetch(self, descriptors):
+    """
+    Download the binary packages of descriptors at the same time,
+    up to jobs at once
+    """
+    shas = set(stable_sha(d) for d in descriptors
+               if d['form'] == 'binary' and d['version'] != 'local')
+    shas = [sha for sha in shas if sha not in self.fetched]
+    if len(shas) < 2:
+      return
+    pool = ThreadPool(min(self.jobs, len(shas)))
+    try:
+      pool.map(self.get_tarball, shas)
+    finally:
+      pool.close()
+      pool.join()
+
+  def put_package(self, path):
+    """
+    Upload the stored package at path, which is named by its sha
+    """
+    sha = os.path.split(path)[1]
+    tarball = self.tarball_name(sha)
+    try:
+      create_tarball(tarball, path, sha)
+      with tracing.span('upload', sha[:8]):
+        with open(tarball, 'rb') as f:
+          status, headers = self.pool.request(
+            'PUT', '/' + os.path.split(tarball)[1],
+            {'Content-Length' : str(os.path.getsize(tarball)),
+             'Content-Type' : 'application/octet-stream'}, f)
+      if status >= 300:
+        raise Exception("{0} answered {1}".format(self.url, status))
+    except Exception as e:
+      print(colored("Couldn't upload {0} to {1}: {2}".format(sha, self.url, e), 'yellow'))
+      return False
+    return True
+
+  def flush(self):
+    PackageServer.flush(self)
+    with self.lock:
+      self.fetched = {}
@@ -0,0 +1,94 @@
+import os
+
+
+def read_depfile(path):
+  """
+  Parse a Makefile style dependency file, as written by
+  gcc -MMD, and return the list of prerequisites.
+
+  The file looks like
+
+    build/foo.o: src/foo.c include/foo.h \
+      include/bar.h
+
+  Spaces inside of paths are escaped with a backslash.
+  """
+  with open(path) as f:
+    contents = f.read().replace('\\\n', ' ')
+
+  prerequisites = []
+  for line in contents.splitlines():
+    if ': ' not in line:
+      continue
+    rule = line.split(': ', 1)[1]
+
+    current = ''
+    escaped = False
+    for c in rule:
+      if escaped:
+        current += c
+        escaped = False
+      elif c == '\\':
+        escaped = True
+      elif c.isspace():
+        if current:
+          prerequisites.append(current)
+        current = ''
+      else:
+        current += c
+    if current:
+      prerequisites.append(current)
+  return prerequisites
+
+
+def command_file(output):
+  return output + '.cmd'
+
+
+def record_command(output, args):
+  """
+  Remember the command used to create output, so changing
+  flags causes a rebuild even when no file changed
+  """
+  with open(command_file(output), 'w') as f:
+    f.write("\n".join(args))
+
+
+def forget_command(output):
+  if os.path.exists(command_file(output)):
+    os.remove(command_file(output))
+
+
+def needs_rebuild(output, args, inputs = None, depfile = None):
+  """
+  Returns True if output has to be recreated by running args.
+
+  This happens when the output is missing, it was created with
+  a different command, or any of the inputs (plus everything
+  listed in depfile) is newer than the output.
+  """
+  if not os.path.exists(output):
+    return True
+
+  try:
+    with open(command_file(output)) as f:
+      if f.read() != "\n".join(args):
+        return True
+  except IOError:
+    return True
+
+  prerequisites = list(inputs or [])
+  if depfile:
+    if not os.path.exists(depfile):
+      return True
+    prerequisites.extend(read_depfile(depfile))
+
+  output_mtime = os.stat(output).st_mtime
+  for prerequisite in prerequisites:
+    try:
+      if os.stat(prerequisite).st_mtime > output_mtime:
+        return True
+    except OSError:
+      # A header was deleted or renamed
+      return True
+  return False
@@ -0,0 +1,144 @@
+import errno
+import fcntl
+import os
+import shutil
+import threading
+from os.path import join, exists, isdir, islink, relpath, realpath
+
+INSTALL_MODES = ['copy', 'hardlink', 'reflink', 'symlink']
+
+# ioctl from linux/fs.h that shares the blocks of one file with another
+FICLONE = 0x40049409
+
+
+def persistent_mode(mode):
+  """
+  The install mode to use for copies that have to outlive their
+  source, like archives and the .packages store. Symlinks would
+  dangle as soon as the build directory is cleaned.
+  """
+  if mode == 'symlink':
+    return 'hardlink'
+  return mode
+
+
+def source_mode(mode):
+  """
+  The install mode for files taken from a package's source tree,
+  like its headers. They end up in archives and the .packages store,
+  which everyone using the package's sha shares, so they must never
+  share an inode with a file someone may edit in place. Reflinks
+  fall back to a copy where blocks can't be shared.
+  """
+  if mode in ['hardlink', 'symlink']:
+    return 'reflink'
+  return mode
+
+
+def temporary_name(dest):
+  return "{0}.{1}.{2}.tmp".format(dest, os.getpid(), 
+                                  threading.current_thread().ident)
+
+
+def copy_file(src, dest):
+  shutil.copyfile(src, dest)
+  shutil.copystat(src, dest)
+
+
+def reflink_file(src, dest):
+  """
+  Clone src into dest without copying data on filesystems that
+  support it (btrfs, xfs). Otherwise let the kernel do the copy
+  with copy_file_range, and fall back to a plain copy.
+  """
+  with open(src, 'rb') as s:
+    with open(dest, 'wb') as d:
+      try:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+      except (IOError, OSError):
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        remaining = os.fstat(s.fileno()).st_size
+        try:
+          if copy_file_range is None:
+            raise OSError(errno.ENOSYS, "copy_file_range not available")
+          while remaining > 0:
+            copied = copy_file_range(s.fileno(), d.fileno(), remaining)
+            if copied == 0:
+              break
+            remaining -= copied
+        except OSError:
+          s.seek(0)
+          d.seek(0)
+          d.truncate()
+          shutil.copyfileobj(s, d)
+  shutil.copystat(src, dest)
+
+
+def install_file(src, dest, mode = 'copy'):
+  """
+  Make dest have the contents of src.
+
+  The file is created under a temporary name and renamed into place,
+  so an existing dest is replaced rather than written through. This
+  matters when dest is a hard link into the package store.
+
+  Hard links and symlinks that can't be created (for example, across
+  filesystems) fall back to a copy.
+  """
+  if mode == 'hardlink' and exists(dest) and not islink(dest):
+    s = os.stat(src)
+    d = os.stat(dest)
+    if (s.st_dev, s.st_ino) == (d.st_dev, d.st_ino):
+      return
+
+  temp = temporary_name(dest)
+  if os.path.lexists(temp):
+    os.remove(temp)
+
+  if mode == 'hardlink':
+    try:
+      os.link(src, temp)
+    except OSError:
+      copy_file(src, temp)
+  elif mode == 'symlink':
+    try:
+      os.symlink(realpath(src), temp)
+    except OSError:
+      copy_file(src, temp)
+  elif mode == 'reflink':
+    reflink_file(src, temp)
+  elif mode == 'copy':
+    copy_file(src, temp)
+  else:
+    raise Exception("Unknown install mode {0}. Use one of {1}".format(
+      mode, ", ".join(INSTALL_MODES)))
+  os.rename(temp, dest)
+
+
+def install_tree(src, dest, mode = 'copy'):
+  """
+  A replacement for distutils copy_tree that can hard link, reflink
+  or symlink files instead of copying them.
+
+  Every file below src is installed at the same relative path below
+  dest, creating directories as needed. Returns the list of files
+  created in dest.
+  """
+  if not isdir(src):
+    raise Exception("Cannot install {0}: not a directory".format(src))
+
+  outputs = []
+  for root, dirs, filenames in os.walk(src, followlinks = True):
+    target_dir = join(dest, relpath(root, src))
+    if not isdir(target_dir):
+      try:
+        os.makedirs(target_dir)
+      except OSError as e:
+        # Another thread created it first
+        if e.errno != errno.EEXIST:
+          raise
+    for filename in filenames:
+      target = join(target_dir, filename)
+      install_file(join(root, filename), target, mode)
+      outputs.append(target)
+  return outputs
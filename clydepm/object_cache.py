@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+A ccache style cache of compiled object files.
+
+Objects are stored under a content address made from:
+
+  * The preprocessed source. This covers every header the source
+    includes, as well as -I, -D, and -include flags
+  * A fingerprint of the compiler binary
+  * The remaining flags, with paths that don't affect the object removed
+
+Because the key doesn't depend on where a package is checked out,
+objects are shared between branches, workspaces, and packages that
+show up under several roots.
+
+The cache can be used from python via ObjectCache.compile(), or
+as a compiler wrapper from a build.ninja:
+
+  python -m clydepm.object_cache --dir ~/.clyde/objects -- gcc -c foo.c -o foo.o
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from distutils.spawn import find_executable
+from os.path import join, exists, expanduser, splitext
+from subprocess import Popen, PIPE
+
+SOURCE_EXTENSIONS = ['.c', '.cpp', '.cc', '.c++', '.cxx']
+
+# Flags that take the next argument as their value
+FLAGS_WITH_VALUES = ['-o', '-MF', '-MT', '-MQ', '-I', '-D', '-U', '-include',
+                     '-isystem', '-iquote', '-imacros', '-x']
+
+# Flags that only affect preprocessing or dependency generation.
+# They are covered by the preprocessed source, so they are left out
+# of the key. Otherwise two checkouts would never share objects.
+PREPROCESSOR_FLAGS = ['-MF', '-MT', '-MQ', '-I', '-D', '-U', '-include',
+                      '-isystem', '-iquote', '-imacros']
+DEPFILE_FLAGS = ['-MMD', '-MD', '-MP']
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+_compiler_fingerprints = {}
+
+
+def parse_size(size):
+  """
+  Convert a size like 500M or 5G to a number of bytes
+  """
+  size = str(size).strip().upper()
+  if size and size[-1] in SIZE_SUFFIXES:
+    return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+  return int(size)
+
+
+def compiler_fingerprint(compiler):
+  """
+  Identify a compiler binary by its resolved path, size and mtime.
+  This is what ccache does, and avoids running the compiler.
+  """
+  if compiler not in _compiler_fingerprints:
+    path = find_executable(compiler) or compiler
+    path = os.path.realpath(path)
+    try:
+      st = os.stat(path)
+      fingerprint = "{0}:{1}:{2}".format(path, st.st_size, int(st.st_mtime))
+    except OSError:
+      fingerprint = compiler
+    _compiler_fingerprints[compiler] = fingerprint
+  return _compiler_fingerprints[compiler]
+
+
+class CompileCommand(object):
+  """
+  The interesting parts of a single gcc -c invocation
+  """
+
+  def __init__(self, args):
+    self.args = list(args)
+    self.compiler = args[0]
+    self.output = None
+    self.source = None
+    self.depfile = False
+    self.has_target = False
+    self.compile_only = False
+
+    # Flags that change the object file
+    self.key_flags = []
+    # Command line to create the preprocessed source
+    self.preprocess_args = [self.compiler]
+
+    i = 1
+    while i < len(args):
+      arg = args[i]
+      value = None
+      if arg in FLAGS_WITH_VALUES and i + 1 < len(args):
+        value = args[i + 1]
+        i += 1
+      i += 1
+
+      if arg == '-o':
+        self.output = value
+      elif arg == '-c':
+        self.compile_only = True
+      elif value is None and splitext(arg)[1] in SOURCE_EXTENSIONS:
+        self.source = arg
+        self.preprocess_args.append(arg)
+      elif arg in PREPROCESSOR_FLAGS or \
+           any(arg.startswith(f) and len(arg) > len(f) for f in ['-I', '-D', '-U']):
+        if arg in ['-MT', '-MQ']:
+          self.has_target = True
+        self.preprocess_args.append(arg)
+        if value is not None:
+          self.preprocess_args.append(value)
+      elif arg in DEPFILE_FLAGS:
+        self.depfile = True
+        self.preprocess_args.append(arg)
+      else:
+        self.key_flags.append(arg)
+        self.preprocess_args.append(arg)
+        if value is not None:
+          self.key_flags.append(value)
+          self.preprocess_args.append(value)
+
+    self.preprocess_args.append('-E')
+    if '-g' in self.key_flags or any(f.startswith('-g') for f in self.key_flags):
+      # Debug info records source paths, so objects can only be
+      # shared within a directory
+      self.key_flags.append(os.getcwd())
+    else:
+      # Line markers contain absolute paths
+      self.preprocess_args.append('-P')
+    if self.depfile and not self.has_target:
+      # With -E, gcc doesn't know the name of the object file
+      self.preprocess_args += ['-MT', self.output]
+
+  def cacheable(self):
+    return self.compile_only and self.output is not None and \
+           self.source is not None
+
+
+class ObjectCache(object):
+
+  def __init__(self, directory, max_size = '5G'):
+    self.directory = expanduser(directory)
+    self.max_size = parse_size(max_size)
+    self.stats_file = join(self.directory, 'stats.json')
+    self.lock_file = join(self.directory, 'lock')
+    self.lock = threading.Lock()
+    if not exists(self.directory):
+      try:
+        os.makedirs(self.directory)
+      except OSError:
+        # Another compiler process created it first
+        pass
+
+  @staticmethod
+  def from_config(configuration):
+    """
+    Create an ObjectCache from the [General] section of the clyde
+    config, or return None if the cache is disabled
+    """
+    general = configuration['General']
+    if str(general.get('object-cache', 'false')).lower() not in ['true', 'yes', 'on', '1']:
+      return None
+    return ObjectCache(general['object-cache-dir'], general['object-cache-size'])
+
+  def object_path(self, key):
+    return join(self.directory, key[:2], key[2:] + '.o')
+
+  def key(self, command):
+    """
+    Run the preprocessor and hash its output together with
+    the compiler and the flags that affect code generation.
+    Returns None if the source couldn't be preprocessed
+    """
+    preprocessor = Popen(command.preprocess_args, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = preprocessor.communicate()
+    if preprocessor.returncode != 0:
+      return None
+
+    sha = hashlib.sha1()
+    sha.update(compiler_fingerprint(command.compiler).encode('utf-8'))
+    sha.update(b'\0')
+    sha.update("\0".join(command.key_flags).encode('utf-8'))
+    sha.update(b'\0')
+    sha.update(stdout)
+    return sha.hexdigest()
+
+  def compile(self, args):
+    """
+    Compile using the cache. Returns (returncode, stdout, stderr)
+    just like running args would.
+    """
+    command = CompileCommand(args)
+    key = None
+    if command.cacheable():
+      key = self.key(command)
+
+    if key:
+      cached = self.object_path(key)
+      if exists(cached):
+        try:
+          self.copy(cached, command.output)
+          os.utime(cached, None)
+          with open(cached + '.stderr', 'rb') as f:
+            stderr = f.read()
+          self.update_stats(hits = 1)
+          return 0, b'', stderr
+        except (IOError, OSError):
+          # Evicted by another process while we were copying
+          pass
+
+    gcc = Popen(args, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = gcc.communicate()
+
+    if key and gcc.returncode == 0:
+      self.store(key, command.output, stderr)
+    if command.cacheable():
+      self.update_stats(misses = 1)
+    return gcc.returncode, stdout, stderr
+
+  def copy(self, src, dest):
+    """
+    Copy src to dest through a temporary file, so nobody ever
+    sees half of an object file
+    """
+    temp = "{0}.{1}.{2}.tmp".format(dest, os.getpid(), 
+                                    threading.current_thread().ident)
+    shutil.copyfile(src, temp)
+    os.rename(temp, dest)
+
+  def store(self, key, output, stderr):
+    cached = self.object_path(key)
+    directory = os.path.dirname(cached)
+    if not exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        pass
+    with open(cached + '.stderr', 'wb') as f:
+      f.write(stderr)
+    self.copy(output, cached)
+    size = os.stat(cached).st_size
+    stats = self.update_stats(size = size)
+    if stats['size'] > self.max_size:
+      self.trim()
+
+  def read_stats(self):
+    try:
+      with open(self.stats_file) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return {'hits': 0, 'misses': 0, 'size': 0}
+
+  def update_stats(self, hits = 0, misses = 0, size = 0, total_size = None):
+    """
+    Add to the stats. total_size replaces the size instead, once
+    trim has measured it
+    """
+    # The cache is shared by every compiler process ninja starts,
+    # so updates are serialized with a file lock
+    with self.lock:
+      with open(self.lock_file, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        stats = self.read_stats()
+        stats['hits'] += hits
+        stats['misses'] += misses
+        stats['size'] += size
+        if total_size is not None:
+          stats['size'] = total_size
+        temp = "{0}.{1}.tmp".format(self.stats_file, os.getpid())
+        with open(temp, 'w') as f:
+          json.dump(stats, f)
+        os.rename(temp, self.stats_file)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return stats
+
+  def trim(self):
+    """
+    Delete the least recently used objects until the cache
+    is under 90% of its size limit
+    """
+    objects = []
+    total = 0
+    for root, dirs, filenames in os.walk(self.directory):
+      for filename in filenames:
+        if filename.endswith('.o'):
+          path = join(root, filename)
+          st = os.stat(path)
+          objects.append((st.st_mtime, st.st_size, path))
+          total += st.st_size
+
+    objects.sort()
+    target = self.max_size * 0.9
+    for mtime, size, path in objects:
+      if total <= target:
+        break
+      for f in [path, path + '.stderr']:
+        if exists(f):
+          os.remove(f)
+      total -= size
+
+    self.update_stats(total_size = total)
+
+  def clear(self):
+    for name in os.listdir(self.directory):
+      path = join(self.directory, name)
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      else:
+        os.remove(path)
+
+  def print_stats(self):
+    stats = self.read_stats()
+    total = stats['hits'] + stats['misses']
+    if total:
+      rate = 100.0 * stats['hits'] / total
+    else:
+      rate = 0
+    print("Object cache {0}".format(self.directory))
+    print("\tHits       {0}".format(stats['hits']))
+    print("\tMisses     {0}".format(stats['misses']))
+    print("\tHit rate   {0:.1f}%".format(rate))
+    print("\tSize       {0:.1f} MB of {1:.1f} MB".format(stats['size'] / 1024.0 ** 2,
+                                                        self.max_size / 1024.0 ** 2))
+
+  def wrapper_command(self):
+    """
+    Prefix to put in front of a compiler command line to run
+    it through this cache
+    """
+    return "{0} -m clydepm.object_cache --dir {1} --max-size {2} --".format(
+      sys.executable, self.directory, self.max_size)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dir',
+                      default = join(expanduser('~'), '.clyde', 'objects'),
+                      help = 'Cache directory')
+  parser.add_argument('--max-size',
+                      default = '5G',
+                      help = 'Size limit of the cache e.g. 500M or 5G')
+  parser.add_argument('--stats',
+                      action = 'store_true',
+                      default = False,
+                      help = 'Print cache statistics')
+  parser.add_argument('--clear',
+                      action = 'store_true',
+                      default = False,
+                      help = 'Delete everything in the cache')
+  parser.add_argument('command',
+                      nargs = argparse.REMAINDER,
+                      help = 'Compiler command line')
+  namespace = parser.parse_args()
+
+  cache = ObjectCache(namespace.dir, namespace.max_size)
+  command = namespace.command
+  if command and command[0] == '--':
+    command = command[1:]
+
+  if namespace.clear:
+    cache.clear()
+  if namespace.stats:
+    cache.print_stats()
+  if not command:
+    return 0
+
+  returncode, stdout, stderr = cache.compile(command)
+  getattr(sys.stdout, 'buffer', sys.stdout).write(stdout)
+  getattr(sys.stderr, 'buffer', sys.stderr).write(stderr)
+  return returncode
+
+
+if __name__ == '__main__':
+  sys.exit(main())
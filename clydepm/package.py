@@ -1,16 +1,22 @@
 #!/usr/bin/env python
 import sys, os
 from subprocess import Popen, PIPE
+from multiprocessing.pool import ThreadPool
+import threading
 import json
 
 from os.path import splitext, join, realpath
 import shutil
 import yaml
-from distutils.dir_util import copy_tree
-import distutils
 from termcolor import colored
 
-from .common import temp_cwd, dict_contains, stable_sha 
+from .common import dict_contains, default_jobs
+from .hashing import name_hash
+from .incremental import needs_rebuild, record_command, forget_command
+from .fingerprint import StatCache, fingerprint
+from .install import install_tree, persistent_mode, source_mode
+from .compilation_database import FILENAME, compile_command, write_compilation_database
+from . import tracing
 
 from unidecode import unidecode
 
@@ -48,9 +54,7 @@ class EmptyPackage(object):
       self.version = version
 
   def __hash__(self):
-      h = int(stable_sha({'name': self.name, 
-                         }), 16)
-      return h
+      return name_hash(self.name)
   def __repr__(self):
     return "{0}-{1}".format(self.name, self.version)
 
@@ -102,7 +106,8 @@ class Package(object):
                path, 
                form = 'binary', 
                traits = None, 
-               root_package = None):
+               root_package = None,
+               install_mode = 'copy'):
 
     self.config = None
     # TODO: Clean up multiple types of config files
@@ -150,6 +155,10 @@ class Package(object):
 
     self.form = form
 
+    # How files are copied into output, archive and dependency 
+    # directories. See clydepm.install
+    self.install_mode = install_mode
+
     self.output_dirs = {}
 
     self.evaluate_config_sugar()
@@ -174,6 +183,25 @@ class Package(object):
   def get_binary(self):
     return self.binary
 
+  def links_binary(self):
+    """
+    Applications, and the test variant of anything, are linked
+    into an executable. Everything else becomes a library
+    """
+    return (self.config['type'] == 'application' or
+            self.traits.get('variant') == 'test')
+
+  def get_artifact(self):
+    """
+    The file build produces. Foreign packages only promise
+    an output directory
+    """
+    if self.config['type'] == 'foreign':
+      return self.output_dir
+    if self.links_binary():
+      return self.binary
+    return self.library
+
   def get_configuration(self):
     return self.config
   
@@ -260,13 +288,27 @@ class Package(object):
     self.filtered_variants = [a for a in self.get_variants() if list(a.keys())[0] in enabled_variants]
     return self.filtered_variants
 
-  def get_hash(self, method = 'timestamp'):
+  def get_hash(self, method = 'content'):
     """
     Returns a hash of the packages sources.
-    The sha is based on the last modified timestamp of 
-    every file in all variant directories, include, and private_include
+    The sha is based on the contents of every file in all 
+    enabled variant directories, include, private_include 
+    and the package configuration.
+
+    File digests are cached in build/stat-cache.json, keyed on 
+    their size, mtime and inode, so only files that changed since 
+    the last call are read. With method = 'timestamp', only the 
+    size and last modified timestamp of each file are used.
     """
-    return "asdf"
+    self.resolve_variants()
+    directories = list(self.variant_dirs.values()) + [self.include, 
+                                                       self.private_include]
+    directories += [join(self.path, 'config.yaml'), 
+                    join(self.path, 'descriptor.yaml')]
+    directories = sorted(realpath(d) for d in directories if os.path.exists(d))
+
+    cache = StatCache(join(self.build_dir, 'stat-cache.json'))
+    return fingerprint(directories, realpath(self.path), cache, method)
 
 
   def get_variants(self):
@@ -275,6 +317,13 @@ class Package(object):
     else:
       return []
 
+  def compilation_database(self):
+    """
+    The compile_commands.json of this package's sources, written
+    by compile
+    """
+    return join(self.build_dir, FILENAME)
+
   def create_build_directories(self):
     if not os.path.exists(self.build_dir):
       os.mkdir(self.build_dir)
@@ -383,31 +432,34 @@ class Package(object):
     return cflags
 
 
-  def copy_artifacts(self, dest, headers_only = False):
+  def copy_artifacts(self, dest, headers_only = False, mode = None):
     src = realpath(join(self.output_dir))
-    # Scary magic that occurs because shutil
-    # has a cache of directories that where created,
-    # so it doesn't recreate the directory structure
-    # See:
-    # http://stackoverflow.com/questions/9160227/dir-util-copy-tree-fails-after-shutil-rmtree
+    if mode is None:
+      mode = self.install_mode
 
     def filter_not_headers(f, g):
       return ['lib', 'bin']
 
-    distutils.dir_util._path_created = {}
-    if headers_only:
-      src = self.output_dir
-      dest = dest
-      copy_tree(src, dest)
-    else:
-      copy_tree(src, dest)
+    # Nothing has been built or unpacked yet
+    if not os.path.isdir(src):
+      return
+
+    with tracing.span('install', self.name, {'dest' : dest, 'mode' : mode}):
+      if headers_only:
+        src = self.output_dir
+        dest = dest
+        install_tree(src, dest, mode)
+      else:
+        install_tree(src, dest, mode)
 
 
 
   def copy_headers(self):
     #headers = [realpath(join(self.include, f)) for f in os.listdir(self.include) if f.endswith('.h')]
 
-    copy_tree(self.include, self.output_dirs['include'])
+    with tracing.span('install', self.name + ' headers'):
+      install_tree(self.include, self.output_dirs['include'], 
+                   source_mode(self.install_mode))
     #for header in headers:
     #  dest = join(self.output_dirs['include'])
     #  shutil.copy2(header, dest)
@@ -449,31 +501,33 @@ class Package(object):
 
     
   def foreign_build(self):
-    build_script = join(self.path, 'build.sh')
+    build_script = realpath(join(self.path, 'build.sh'))
     log = join(self.path, 'build_output.txt')
-    with temp_cwd(self.path):
-      if os.path.exists(build_script):
-        print("Running build.sh")
-        os.environ['CFLAGS']  + self.traits['cflags']
-        print('CFLAGS', self.traits['cflags'])
-        os.environ['VERSION'] = self.config['version']
-        del os.environ['CC']
-
-        print("VERSION=", self.config['version'])
-        args = [build_script]
-        bash = Popen(args, stdout=PIPE, stderr=PIPE)
+    if os.path.exists(build_script):
+      print("Running build.sh")
+      # Other packages may be building on other threads, so build.sh
+      # gets its own environment and working directory rather than
+      # changing ours. It picks its own compiler
+      env = dict(os.environ)
+      env.pop('CC', None)
+      env['CFLAGS'] = self.traits['cflags']
+      env['VERSION'] = self.config['version']
+      print('CFLAGS', self.traits['cflags'])
+      print("VERSION=", self.config['version'])
+
+      args = [build_script]
+      with tracing.span('build', self.name + ' build.sh'):
+        bash = Popen(args, stdout=PIPE, stderr=PIPE, cwd=self.path, env=env)
         stdout, stderr = bash.communicate()
-        del os.environ['CFLAGS']
-        del os.environ['VERSION']
 
-        with open(log, 'w') as f:
-          print("Writing to {0}".format(log))
-          f.write(stdout)
+      with open(log, 'w') as f:
+        print("Writing to {0}".format(log))
+        f.write(stdout)
 
-        if bash.returncode !=0:
-          raise Exception("Compilation failed. See {0} for details.".format(log))
-      pass
+      if bash.returncode !=0:
+        raise Exception("Compilation failed. See {0} for details.".format(log))
 
+  @tracing.traced('archive')
   def create_archive(self, descriptor):
     archive_dir = self.get_archive_dir()
     if os.path.exists(archive_dir):
@@ -483,16 +537,19 @@ class Package(object):
     archive_output_dir = join(archive_dir, os.path.split(self.get_output_dir())[1])
     os.mkdir(archive_output_dir)
     # Copy build artifacts
-    self.copy_artifacts(archive_output_dir)
+    self.copy_artifacts(archive_output_dir, 
+                        mode = persistent_mode(self.install_mode))
     with open(join(archive_dir, 'descriptor.yaml'), 'w') as f:
       yaml.dump(descriptor, f)
 
-  def build(self, extra_flags = ''):
+  def build(self, extra_flags = '', jobs = None, incremental = False,
+            object_cache = None, job_slots = None):
 
     # Copy headers first, so we can add 
     # output/.../include
     # To allow a package to include it's own header files
     # within header files
+    self.create_build_directories()
     self.copy_headers()
     self.update_traits(extra_flags)
     if 'type' in self.config and self.config['type'] == 'foreign':
@@ -500,14 +557,39 @@ class Package(object):
       return self.foreign_build()
 
     try:
-      self.compile(extra_flags)
+      self.compile(extra_flags, jobs, incremental, object_cache, job_slots)
     except CompilationError as e:
       #print (str(e))
       raise e
     self.form = 'binary'
 
 
-  def compile(self, extra_flags):
+  def compile(self, extra_flags, jobs = None, incremental = False,
+              object_cache = None, job_slots = None):
+    """
+    Compile every source file in the enabled variants, and then
+    link them into a library or binary.
+
+    Translation units are compiled concurrently by a pool of 
+    jobs workers (defaults to the number of CPUs). The output of
+    each compiler invocation is printed in one piece once it finishes.
+    If any file fails to compile, no new compilations are started,
+    and a CompilationError is raised before linking.
+
+    In incremental mode, gcc writes a .d file next to each object.
+    Objects whose source, headers and command line are unchanged 
+    are not recompiled, and the final link is skipped if none of 
+    its inputs changed.
+
+    If an ObjectCache is passed, objects are fetched from the cache
+    instead of compiling them whenever possible.
+
+    job_slots is a semaphore shared by packages being built at the 
+    same time. Every compiler or linker process holds a slot while 
+    it runs.
+    """
+    if job_slots is None:
+      job_slots = threading.BoundedSemaphore(jobs or default_jobs())
 
     source_names = []
     object_names = []
@@ -523,7 +605,7 @@ class Package(object):
       # List out sources without full paths so we can create a list of object files
       # separately
       try:
-        new_source_names = [f for f in os.listdir(variant_dir) if f.endswith('.c') or f.endswith('.cpp')]
+        new_source_names = sorted(f for f in os.listdir(variant_dir) if f.endswith('.c') or f.endswith('.cpp'))
       except OSError:
         print (colored("Directory for variant {0} does not exist".format(variant_name), 'red'))
         new_source_names = []
@@ -553,6 +635,8 @@ class Package(object):
     # then the final links must be performed by g++, not gcc
     
     final_compiler = 'gcc'
+    compile_jobs = []
+    commands = []
     for source, object in stuff:
       if source.endswith('.c'):
         compiler = 'gcc'
@@ -564,45 +648,108 @@ class Package(object):
         args = [compiler_prefix + compiler] + ['-c', '-o', object] + [source] + cflags
       elif self.config['type'] == 'application':
         args = [compiler_prefix + compiler] + ['-c', '-o', object] + [source] + cflags
-      
-      print("Compiling {0}".format(os.path.split(source)[1]))
-      print((colored(" ".join(args), 'yellow')))
-      gcc = Popen(args, stdout=PIPE, stderr=PIPE)
-      stdout, stderr = gcc.communicate()
-      print(stdout)
 
-      if gcc.returncode != 0:
-          raise CompilationError(stderr = stderr)
+      commands.append(compile_command(os.getcwd(), source, object, args))
+      if incremental:
+        args += ['-MMD', '-MF', object + '.d']
+        if not needs_rebuild(object, args, depfile = object + '.d'):
+          continue
+        forget_command(object)
+      compile_jobs.append((source, args))
+
+    if incremental:
+      print("{0} of {1} files need to be compiled".format(len(compile_jobs),
+                                                          len(stuff)))
+
+    # Every file, including the ones that are up to date. PackageBuilder
+    # merges these into one database for the whole tree
+    self.create_build_directories()
+    write_compilation_database(self.compilation_database(), commands)
+
+    failed = threading.Event()
+
+    def compile_source(job):
+      source, args = job
+      # Don't start new work once something has failed
+      if failed.is_set():
+        return source, args, None, None, None
+      with job_slots, tracing.span('compile', os.path.split(source)[1]):
+        if object_cache:
+          returncode, stdout, stderr = object_cache.compile(args)
+        else:
+          gcc = Popen(args, stdout=PIPE, stderr=PIPE)
+          stdout, stderr = gcc.communicate()
+          returncode = gcc.returncode
+      if returncode != 0:
+        failed.set()
+      elif incremental:
+        record_command(args[args.index('-o') + 1], args)
+      return source, args, returncode, stdout, stderr
+
+    error = None
+    pool = ThreadPool(max(1, min(jobs or default_jobs(), len(compile_jobs))))
+    try:
+      for source, args, returncode, stdout, stderr in \
+          pool.imap_unordered(compile_source, compile_jobs):
+        if returncode is None:
+          continue
+        print("Compiling {0}".format(os.path.split(source)[1]))
+        print((colored(" ".join(args), 'yellow')))
+        if stdout:
+          print(stdout)
+
+        if returncode != 0:
+          if error is None:
+            error = CompilationError(stderr = stderr)
+        elif stderr:
+          # Warnings
+          print(stderr)
+    finally:
+      pool.close()
+      pool.join()
+
+    if error:
+      raise error
 
-    
     libraries = self.get_static_libraries()
-    if self.config['type'] == 'application' or ('variant' in self. traits and
-                                                self.traits['variant'] ==
-                                                'test'):
-
+    if self.links_binary():
 
       args = [compiler_prefix + final_compiler] +  ['-o', self.binary] + objects + libraries + cflags
 
+      if incremental and not needs_rebuild(self.binary, args, objects + libraries):
+        print("{0} is up to date".format(os.path.split(self.binary)[1]))
+        return
+
       print(colored(" ".join(args), 'yellow'))
-      gcc = Popen(args, stdout=PIPE, stderr=PIPE)
-      stdout, stderr = gcc.communicate()
+      with job_slots, tracing.span('link', os.path.split(self.binary)[1]):
+        gcc = Popen(args, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = gcc.communicate()
 
       print(stdout)
 
       if gcc.returncode != 0:
           raise CompilationError(stderr = stderr)
+      if incremental:
+        record_command(self.binary, args)
 
     elif self.config['type'] == 'library':
       print((colored("Linking {0}".format(os.path.split(self.library)[1]),"red")))
       args = [compiler_prefix + 'ld', '-r','-o', self.library] + objects + libraries
 
+      if incremental and not needs_rebuild(self.library, args, objects + libraries):
+        print("{0} is up to date".format(os.path.split(self.library)[1]))
+        return
+
       print((colored(" ".join(args), 'yellow')))
-      ar = Popen(args, stdout=PIPE, stderr=PIPE)
-      stdout, stderr = ar.communicate()
+      with job_slots, tracing.span('link', os.path.split(self.library)[1]):
+        ar = Popen(args, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = ar.communicate()
       print(stdout)
 
       if ar.returncode != 0:
         raise CompilationError(stderr = stderr)
+      if incremental:
+        record_command(self.library, args)
 
     else:
       raise Exception("Clyde doesn't know how to build type: {0}".format(self.config['type']))
@@ -612,9 +759,7 @@ class Package(object):
     return "Package('{0}')".format(self.path)
 
   def __hash__(self):
-      h = int(stable_sha({'name': self.name, 
-                         }), 16)
-      return h
+      return name_hash(self.name)
 
   def __eq__(self, other):
     return hash(self) == hash(other)
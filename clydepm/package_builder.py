@@ -5,12 +5,22 @@ import hashlib
 import shutil
 import yaml
 from os.path import splitext, join, realpath
-from .common import stable_sha, list_contains
+from .common import stable_sha, list_contains, default_jobs, write_if_changed
+from .hashing import FrozenDescriptor
 from .git_package_server import LocalGitPackageServer, LocalForeignPackagerServer
-import tarfile
-from distutils.dir_util import copy_tree
+from .git_clone import CloneStrategy
+from .http_package_server import HttpPackageServer
+from .compilation_database import (FILENAME, read_compilation_database,
+                                   write_compilation_database)
+from .object_cache import ObjectCache
+from .install import install_tree, persistent_mode, INSTALL_MODES
+from .archive import split_tarball_name, extract_tarball
+from .catalog import PackageCatalog
+from . import tracing
+import threading
 import pprint
 from graphviz import Digraph
+from termcolor import colored
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -53,7 +63,8 @@ class PackageBuilder(object):
 
 
   """
-  def __init__(self, configuration):
+  def __init__(self, configuration, jobs = None, incremental = False,
+               parallel_deps = False):
     self.u = Digraph('unix', filename='build.gv')
     self.counter = 1
     self.u.body.append('size="6,6"')
@@ -62,44 +73,111 @@ class PackageBuilder(object):
 
     self.root_package = None
 
-    self.build_trace = []
+    # Each thread has its own chain of packages it's retrieving.
+    # See build_trace
+    self.trace = threading.local()
     package_root = configuration['General']['package-root']
     git_root     = configuration['General']['git-root']
 
     self.configuration = configuration
 
+    # Number of translation units compiled in parallel
+    if jobs is None:
+      self.jobs = default_jobs()
+    else:
+      self.jobs = jobs
+
+    # Skip compiling and linking outputs that are up to date
+    self.incremental = incremental
+
+    # Shared cache of compiled objects, or None
+    self.object_cache = ObjectCache.from_config(configuration)
+
+    # How artifacts are copied around. See clydepm.install
+    self.install_mode = configuration['General'].get('install-mode', 'copy')
+    if self.install_mode not in INSTALL_MODES:
+      raise Exception("Unknown install-mode {0}. Use one of {1}".format(
+        self.install_mode, ", ".join(INSTALL_MODES)))
+
+    # When parallel_deps is set, dependencies that don't depend on
+    # each other are retrieved and built at the same time. The number
+    # of compiler processes is still limited to jobs across every
+    # package being built.
+    self.parallel_deps = parallel_deps
+    self.job_slots = threading.BoundedSemaphore(self.jobs)
+
+    # Protects the dependency graph, the root package's dependency
+    # directory and the local cache
+    self.lock = threading.RLock()
+    # Package servers change directories, so only one can run at a time
+    self.server_lock = threading.Lock()
+    # Packages being retrieved by some thread, by descriptor sha
+    self.pending = {}
+
     if package_root is None:
       self.root_directory = realpath(os.getcwd())
     else:
       self.root_directory = realpath(package_root)
 
+    # Compression used for package tarballs. See clydepm.archive
+    codec = configuration['General'].get('archive-codec', 'gz')
+
+    # How package repositories are cloned. See clydepm.git_clone
+    clone_strategy = CloneStrategy.from_config(configuration)
+
     if git_root is None:
-      self.local_git = LocalGitPackageServer(join(self.root_directory, 'git-server'))
+      self.local_git = LocalGitPackageServer(join(self.root_directory, 'git-server'),
+                                             codec, clone_strategy)
     else:
-      self.local_git = LocalGitPackageServer(git_root)
+      self.local_git = LocalGitPackageServer(git_root, codec, clone_strategy)
 
     self.all_deps = set()
+    # Packages built from source during this run, in the order
+    # they were reached
+    self.source_packages = []
 
 
     self.package_servers = [self.local_git]
 
+    # Binaries built somewhere else, e.g. by CI, or None.
+    # See clydepm.http_package_server
+    self.remote_cache = HttpPackageServer.from_config(
+      configuration, join(self.root_directory, 'http-server'), codec)
+    if self.remote_cache:
+      self.package_servers.insert(0, self.remote_cache)
+
     self.package_directory = join(self.root_directory, '.packages')
 
     if not os.path.exists(self.package_directory):
       os.makedirs(self.package_directory)
 
+    # Index of what is in package_directory. See clydepm.catalog
+    self.catalog = PackageCatalog(join(self.root_directory, 'catalog.db'),
+                                  self.package_directory)
+
   def store_tarball(self, tarball_path):
     """
-    Extract and store a tarball in local cache
+    Extract and store a tarball in local cache. Everything in it
+    has to be inside a directory named after its sha. Returns
+    False, and deletes the tarball, if it isn't a usable package
     """
-
-    if tarball_path.endswith('.tar.gz'):
-      sha = os.path.split(tarball_path.replace('.tar.gz', ''))[1]
-      path = join(self.package_directory, sha) 
-      with tarfile.open(tarball_path) as tar:
-        tar.extractall(self.package_directory)
-    else:
-      raise Exception("store_tarball not passed .tar.gz file")
+    sha, codec = split_tarball_name(tarball_path)
+    path = join(self.package_directory, sha) 
+    try:
+      with tracing.span('unpack', os.path.split(tarball_path)[1]):
+        extract_tarball(tarball_path, self.package_directory, base = sha)
+      if not os.path.isdir(path):
+        raise Exception("{0} doesn't contain {1}/".format(tarball_path, sha))
+    except Exception as e:
+      print(colored("Not using {0}: {1}".format(tarball_path, e), 'yellow'))
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      for f in [tarball_path, tarball_path + '.etag']:
+        if os.path.exists(f):
+          os.remove(f)
+      return False
+    self.catalog.add(sha, path)
+    return True
 
   def flush(self):
     print ("Deleting local cache first")
@@ -107,18 +185,34 @@ class PackageBuilder(object):
    
     if os.path.exists(self.package_directory):
         shutil.rmtree(self.package_directory)
+    self.catalog.clear()
     
     print ("Deleting all upstream caches")
     for server in self.package_servers:
         server.flush()
     
+  @property
+  def build_trace(self):
+    """
+    Names of the packages the current thread is retrieving, from the
+    root package down. When retrieving fails, it ends with the
+    package that failed, even if that happened on another thread
+    """
+    if not hasattr(self.trace, 'packages'):
+      self.trace.packages = []
+    return self.trace.packages
+
+  @build_trace.setter
+  def build_trace(self, packages):
+    self.trace.packages = list(packages)
+
   def create_new_package(self, new_package_directory, package_type):
 
     Package.create_new_package(new_package_directory, 
                                package_type,
                                self.configuration)
   
-  def store_package(self, package, descriptor):
+  def stored_package_path(self, descriptor):
     descriptor_for_hashing = descriptor.copy()
   
     #TODO
@@ -126,18 +220,50 @@ class PackageBuilder(object):
     # When you build a package, you don't want to have to 
     # enumerate it's dependencies, but you want to know what 
     # they are when linking to abvoid multiple definitions
-    if 'dependencies' in descriptor_for_hashing:
-      del descriptor_for_hashing['dependencies']
-    path  = join(self.package_directory, stable_sha(descriptor_for_hashing))
+    #
+    # The fingerprint is left out for the same reason. It records
+    # what the package was built from, not what was requested
+    for key in ['dependencies', 'fingerprint']:
+      if key in descriptor_for_hashing:
+        del descriptor_for_hashing[key]
+    return join(self.package_directory, stable_sha(descriptor_for_hashing))
+
+  def store_package(self, package, descriptor, path = None):
+    if path is None:
+      path = self.stored_package_path(descriptor)
 
     if os.path.exists(path):
       print ("Overwriting existing package!")
 
     # Copy from archive_dir to path
     #print "Copying {0} -> {1}".format(package.get_archive_dir(), path)
-    copy_tree(package.get_archive_dir(), path)
+    with tracing.span('store', package.name):
+      install_tree(package.get_archive_dir(), path, 
+                   persistent_mode(self.install_mode))
+    self.catalog.add(os.path.split(path)[1], path, descriptor)
+
+
 
+  def fetch_tarball(self, server, descriptor):
+    """
+    Ask server for the tarball of descriptor. Servers that aren't
+    thread_safe are only asked by one thread at a time
+    """
+    if getattr(server, 'thread_safe', False):
+      return server.get_package_tarball_by_descriptor(descriptor)
+    with self.server_lock:
+      return server.get_package_tarball_by_descriptor(descriptor)
 
+  def publish(self, path, name):
+    """
+    Upload the package stored at path that was just built to the
+    servers that take uploads, so other machines don't have to
+    build it
+    """
+    for server in self.package_servers:
+      if getattr(server, 'upload', False):
+        with tracing.span('upload', name):
+          server.put_package(path)
 
   def get_package_by_descriptor(self, descriptor, clean = False):
     """
@@ -149,54 +275,66 @@ class PackageBuilder(object):
 
     """
     self.build_trace.append(descriptor['name'])
-    
-    hash = stable_sha(descriptor)
+
+    # Dependencies arrive frozen, with their sha already worked out.
+    # This copy gets modified as the package is retrieved
+    if not isinstance(descriptor, FrozenDescriptor):
+      descriptor = FrozenDescriptor(descriptor)
+    hash = descriptor.sha
+    frozen, descriptor = descriptor, descriptor.thaw()
     all_dependencies = []
     # packages are stored in root/.packages/
 
 
-    package_paths = [d for d in os.listdir(self.package_directory)]
     name = descriptor['name']
 
     if descriptor['version'] == 'local':
       pass
 
-    elif hash not in package_paths:
-      hash = stable_sha(descriptor)  
-      if hash not in package_paths:
+    elif self.catalog.lookup(hash) is None:
+      # No binary. Look for the sources before asking the servers
+      source = FrozenDescriptor(dict(descriptor, form = 'source'))
+      source_hash = source.sha
+      if self.catalog.lookup(source_hash) is None:
         for server in self.package_servers:
-          package_tarball_path = server.get_package_tarball_by_descriptor(descriptor)
+          with tracing.span('fetch', name):
+            package_tarball_path = self.fetch_tarball(server, frozen)
+          if package_tarball_path and not self.store_tarball(package_tarball_path):
+            package_tarball_path = None
           if package_tarball_path:
-              self.store_tarball(package_tarball_path)
               break
         if package_tarball_path is None:
           for server in self.package_servers:
             descriptor['form'] = 'source'
-            package_tarball_path = server.get_package_tarball_by_descriptor(descriptor)
+            hash = source_hash
+            with tracing.span('fetch', name + ' source'):
+              package_tarball_path = self.fetch_tarball(server, source)
+            if package_tarball_path and not self.store_tarball(package_tarball_path):
+              package_tarball_path = None
             if package_tarball_path:
-                self.store_tarball(package_tarball_path)
                 break
           if package_tarball_path is None:
             raise Exception("Failed to find package {0} anywhere".format(name))
       else:
         print(("Found {0} sources locally".format(name + '-' +
                                                  descriptor['version'])))
+        descriptor['form'] = 'source'
+        hash = source_hash
 
     else:
       pass
 
-    # If the binary package didn't exist, the descriptor might be changed.
-    # Rebuild the sha
+    # If the binary package didn't exist, the descriptor was changed
+    # to the source form, and hash along with it
 
     if descriptor['version'] == 'local':
       package_path = descriptor['local-path']
       descriptor['form'] = 'source'
     else:
-      hash = stable_sha(descriptor)  
       package_path = join(self.package_directory, hash)
 
     package = Package(package_path, descriptor['form'], descriptor['traits'],
-                      self.root_package)
+                      self.root_package, self.install_mode)
 
     if self.root_package is None:
       self.root_package = package
@@ -208,49 +346,79 @@ class PackageBuilder(object):
       form = descriptor['form']
         
       if form == 'source':
+        with self.lock:
+          self.source_packages.append(package)
         # Make a copy of the parent descriptor
         parent_descriptor = descriptor.copy()
         dependencies = self.get_package_dependencies(package, parent_descriptor) 
-        for d in dependencies:
-          if not self.dep_satisfied(d):
-            self.u.edge(str(package), str(d), label = str(self.counter))
-            self.counter += 1
-            d.copy_artifacts(self.root_package.get_dependency_dir(), False)
-            self.all_deps.add(d)
-          else:
-            package.ignore_dependency_by_name(d.name)
-            pass
-            #e = self.u.edge(str(package), str(d), color="orange", label =
-            #               str(self.counter))
-            #self.counter +=1
-            #print ("Already have {0}. Copying headers only".format(d.name))
-            #d.copy_artifacts(package.get_dependency_dir(), True)
+        with self.lock:
+          for d in dependencies:
+            if not self.dep_satisfied(d):
+              self.u.edge(str(package), str(d), label = str(self.counter))
+              self.counter += 1
+              d.copy_artifacts(self.root_package.get_dependency_dir(), False)
+              self.all_deps.add(d)
+            else:
+              package.ignore_dependency_by_name(d.name)
+              pass
+              #e = self.u.edge(str(package), str(d), color="orange", label =
+              #               str(self.counter))
+              #self.counter +=1
+              #print ("Already have {0}. Copying headers only".format(d.name))
+              #d.copy_artifacts(package.get_dependency_dir(), True)
         
+        package.fingerprint = self.package_fingerprint(package, dependencies)
+        # Where it goes once it's built
+        path = self.stored_package_path(dict(descriptor, form = 'binary'))
+        if self.is_up_to_date(package, path):
+          print(("{0}-{1} is up to date".format(package.config['name'],
+                                                package.config['version'])))
+          with self.lock:
+            package.copy_artifacts(self.root_package.get_dependency_dir(), True)
+          package.form = 'binary'
+          self.build_trace.pop()
+          return package
+
         print(("Building {0}-{1}".format(package.config['name'],
                                        package.config['version'])))
-        package.copy_artifacts(self.root_package.get_dependency_dir(), True)
-        package.build()
+        with self.lock:
+          package.copy_artifacts(self.root_package.get_dependency_dir(), True)
+        with tracing.span('build', package.name):
+          package.build(jobs = self.jobs, 
+                        incremental = self.incremental,
+                        object_cache = self.object_cache,
+                        job_slots = self.job_slots)
+        # Every variant builds into the same output directory. Remember
+        # which one is sitting there now
+        write_if_changed(self.fingerprint_stamp(package), package.fingerprint)
         descriptor['form'] = package.get_form()
         descriptor['dependencies'] = package.get_dependency_configurations()
+        descriptor['fingerprint'] = package.fingerprint
         package.create_archive(descriptor)
-        self.store_package(package, descriptor)
+        with self.lock:
+          self.store_package(package, descriptor, path)
+        if descriptor['version'] != 'local':
+          self.publish(path, name)
 
       elif form =='binary':
         print(("Package {0}-{1} already built".format(descriptor['name'],
                                                       descriptor['version'])))
 
-        package.copy_artifacts(self.root_package.get_dependency_dir(), True)
+        package.fingerprint = package.config.get('fingerprint',
+                                                 os.path.split(package_path)[1])
 
-        if 'dependencies' in package.config:
-          for name, options in package.config['dependencies'].items():
-            d = EmptyPackage(name, options['version'])
-            if not self.dep_satisfied(d):
-              self.all_deps.add(d)
-              e = self.u.edge(str(package), str(d), color="red", label =
-                              str(self.counter))
-              self.counter += 1
-            else:
-              e = self.u.edge(str(package), str(d), color="orange", label = str(self.counter))
+        with self.lock:
+          package.copy_artifacts(self.root_package.get_dependency_dir(), True)
+          if 'dependencies' in package.config:
+            for name, options in package.config['dependencies'].items():
+              d = EmptyPackage(name, options['version'])
+              if not self.dep_satisfied(d):
+                self.all_deps.add(d)
+                e = self.u.edge(str(package), str(d), color="red", label =
+                                str(self.counter))
+                self.counter += 1
+              else:
+                e = self.u.edge(str(package), str(d), color="orange", label = str(self.counter))
 
 
       self.build_trace.pop()
@@ -259,6 +427,61 @@ class PackageBuilder(object):
     else:
       print ("Failed to retrieve package")
 
+  def write_compilation_database(self):
+    """
+    Merge the compile_commands.json of every package built from
+    source into one next to the root package, so editors and
+    analysis tools see the flags of the whole dependency tree
+    """
+    if self.root_package is None:
+      return
+    entries = []
+    for package in self.source_packages:
+      entries.extend(read_compilation_database(package.compilation_database()))
+    if write_compilation_database(join(self.root_package.path, FILENAME), entries):
+      print("Wrote {0}".format(FILENAME))
+
+  def package_fingerprint(self, package, dependencies):
+    """
+    Fingerprint of everything that goes into building a package:
+    its own sources, the traits it's built with (variant, cflags...),
+    and the fingerprints of its dependencies
+    """
+    fingerprints = {'sources' : package.get_hash(),
+                    'traits' : package.get_traits()}
+    for d in dependencies:
+      if d is not None and hasattr(d, 'fingerprint'):
+        fingerprints[d.name] = d.fingerprint
+    return stable_sha(fingerprints)
+
+  def fingerprint_stamp(self, package):
+    """
+    Records the fingerprint of whatever was last built into
+    the package's output directory
+    """
+    return join(package.build_dir, 'fingerprint')
+
+  def is_up_to_date(self, package, path):
+    """
+    A package doesn't need to be rebuilt or re-archived if the
+    copy stored at path was built from the same fingerprint,
+    and the outputs in the package directory came from that same
+    build. Other variants write to the same place
+    """
+    package.create_build_directories()
+    stored_descriptor = join(path, 'descriptor.yaml')
+    stamp = self.fingerprint_stamp(package)
+    if not os.path.exists(stored_descriptor) or \
+       not os.path.exists(stamp) or \
+       not os.path.exists(package.get_artifact()):
+      return False
+    with open(stamp) as f:
+      if f.read() != package.fingerprint:
+        return False
+    with open(stored_descriptor) as f:
+      stored = yaml.load(f)
+    return stored.get('fingerprint') == package.fingerprint
+
   def get_package_dependencies(self, package, parent_descriptor):
     """
     Look through dependencies, and construct package 
@@ -268,15 +491,92 @@ class PackageBuilder(object):
     """
     packages = []
     parent_descriptor['requires'] = package.get_dependency_configurations()
-    for dep_name, dep_config in package.get_dependency_configurations().items():
-      
-      descriptor = self.make_package_descriptor(package, parent_descriptor,
-                                                dep_name)
+    descriptors = []
+    with tracing.span('resolve', package.name):
+      for dep_name, dep_config in package.get_dependency_configurations().items():
+        descriptors.append(self.make_package_descriptor(package, parent_descriptor,
+                                                        dep_name))
+
+    # Download the binaries that aren't stored here all at once
+    missing = [d for d in descriptors if self.catalog.lookup(d.sha) is None]
+    for server in self.package_servers:
+      if hasattr(server, 'prefetch') and missing:
+        server.prefetch(missing)
 
-      package = self.get_package_by_descriptor(descriptor)
-      packages.append(package)
+    if self.parallel_deps and len(descriptors) > 1:
+      return self.get_packages_in_parallel(descriptors)
+
+    for descriptor in descriptors:
+      if self.parallel_deps:
+        packages.append(self.get_package_once(descriptor))
+      else:
+        packages.append(self.get_package_by_descriptor(descriptor))
     return packages
 
+  def get_packages_in_parallel(self, descriptors):
+    """
+    Retrieve each descriptor on its own thread, and return the
+    packages in the same order as descriptors.
+
+    Threads spend most of their time waiting for their own
+    dependencies or for a compile slot, so there is no limit on 
+    the number of threads. self.job_slots limits the actual work.
+    """
+    results = [None] * len(descriptors)
+    errors = []
+    trace = self.build_trace
+
+    def retrieve(index, descriptor):
+      # Carry on from the package that depends on this one
+      self.build_trace = trace
+      try:
+        results[index] = self.get_package_once(descriptor)
+      except Exception as e:
+        errors.append((e, self.build_trace))
+
+    threads = [threading.Thread(target = retrieve, args = (i, d)) 
+               for i, d in enumerate(descriptors)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    if errors:
+      error, self.build_trace = errors[0]
+      raise error
+    return results
+
+  def get_package_once(self, descriptor):
+    """
+    get_package_by_descriptor, for use from several threads at once.
+
+    When two packages depend on the same package, the first thread
+    to ask for it retrieves it, and the other waits for the result
+    instead of building it a second time.
+    """
+    key = descriptor.sha
+    with self.lock:
+      owner = key not in self.pending
+      if owner:
+        self.pending[key] = (threading.Event(), {})
+      done, result = self.pending[key]
+
+    if owner:
+      try:
+        result['package'] = self.get_package_by_descriptor(descriptor)
+      except Exception as e:
+        result['error'] = e
+        result['trace'] = list(self.build_trace)
+      finally:
+        done.set()
+    else:
+      done.wait()
+
+    if 'error' in result:
+      self.build_trace = result['trace']
+      raise result['error']
+    return result['package']
+
   def make_package_descriptor(self, package, parent_descriptor, dep_name):
 
     traits = package.get_traits()
@@ -300,7 +600,7 @@ class PackageBuilder(object):
     #print("pt", parent_descriptor)
     # Copy all the elements from the dep_config
     # into the descriptor (name, version, local-path, base-version)
-    return descriptor
+    return FrozenDescriptor(descriptor)
 
 
   def dep_satisfied(self, new_dep):
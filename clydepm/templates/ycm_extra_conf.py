@@ -56,9 +56,14 @@ flags = [
 #
 # Most projects will NOT need to set this to anything; you can just change the
 # 'flags' list of compilation flags. Notice that YCM itself uses that approach.
-compilation_database_folder = ''
+#
+# clyde build and clyde2 gen write compile_commands.json next to this file,
+# with the flags of every package in the dependency tree. 'flags' is only
+# used until one of them has run.
+compilation_database_folder = os.path.dirname( os.path.abspath( __file__ ) )
 
-if os.path.exists( compilation_database_folder ):
+if os.path.exists( os.path.join( compilation_database_folder,
+                                 'compile_commands.json' ) ):
   database = ycm_core.CompilationDatabase( compilation_database_folder )
 else:
   database = None
@@ -0,0 +1,169 @@
+import unittest
+import os
+import shutil
+import io
+import stat
+import subprocess
+import tarfile
+import tempfile
+import threading
+from os.path import join, exists
+
+from clydepm.archive import (create_tarball, extract_tarball, tarball_name,
+                             split_tarball_name, git_archive, compress_stream,
+                             EXTENSIONS)
+
+
+class TestArchive(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.src = join(self.test_dir, 'src')
+    os.makedirs(join(self.src, 'include'))
+    os.makedirs(join(self.src, '.git'))
+    with open(join(self.src, 'include', 'foo.h'), 'w') as f:
+      f.write('int foo;' * 1000)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_round_trip(self):
+    for codec in EXTENSIONS:
+      tarball = tarball_name(self.test_dir, 'abc123', codec)
+      try:
+        create_tarball(tarball, self.src, 'abc123')
+      except Exception:
+        # zstd isn't installed everywhere
+        if codec == 'zst':
+          continue
+        raise
+
+      self.assertEqual(split_tarball_name(tarball), ('abc123', codec))
+      dest = join(self.test_dir, 'dest-' + codec)
+      extract_tarball(tarball, dest)
+      with open(join(dest, 'abc123', 'include', 'foo.h')) as f:
+        self.assertEqual(f.read(), 'int foo;' * 1000)
+      self.assertFalse(os.path.exists(join(dest, 'abc123', '.git')))
+
+  def test_git_archive(self):
+    repo = join(self.test_dir, 'repo')
+    os.makedirs(repo)
+    def git(*args):
+      subprocess.check_call(['git', '-C', repo, '-c', 'user.name=test',
+                             '-c', 'user.email=test@example.com'] + list(args),
+                            stdout = subprocess.PIPE)
+    git('init', '-q')
+    for version in ['1.0.0', '2.0.0']:
+      with open(join(repo, 'version.txt'), 'w') as f:
+        f.write(version)
+      git('add', 'version.txt')
+      git('commit', '-q', '-m', version)
+      git('tag', version)
+
+    for version in ['1.0.0', '2.0.0']:
+      tarball = tarball_name(self.test_dir, 'v' + version, 'gz')
+      git_archive(repo, version, tarball, 'v' + version)
+      extract_tarball(tarball, join(self.test_dir, 'dest'))
+      with open(join(self.test_dir, 'dest', 'v' + version, 'version.txt')) as f:
+        self.assertEqual(f.read(), version)
+
+    tarball = tarball_name(self.test_dir, 'missing', 'gz')
+    self.assertRaises(Exception, git_archive, repo, '3.0.0', tarball, 'missing')
+    self.assertFalse(os.path.exists(tarball))
+
+  def test_failed_write(self):
+    class BrokenStream(object):
+      def read(self, size):
+        raise IOError("connection reset")
+
+    tarball = tarball_name(self.test_dir, 'abc123', 'gz')
+    self.assertRaises(Exception, create_tarball, tarball,
+                      join(self.test_dir, 'missing'), 'abc123')
+    self.assertRaises(IOError, compress_stream, BrokenStream(), tarball)
+    # No temporary files left behind
+    self.assertEqual(sorted(os.listdir(self.test_dir)), ['src'])
+
+  def test_git_errors(self):
+    # More on stderr than a pipe holds, before git closes stdout
+    bin = join(self.test_dir, 'bin')
+    os.makedirs(bin)
+    with open(join(bin, 'git'), 'w') as f:
+      f.write("#!/bin/sh\n"
+              "head -c 200000 /dev/zero | tr '\\0' . >&2\n"
+              "echo ' fatal: not a tree' >&2\n"
+              "exit 128\n")
+    os.chmod(join(bin, 'git'), stat.S_IRWXU)
+    path = os.environ['PATH']
+    os.environ['PATH'] = bin + os.pathsep + path
+    raised = []
+    def archive():
+      try:
+        git_archive(self.src, '1.0.0', tarball_name(self.test_dir, 'abc123', 'none'),
+                    'abc123')
+      except Exception as e:
+        raised.append(e)
+    try:
+      thread = threading.Thread(target = archive)
+      thread.daemon = True
+      thread.start()
+      thread.join(30)
+    finally:
+      os.environ['PATH'] = path
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(len(raised), 1)
+    self.assertTrue(str(raised[0]).endswith(". fatal: not a tree"))
+    self.assertEqual(sorted(os.listdir(self.test_dir)), ['bin', 'src'])
+
+  def unsafe(self, members):
+    """
+    A tarball of members, a list of (name, linkname or None, type)
+    """
+    tarball = tarball_name(self.test_dir, 'abc123', 'none')
+    with tarfile.open(tarball, 'w') as tar:
+      for name, linkname, kind in members:
+        info = tarfile.TarInfo(name)
+        info.type = kind
+        data = b''
+        if linkname is not None:
+          info.linkname = linkname
+        elif kind == tarfile.REGTYPE:
+          data = b'escaped'
+          info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    return tarball
+
+  def test_unsafe_members(self):
+    dest = join(self.test_dir, 'dest', 'packages')
+    os.makedirs(dest)
+    for members in [
+        [('../escaped.txt', None, tarfile.REGTYPE)],
+        [('abc123/../../escaped.txt', None, tarfile.REGTYPE)],
+        [('/tmp/escaped.txt', None, tarfile.REGTYPE)],
+        [('abc123/link', '../../escaped.txt', tarfile.SYMTYPE)],
+        [('abc123/link', '/etc/passwd', tarfile.SYMTYPE)],
+        [('abc123/link', '../escaped.txt', tarfile.LNKTYPE)],
+        [('abc123/null', None, tarfile.CHRTYPE)]]:
+      tarball = self.unsafe(members)
+      self.assertRaises(Exception, extract_tarball, tarball, dest)
+      self.assertFalse(exists(join(self.test_dir, 'dest', 'escaped.txt')))
+
+  def test_base(self):
+    dest = join(self.test_dir, 'dest')
+    # Safe, but not where a package called abc123 belongs
+    tarball = self.unsafe([('abc123/include', None, tarfile.DIRTYPE),
+                           ('def456/foo.h', None, tarfile.REGTYPE)])
+    self.assertRaises(Exception, extract_tarball, tarball, dest, 'abc123')
+    self.assertFalse(exists(join(dest, 'def456')))
+
+    tarball = self.unsafe([('abc123/foo.h', None, tarfile.REGTYPE),
+                           ('abc123/lib/foo.h', '../foo.h', tarfile.SYMTYPE)])
+    extract_tarball(tarball, dest, 'abc123')
+    self.assertEqual(os.readlink(join(dest, 'abc123', 'lib', 'foo.h')), '../foo.h')
+
+  def test_unknown_codec(self):
+    self.assertRaises(Exception, tarball_name, self.test_dir, 'abc123', 'rar')
+    self.assertRaises(Exception, split_tarball_name, 'abc123.rar')
+
+
+if __name__ == '__main__':
+  unittest.main()
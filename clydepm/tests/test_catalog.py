@@ -0,0 +1,50 @@
+import unittest
+import os
+import shutil
+import tempfile
+from os.path import join
+
+from clydepm.catalog import PackageCatalog
+
+
+class TestPackageCatalog(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.packages = join(self.test_dir, '.packages')
+    os.makedirs(self.packages)
+    self.catalog = PackageCatalog(join(self.test_dir, 'catalog.db'),
+                                  self.packages)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def make_package(self, hash):
+    path = join(self.packages, hash)
+    os.makedirs(path)
+    with open(join(path, 'libfoo.a'), 'w') as f:
+      f.write('0123456789')
+    return path
+
+  def test_add_lookup(self):
+    path = self.make_package('abc')
+    self.assertEqual(self.catalog.lookup('abc'), path)
+    self.catalog.add('abc', path, {'name': 'foo', 'version': '1.0'})
+    entries = self.catalog.entries()
+    self.assertEqual(len(entries), 1)
+    self.assertEqual(entries[0][2:5], ('foo', '1.0', 10))
+    self.assertIsNone(self.catalog.lookup('def'))
+
+  def test_removed_package(self):
+    path = self.make_package('abc')
+    self.catalog.add('abc', path, {'name': 'foo', 'version': '1.0'})
+    shutil.rmtree(path)
+    self.assertIsNone(self.catalog.lookup('abc'))
+    self.assertEqual(self.catalog.entries(), [])
+
+  def test_rebuild(self):
+    self.make_package('abc')
+    self.make_package('def')
+    self.assertEqual(self.catalog.rebuild(), 2)
+    self.assertEqual(sorted(e[0] for e in self.catalog.entries()),
+                     ['abc', 'def'])
@@ -0,0 +1,38 @@
+import unittest
+import argparse
+import shutil
+import sys
+import tempfile
+from os.path import join, exists
+
+if sys.version_info[0] > 2:
+  raise unittest.SkipTest("clyde2 only runs on Python 2")
+
+from clyde2.command_line import generate_build_file
+
+
+class TestGenerateBuildFile(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def namespace(self):
+    return argparse.Namespace(variant = 'src', platform = 'linux', config = None,
+                              rtems = None, verbose = False, fast = True,
+                              frozen = False, refresh = False, trace = None)
+
+  def test_failure_exits_nonzero(self):
+    # The regen rule in build.ninja relies on this to notice
+    with open(join(self.test_dir, 'config.yaml'), 'w') as f:
+      f.write('name: [broken\n')
+    with self.assertRaises(SystemExit) as raised:
+      generate_build_file(self.test_dir, self.namespace())
+    self.assertEqual(raised.exception.code, 1)
+    self.assertFalse(exists(join(self.test_dir, 'build.ninja')))
+
+
+if __name__ == '__main__':
+  unittest.main()
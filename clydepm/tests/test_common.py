@@ -0,0 +1,64 @@
+import unittest
+import os
+import shutil
+import tempfile
+from os.path import join
+
+from clydepm.common import atomic_file, write_if_changed, memory_jobs, default_jobs
+
+
+class TestAtomicFile(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.filename = join(self.test_dir, 'build.ninja')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def read(self):
+    with open(self.filename) as f:
+      return f.read()
+
+  def test_replace(self):
+    output = atomic_file(self.filename)
+    with output as f:
+      f.write('rule cc\n')
+      # Nothing is there until the file is complete
+      self.assertFalse(os.path.exists(self.filename))
+    self.assertTrue(output.changed)
+    self.assertEqual(self.read(), 'rule cc\n')
+    self.assertEqual(os.listdir(self.test_dir), ['build.ninja'])
+
+  def test_unchanged(self):
+    self.assertTrue(write_if_changed(self.filename, 'rule cc\n'))
+    os.utime(self.filename, (0, 0))
+    self.assertFalse(write_if_changed(self.filename, 'rule cc\n'))
+    self.assertEqual(os.path.getmtime(self.filename), 0)
+    self.assertTrue(write_if_changed(self.filename, 'rule cx\n'))
+    self.assertEqual(self.read(), 'rule cx\n')
+
+  def test_failure(self):
+    write_if_changed(self.filename, 'rule cc\n')
+    output = atomic_file(self.filename)
+    try:
+      with output as f:
+        f.write('rule')
+        raise ValueError()
+    except ValueError:
+      pass
+    self.assertFalse(output.changed)
+    self.assertEqual(self.read(), 'rule cc\n')
+    self.assertEqual(os.listdir(self.test_dir), ['build.ninja'])
+
+
+class TestMemoryJobs(unittest.TestCase):
+
+  def test_bounds(self):
+    self.assertEqual(memory_jobs(1), default_jobs())
+    # Even a job bigger than the machine gets to run
+    self.assertEqual(memory_jobs(1 << 60), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
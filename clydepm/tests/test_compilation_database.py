@@ -0,0 +1,57 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+from os.path import join
+
+from clydepm.compilation_database import (compile_command, read_compilation_database,
+                                          write_compilation_database)
+
+
+class TestCompilationDatabase(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.filename = join(self.test_dir, 'compile_commands.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_entries(self):
+    entry = compile_command('/src/foo', 'src/foo.cpp', 'build/foo.o',
+                            ['g++', '-c', '-o', 'build/foo.o', 'src/foo.cpp'])
+    self.assertEqual(entry['file'], '/src/foo/src/foo.cpp')
+    self.assertEqual(entry['output'], '/src/foo/build/foo.o')
+    self.assertEqual(entry['arguments'][0], 'g++')
+    self.assertFalse('command' in entry)
+
+    entry = compile_command('/src/foo', '/abs/bar.c', 'build/bar.o',
+                            command = 'gcc -c /abs/bar.c -o build/bar.o')
+    self.assertEqual(entry['file'], '/abs/bar.c')
+    self.assertFalse('arguments' in entry)
+
+  def test_write_if_changed(self):
+    entries = [compile_command('/src', name, name + '.o', command = 'cc ' + name)
+               for name in ['b.c', 'a.c']]
+    self.assertTrue(write_compilation_database(self.filename, entries))
+    with open(self.filename) as f:
+      self.assertEqual([e['file'] for e in json.load(f)], ['/src/a.c', '/src/b.c'])
+
+    os.utime(self.filename, (0, 0))
+    self.assertFalse(write_compilation_database(self.filename, list(reversed(entries))))
+    self.assertEqual(os.path.getmtime(self.filename), 0)
+
+    entries[0]['command'] += ' -O2'
+    self.assertTrue(write_compilation_database(self.filename, entries))
+    self.assertEqual(read_compilation_database(self.filename)[1]['command'], 'cc b.c -O2')
+
+  def test_read_invalid(self):
+    self.assertEqual(read_compilation_database(self.filename), [])
+    with open(self.filename, 'w') as f:
+      f.write('{"not": "a list"}')
+    self.assertEqual(read_compilation_database(self.filename), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
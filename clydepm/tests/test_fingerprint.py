@@ -0,0 +1,52 @@
+import unittest
+import os
+import shutil
+import tempfile
+from os.path import join
+
+from clydepm.fingerprint import StatCache, fingerprint
+
+
+class TestFingerprint(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.src = join(self.test_dir, 'src')
+    os.makedirs(self.src)
+    self.source = join(self.src, 'foo.c')
+    with open(self.source, 'w') as f:
+      f.write('int foo;')
+    self.cache_file = join(self.test_dir, 'build', 'stat-cache.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def fingerprint(self):
+    return fingerprint([self.src], self.test_dir, StatCache(self.cache_file))
+
+  def test_stable(self):
+    self.assertEqual(self.fingerprint(), self.fingerprint())
+    self.assertTrue(os.path.exists(self.cache_file))
+
+  def test_content_change(self):
+    before = self.fingerprint()
+    with open(self.source, 'w') as f:
+      f.write('int bar;')
+    self.assertNotEqual(before, self.fingerprint())
+
+  def test_new_file(self):
+    before = self.fingerprint()
+    with open(join(self.src, 'bar.c'), 'w') as f:
+      f.write('')
+    self.assertNotEqual(before, self.fingerprint())
+
+  def test_cached_digest_is_reused(self):
+    self.fingerprint()
+    cache = StatCache(self.cache_file)
+    cache.entries[self.source][1] = 'cached'
+    self.assertEqual(cache.digest(self.source), 'cached')
+    self.assertFalse(cache.dirty)
+
+
+if __name__ == '__main__':
+  unittest.main()
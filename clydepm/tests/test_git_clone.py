@@ -0,0 +1,114 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import join, exists
+
+from clydepm.git_clone import CloneStrategy, git
+
+
+class TestGitClone(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.origin = join(self.test_dir, 'origin')
+    self.url = 'file://' + self.origin
+    os.makedirs(self.origin)
+    self.git('init', '-q')
+    # Let clients ask for partial clones
+    self.git('config', 'uploadpack.allowFilter', 'true')
+    self.commits = {}
+    for version in ['1.0.0', '1.1.0', '2.0.0']:
+      with open(join(self.origin, 'version.txt'), 'w') as f:
+        f.write(version)
+      self.git('add', 'version.txt')
+      self.git('commit', '-q', '-m', version)
+      self.git('tag', version)
+      self.commits[version] = git(self.origin, 'rev-parse', 'HEAD')
+    self.git('checkout', '-q', '-b', 'unreleased')
+    self.git('commit', '-q', '--allow-empty', '-m', 'unreleased')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def git(self, *args):
+    subprocess.check_call(['git', '-C', self.origin, '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com'] + list(args),
+                          stdout = subprocess.PIPE)
+
+  def clone(self, strategy, tag = None):
+    path = join(self.test_dir, 'clone-' + strategy.replace(',', '-'))
+    self.assertTrue(CloneStrategy(strategy).clone(self.url, path, tag))
+    return path
+
+  def read(self, path, version):
+    return git(path, 'show', version + ':version.txt')
+
+  def missing_blobs(self, path, version):
+    listing = git(path, 'rev-list', '--objects', '--no-walk', '--missing=print', version)
+    return [line for line in listing.splitlines() if line.startswith('?')]
+
+  def test_parse(self):
+    self.assertTrue(CloneStrategy().full)
+    self.assertEqual(str(CloneStrategy('shallow, blobless')), 'blobless,shallow')
+    self.assertEqual(str(CloneStrategy.from_config({'General' : {}})), 'full')
+    self.assertRaises(Exception, CloneStrategy, 'sparse')
+    self.assertRaises(Exception, CloneStrategy, 'full,shallow')
+
+  def test_full(self):
+    path = self.clone('full')
+    for version in self.commits:
+      self.assertEqual(self.read(path, version), version)
+    self.assertEqual(self.missing_blobs(path, '1.0.0'), [])
+
+  def test_blobless(self):
+    strategy = CloneStrategy('blobless')
+    path = self.clone('blobless')
+    self.assertEqual(len(self.missing_blobs(path, '2.0.0')), 1)
+    strategy.prefetch(path, '2.0.0')
+    self.assertEqual(self.missing_blobs(path, '2.0.0'), [])
+    # Blobs that weren't prefetched are fetched when they are read
+    self.assertEqual(self.read(path, '1.0.0'), '1.0.0')
+
+  def test_tags_only(self):
+    path = self.clone('tags')
+    self.assertEqual(sorted(git(path, 'tag').split()), sorted(self.commits))
+    self.assertEqual(git(path, 'for-each-ref', 'refs/remotes'), '')
+
+  def test_shallow(self):
+    strategy = CloneStrategy('shallow')
+    path = self.clone('shallow', '1.1.0')
+    self.assertEqual(git(path, 'tag').split(), ['1.1.0'])
+    self.assertEqual(git(path, 'rev-list', '--count', '1.1.0'), '1')
+    self.assertFalse(strategy.has_commit(path, self.commits['2.0.0']))
+
+    # Another version is selected, by tag and by sha
+    strategy.ensure_commit(path, self.commits['2.0.0'], '2.0.0')
+    self.assertEqual(self.read(path, '2.0.0'), '2.0.0')
+    strategy.ensure_commit(path, self.commits['1.0.0'])
+    self.assertEqual(self.read(path, self.commits['1.0.0']), '1.0.0')
+    self.assertEqual(git(path, 'rev-list', '--count', '2.0.0'), '1')
+
+    self.assertFalse(strategy.fetch_tag(path, '3.0.0'))
+
+  def test_shallow_without_tag(self):
+    strategy = CloneStrategy('blobless,shallow')
+    path = self.clone('blobless,shallow')
+    self.assertEqual(git(path, 'tag'), '')
+    strategy.fetch_tags(path)
+    self.assertEqual(git(path, 'tag'), '')
+    strategy.ensure_commit(path, self.commits['1.1.0'], '1.1.0')
+    self.assertEqual(self.read(path, '1.1.0'), '1.1.0')
+
+  def test_failed_clone(self):
+    path = join(self.test_dir, 'missing')
+    for strategy in ['full', 'blobless,tags', 'shallow']:
+      self.assertFalse(CloneStrategy(strategy).clone('file:///nonexistent', path))
+      self.assertFalse(exists(path))
+    self.assertFalse(CloneStrategy('shallow').clone(self.url, path, '3.0.0'))
+    self.assertFalse(exists(path))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from os.path import join, exists
+
+from clydepm.git_clone import git
+from clydepm.git_mirror import MirrorStore, STAMP
+
+
+class TestGitMirror(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.origin = join(self.test_dir, 'origin', 'package')
+    self.url = 'file://' + self.origin
+    os.makedirs(self.origin)
+    self.git('init', '-q')
+    self.commit('1.0.0')
+    self.mirrors = MirrorStore(join(self.test_dir, 'mirrors'), ttl = 3600)
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def git(self, *args):
+    subprocess.check_call(['git', '-C', self.origin, '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com'] + list(args),
+                          stdout = subprocess.PIPE)
+
+  def commit(self, version):
+    with open(join(self.origin, 'version.txt'), 'w') as f:
+      f.write(version)
+    self.git('add', 'version.txt')
+    self.git('commit', '-q', '-m', version)
+    self.git('tag', version)
+    return git(self.origin, 'rev-parse', 'HEAD')
+
+  def clone(self, project):
+    path = join(self.test_dir, project, 'package')
+    os.makedirs(join(self.test_dir, project))
+    self.assertTrue(self.mirrors.clone(self.url, path))
+    return path
+
+  def test_shared_clones(self):
+    first = self.clone('first')
+    second = self.clone('second')
+    mirror = self.mirrors.mirror_path(self.url)
+    self.assertEqual([name for name in os.listdir(self.mirrors.directory)
+                      if name.endswith('.git')], [os.path.basename(mirror)])
+    for path in [first, second]:
+      self.assertEqual(git(path, 'config', 'remote.origin.url'), mirror)
+      self.assertEqual(git(path, 'show', '1.0.0:version.txt'), '1.0.0')
+      # Every object is borrowed from the mirror
+      with open(join(path, '.git', 'objects', 'info', 'alternates')) as f:
+        self.assertEqual(f.read().strip(), join(mirror, 'objects'))
+      self.assertEqual(git(path, 'count-objects', '-v').splitlines()[0], 'count: 0')
+
+  def test_ttl(self):
+    path = self.clone('project')
+    self.commit('2.0.0')
+    # Fetched less than ttl seconds ago
+    self.mirrors = MirrorStore(self.mirrors.directory, ttl = 3600)
+    self.assertTrue(self.mirrors.update_origin(path))
+    self.assertEqual(git(path, 'ls-remote', '--tags', 'origin').count('\n'), 0)
+
+    stamp = join(self.mirrors.mirror_path(self.url), STAMP)
+    os.utime(stamp, (time.time() - 7200, time.time() - 7200))
+    self.mirrors = MirrorStore(self.mirrors.directory, ttl = 3600)
+    self.mirrors.update_origin(path)
+    self.assertEqual(git(path, 'ls-remote', '--tags', 'origin').count('\n'), 1)
+
+  def test_force(self):
+    path = self.clone('project')
+    commit = self.commit('2.0.0')
+    self.assertRaises(Exception, git, path, 'cat-file', '-e', commit)
+    self.mirrors.update_origin(path, force = True)
+    git(path, 'cat-file', '-e', commit)
+
+  def test_not_a_mirror(self):
+    path = join(self.test_dir, 'plain')
+    git(self.test_dir, 'clone', '-q', self.url, path)
+    self.assertFalse(self.mirrors.update_origin(path))
+
+  def test_failed_clone(self):
+    path = join(self.test_dir, 'missing')
+    self.assertFalse(self.mirrors.clone('file:///nonexistent', path))
+    self.assertFalse(exists(path))
+    self.assertFalse(exists(self.mirrors.mirror_path('file:///nonexistent')))
+
+  def test_from_config(self):
+    general = {'git-mirrors' : 'false', 'git-mirror-dir' : join(self.test_dir, 'config')}
+    self.assertEqual(MirrorStore.from_config({'General' : general}), None)
+    general['git-mirrors'] = 'true'
+    mirrors = MirrorStore.from_config({'General' : general}, refresh = True)
+    self.assertTrue(mirrors.refresh)
+    self.assertEqual(mirrors.ttl, 3600)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from clydepm.hashing import descriptor_sha, FrozenDescriptor, name_hash, thaw
+
+
+class TestDescriptorSha(unittest.TestCase):
+
+  def setUp(self):
+    self.descriptor = {
+      'name'    : 'foo',
+      'version' : 'v1.0.0',
+      'form'    : 'binary',
+      'traits'  : {'cflags' : {'gcc' : ['-O2', '-g']}}
+    }
+
+  def test_key_order(self):
+    reordered = dict(reversed(list(self.descriptor.items())))
+    self.assertEqual(descriptor_sha(self.descriptor), descriptor_sha(reordered))
+
+  def test_keys_and_lists_matter(self):
+    sha = descriptor_sha(self.descriptor)
+    self.assertNotEqual(sha, descriptor_sha(dict(self.descriptor, form = 'source')))
+    self.assertNotEqual(descriptor_sha({'a' : 'x'}), descriptor_sha({'b' : 'x'}))
+    self.assertNotEqual(descriptor_sha({'a' : ['x', 'y']}),
+                        descriptor_sha({'a' : ['x', 'z']}))
+
+  def test_frozen(self):
+    frozen = FrozenDescriptor(self.descriptor)
+    self.assertEqual(frozen.sha, descriptor_sha(self.descriptor))
+    self.assertEqual(descriptor_sha(frozen), frozen.sha)
+    self.assertEqual(frozen.thaw(), self.descriptor)
+    self.assertEqual(frozen['traits']['cflags']['gcc'], ('-O2', '-g'))
+    with self.assertRaises(TypeError):
+      frozen['form'] = 'source'
+    self.assertEqual(len(set([frozen, FrozenDescriptor(self.descriptor)])), 1)
+
+  def test_thaw(self):
+    thawed = thaw(FrozenDescriptor(self.descriptor))
+    thawed['form'] = 'source'
+    self.assertEqual(thawed['traits'], self.descriptor['traits'])
+    copy = thaw(self.descriptor)
+    copy['form'] = 'source'
+    self.assertEqual(self.descriptor['form'], 'binary')
+
+  def test_name_hash(self):
+    self.assertEqual(name_hash('foo'), name_hash('foo'))
+    self.assertNotEqual(name_hash('foo'), name_hash('bar'))
@@ -0,0 +1,132 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from os.path import join, exists
+
+from clydepm.archive import extract_tarball
+from clydepm.common import stable_sha
+from clydepm.http_package_server import (PackageCacheServer, HttpPackageServer,
+                                         ConnectionPool, PackageRequestHandler)
+
+
+class TestHttpPackageServer(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.server = PackageCacheServer(join(self.test_dir, 'served'), ('127.0.0.1', 0))
+    self.thread = threading.Thread(target = self.server.serve_forever,
+                                   kwargs = {'poll_interval' : 0.05})
+    self.thread.start()
+    self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+    shutil.rmtree(self.test_dir)
+
+  def client(self, name, upload = False):
+    return HttpPackageServer(join(self.test_dir, name), self.url, upload = upload)
+
+  def descriptor(self, version):
+    return {'name' : 'foo', 'version' : version, 'form' : 'binary', 'traits' : {}}
+
+  def store(self, descriptor):
+    """
+    A stored package, like PackageBuilder.store_package makes
+    """
+    path = join(self.test_dir, 'store', stable_sha(descriptor))
+    os.makedirs(join(path, 'output'))
+    with open(join(path, 'output', 'libfoo.a'), 'w') as f:
+      f.write(descriptor['version'] * 1000)
+    return path
+
+  def test_round_trip(self):
+    descriptor = self.descriptor('1.0.0')
+    ci = self.client('ci', upload = True)
+    self.assertTrue(ci.put_package(self.store(descriptor)))
+
+    developer = self.client('developer')
+    tarball = developer.get_package_tarball_by_descriptor(descriptor)
+    extract_tarball(tarball, join(self.test_dir, 'extracted'))
+    with open(join(self.test_dir, 'extracted', stable_sha(descriptor),
+                   'output', 'libfoo.a')) as f:
+      self.assertEqual(f.read(), '1.0.0' * 1000)
+
+  def test_missing(self):
+    client = self.client('developer')
+    self.assertEqual(client.get_package_tarball_by_descriptor(self.descriptor('2.0.0')),
+                     None)
+    source = dict(self.descriptor('1.0.0'), form = 'source')
+    self.assertEqual(client.get_package_tarball_by_descriptor(source), None)
+
+  def test_conditional_get(self):
+    descriptor = self.descriptor('1.0.0')
+    self.client('ci').put_package(self.store(descriptor))
+    tarball = self.client('developer').get_package_tarball_by_descriptor(descriptor)
+    with open(tarball + '.etag') as f:
+      tag = f.read()
+
+    pool = ConnectionPool(self.url)
+    status, headers = pool.request('GET', '/' + stable_sha(descriptor),
+                                   {'If-None-Match' : tag})
+    self.assertEqual(status, 304)
+
+    # A later run finds the same tarball without downloading it
+    os.utime(tarball, (0, 0))
+    self.assertEqual(self.client('developer').get_package_tarball_by_descriptor(descriptor),
+                     tarball)
+    self.assertEqual(os.path.getmtime(tarball), 0)
+
+  def test_wrong_package(self):
+    wanted, other = self.descriptor('1.0.0'), self.descriptor('2.0.0')
+    self.client('ci').put_package(self.store(other))
+    served = self.server.directory
+
+    class WrongPackage(PackageRequestHandler):
+      # Answers every request with the other package
+      def tarball(self):
+        return join(served, stable_sha(other) + '.tar.gz')
+    self.server.RequestHandlerClass = WrongPackage
+
+    developer = self.client('developer')
+    self.assertEqual(developer.get_package_tarball_by_descriptor(wanted), None)
+    self.assertEqual([f for f in os.listdir(join(self.test_dir, 'developer'))
+                      if f.endswith('.tar.gz')], [])
+
+  def test_keep_alive(self):
+    pool = ConnectionPool(self.url)
+    pool.request('GET', '/' + 'a' * 40)
+    connection = pool.idle[0]
+    pool.request('HEAD', '/' + 'a' * 40)
+    self.assertEqual(pool.idle, [connection])
+
+    # The server closed it in the meantime
+    connection.sock.close()
+    status, headers = pool.request('GET', '/' + 'a' * 40)
+    self.assertEqual(status, 404)
+
+  def test_prefetch(self):
+    descriptors = [self.descriptor('1.{0}.0'.format(i)) for i in range(10)]
+    ci = self.client('ci')
+    for descriptor in descriptors:
+      ci.put_package(self.store(descriptor))
+
+    developer = self.client('developer')
+    developer.prefetch(descriptors + [self.descriptor('3.0.0')])
+    self.assertEqual(len(developer.fetched), 11)
+    for descriptor in descriptors:
+      self.assertTrue(exists(developer.fetched[stable_sha(descriptor)]))
+
+  def test_bad_requests(self):
+    pool = ConnectionPool(self.url)
+    self.assertEqual(pool.request('GET', '/../secret')[0], 400)
+    self.assertEqual(pool.request('PUT', '/' + 'a' * 40, body = 'data')[0], 400)
+    self.assertEqual(pool.request('PUT', '/foo.tar.gz', body = 'data')[0], 400)
+    self.assertRaises(Exception, ConnectionPool, 'ftp://example.com')
+
+
+if __name__ == '__main__':
+  unittest.main()
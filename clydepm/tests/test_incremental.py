@@ -0,0 +1,59 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+from os.path import join
+
+from clydepm.incremental import read_depfile, needs_rebuild, record_command
+
+
+class TestIncremental(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.source = join(self.test_dir, 'foo.c')
+    self.header = join(self.test_dir, 'my header.h')
+    self.object = join(self.test_dir, 'foo.o')
+    self.depfile = self.object + '.d'
+    self.args = ['gcc', '-c', '-o', self.object, self.source]
+
+    for path in [self.source, self.header]:
+      with open(path, 'w') as f:
+        f.write('')
+    with open(self.depfile, 'w') as f:
+      f.write('{0}: {1} \\\n {2}\n'.format(self.object, self.source,
+                                          self.header.replace(' ', '\\ ')))
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def build(self):
+    with open(self.object, 'w') as f:
+      f.write('')
+    record_command(self.object, self.args)
+
+  def test_read_depfile(self):
+    self.assertEqual(read_depfile(self.depfile), [self.source, self.header])
+
+  def test_missing_output(self):
+    self.assertTrue(needs_rebuild(self.object, self.args, depfile = self.depfile))
+
+  def test_up_to_date(self):
+    self.build()
+    self.assertFalse(needs_rebuild(self.object, self.args, depfile = self.depfile))
+
+  def test_changed_flags(self):
+    self.build()
+    self.assertTrue(needs_rebuild(self.object, self.args + ['-O2'],
+                                  depfile = self.depfile))
+
+  def test_changed_header(self):
+    self.build()
+    later = time.time() + 10
+    os.utime(self.header, (later, later))
+    self.assertTrue(needs_rebuild(self.object, self.args, depfile = self.depfile))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import os
+import shutil
+import tempfile
+from os.path import join
+
+from clydepm.install import install_tree, source_mode, INSTALL_MODES
+
+
+class TestInstallTree(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.src = join(self.test_dir, 'src')
+    os.makedirs(join(self.src, 'include', 'foo'))
+    self.header = join(self.src, 'include', 'foo', 'foo.h')
+    with open(self.header, 'w') as f:
+      f.write('int foo;')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_modes(self):
+    for mode in INSTALL_MODES:
+      dest = join(self.test_dir, mode)
+      outputs = install_tree(self.src, dest, mode)
+      installed = join(dest, 'include', 'foo', 'foo.h')
+      self.assertEqual(outputs, [installed])
+      with open(installed) as f:
+        self.assertEqual(f.read(), 'int foo;')
+
+  def test_hardlink_shares_inode(self):
+    dest = join(self.test_dir, 'dest')
+    install_tree(self.src, dest, 'hardlink')
+    installed = join(dest, 'include', 'foo', 'foo.h')
+    self.assertEqual(os.stat(installed).st_ino, os.stat(self.header).st_ino)
+
+  def test_reinstall_replaces_instead_of_writing_through(self):
+    dest = join(self.test_dir, 'dest')
+    install_tree(self.src, dest, 'hardlink')
+
+    other = join(self.test_dir, 'other')
+    os.makedirs(join(other, 'include', 'foo'))
+    with open(join(other, 'include', 'foo', 'foo.h'), 'w') as f:
+      f.write('int bar;')
+    install_tree(other, dest, 'copy')
+
+    with open(self.header) as f:
+      self.assertEqual(f.read(), 'int foo;')
+
+  def test_source_files_are_not_shared(self):
+    for mode in INSTALL_MODES:
+      dest = join(self.test_dir, mode)
+      install_tree(self.src, dest, source_mode(mode))
+      installed = join(dest, 'include', 'foo', 'foo.h')
+      self.assertFalse(os.path.islink(installed))
+      self.assertNotEqual(os.stat(installed).st_ino, os.stat(self.header).st_ino)
+    # Edited in place, the way some editors save
+    with open(self.header, 'r+') as f:
+      f.write('int bar;')
+    with open(join(self.test_dir, 'hardlink', 'include', 'foo', 'foo.h')) as f:
+      self.assertEqual(f.read(), 'int foo;')
+
+  def test_unknown_mode(self):
+    self.assertRaises(Exception, install_tree, self.src,
+                      join(self.test_dir, 'dest'), 'teleport')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+from os.path import join
+
+import yaml
+
+from clyde2.lockfile import (LOCKFILE, LOCK_VERSION, lock_entry, write_lockfile,
+                             read_lockfile, check_lockfile)
+
+if sys.version_info[0] < 3:
+  from clyde2.resolver import get_locked_packages
+
+
+class FakePackage(object):
+
+  def __init__(self, name, version, requires):
+    self.name = name
+    self.version = version
+    self.requires = requires
+
+  def get_dependency_configurations(self):
+    dependencies = []
+    for name, spec in sorted(self.requires.items()):
+      # A list when a variant narrows the range
+      for spec in spec if isinstance(spec, list) else [spec]:
+        dependencies.append((name, spec))
+    return dependencies
+
+
+class TestLockfile(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.filename = join(self.test_dir, LOCKFILE)
+    self.top = FakePackage('top', '0.1.0', {'a' : '>=1.0.0'})
+    a = FakePackage('a', '1.1.0', {'c' : '<2.0.0'})
+    self.entries = {'a' : lock_entry(a, '0f3c', {'name' : 'a'}),
+                    'c' : lock_entry(FakePackage('c', '1.0.0', {}), '9a41',
+                                     {'name' : 'c'})}
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def test_round_trip(self):
+    self.assertTrue(write_lockfile(self.filename, [('src-linux', self.top)],
+                                   self.entries))
+    lock = read_lockfile(self.filename)
+    self.assertEqual(lock['root'], 'top')
+    self.assertEqual(lock['requires'], {'src-linux' : {'a' : '>=1.0.0'}})
+    self.assertEqual(lock['packages'], self.entries)
+    self.assertEqual(lock['packages']['a']['requires'], {'c' : '<2.0.0'})
+    # Nothing changed, so build.ninja doesn't need regenerating
+    self.assertFalse(write_lockfile(self.filename, [('src-linux', self.top)],
+                                    self.entries))
+
+  def test_configurations(self):
+    # The test variant narrows the range
+    test = FakePackage('top', '0.1.0', {'a' : ['>=1.0.0', '<2.0.0'],
+                                        'check' : '>=0.1.0'})
+    self.entries['check'] = lock_entry(FakePackage('check', '0.1.0', {}), '77d0',
+                                       {'name' : 'check'})
+    write_lockfile(self.filename, [('src-linux', self.top), ('test-linux', test)],
+                   self.entries)
+    lock = read_lockfile(self.filename)
+    self.assertEqual(lock['requires'],
+                     {'src-linux' : {'a' : '>=1.0.0'},
+                      'test-linux' : {'a' : '>=1.0.0,<2.0.0', 'check' : '>=0.1.0'}})
+    # Each configuration is checked against its own
+    check_lockfile(self.filename, lock, 'src-linux', self.top)
+    check_lockfile(self.filename, lock, 'test-linux', test)
+    self.assertRaises(Exception, check_lockfile, self.filename, lock, 'src-linux', test)
+    with self.assertRaises(Exception) as raised:
+      check_lockfile(self.filename, lock, 'src-rtems', self.top)
+    self.assertEqual(str(raised.exception),
+                     "{0} is out of date (src-rtems isn't locked). Run gen "
+                     "without --frozen to update it".format(self.filename))
+
+  def test_version_1(self):
+    # One requires for every configuration
+    with open(self.filename, 'w') as f:
+      yaml.safe_dump({'lock-version' : 1, 'root' : 'top',
+                      'requires' : {'a' : '>=1.0.0'}, 'packages' : self.entries}, f)
+    lock = read_lockfile(self.filename)
+    check_lockfile(self.filename, lock, 'src-linux', self.top)
+    check_lockfile(self.filename, lock, 'test-linux', self.top)
+    changed = FakePackage('top', '0.1.0', {'a' : '>=1.2.0'})
+    self.assertRaises(Exception, check_lockfile, self.filename, lock, 'src-linux',
+                      changed)
+
+  def test_newer_version(self):
+    with open(self.filename, 'w') as f:
+      yaml.safe_dump({'lock-version' : LOCK_VERSION + 1, 'packages' : {}}, f)
+    self.assertRaises(Exception, read_lockfile, self.filename)
+
+  def test_not_a_lockfile(self):
+    with open(self.filename, 'w') as f:
+      f.write('a=1.0.0\n')
+    self.assertRaises(Exception, read_lockfile, self.filename)
+
+  def test_check(self):
+    write_lockfile(self.filename, [('src-linux', self.top)], self.entries)
+    lock = read_lockfile(self.filename)
+    check_lockfile(self.filename, lock, 'src-linux', self.top)
+
+    changed = FakePackage('top', '0.1.0', {'a' : '>=1.2.0'})
+    with self.assertRaises(Exception) as raised:
+      check_lockfile(self.filename, lock, 'src-linux', changed)
+    self.assertEqual(str(raised.exception),
+                     "{0} is out of date (a is '>=1.2.0' in config.yaml but "
+                     "'>=1.0.0' in clyde.lock). Run gen without --frozen to "
+                     "update it".format(self.filename))
+
+    added = FakePackage('top', '0.1.0', {'a' : '>=1.0.0', 'b' : '>=1.0.0'})
+    with self.assertRaises(Exception) as raised:
+      check_lockfile(self.filename, lock, 'src-linux', added)
+    self.assertIn("b isn't locked", str(raised.exception))
+
+
+class FakeServer(object):
+
+  def __init__(self):
+    self.checked_out = []
+
+  def get_locked_project(self, name, commit, traits, config):
+    self.checked_out.append((name, commit, config))
+    return name + '@' + commit
+
+
+@unittest.skipIf(sys.version_info[0] > 2, "clyde2 only runs on Python 2")
+class TestGetLockedPackages(unittest.TestCase):
+
+  def test_checkout(self):
+    locked = {'a' : {'version' : '1.1.0', 'commit' : '0f3c', 'config' : '9a41'},
+              'c' : {'version' : '1.0.0', 'commit' : 'e51b'}}
+    for jobs in [1, 8]:
+      server = FakeServer()
+      packages = get_locked_packages(locked, server, {}, jobs)
+      self.assertEqual(packages, set(['a@0f3c', 'c@e51b']))
+      # Older lockfiles have no config hash
+      self.assertEqual(sorted(server.checked_out),
+                       [('a', '0f3c', '9a41'), ('c', 'e51b', None)])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+import datetime
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import join, exists
+
+from clyde2.metadata import CatFile, ConfigReader
+from clyde2.worktrees import git
+
+
+class TestMetadata(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.repository = join(self.test_dir, 'foo')
+    os.makedirs(self.repository)
+    self.git('init', '-q')
+    self.commits = {}
+    for version, extra in [('1.0.0', ''), ('1.1.0', 'requires:\n  bar: {version: ">=1.0.0"}\n'),
+                           ('1.2.0', 'released: 2020-01-01\n')]:
+      self.write('config.yaml', 'name: foo\nversion: {0}\n{1}'.format(version, extra))
+      self.git('add', 'config.yaml')
+      self.git('commit', '-q', '-m', version)
+      self.commits[version] = git(self.repository, 'rev-parse', 'HEAD')
+    self.git('rm', '-q', 'config.yaml')
+    self.git('commit', '-q', '-m', 'gone')
+    self.commits['gone'] = git(self.repository, 'rev-parse', 'HEAD')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def git(self, *args):
+    subprocess.check_call(['git', '-C', self.repository, '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com'] + list(args),
+                          stdout = subprocess.PIPE)
+
+  def write(self, filename, contents):
+    with open(join(self.repository, filename), 'w') as f:
+      f.write(contents)
+
+  def test_cat_file(self):
+    reader = CatFile(self.repository)
+    try:
+      self.assertEqual(reader.read(self.commits['1.0.0'] + ':config.yaml'),
+                       b'name: foo\nversion: 1.0.0\n')
+      self.assertEqual(reader.read(self.commits['gone'] + ':config.yaml'), None)
+      # Still in step after a missing object
+      self.assertEqual(reader.read(self.commits['1.1.0'] + ':config.yaml'),
+                       b'name: foo\nversion: 1.1.0\n'
+                       b'requires:\n  bar: {version: ">=1.0.0"}\n')
+    finally:
+      reader.close()
+
+  def test_config(self):
+    reader = ConfigReader(self.test_dir)
+    commit = self.commits['1.1.0']
+    config = reader.read('foo', commit)
+    self.assertEqual(config, {'name' : 'foo', 'version' : '1.1.0',
+                              'requires' : {'bar' : {'version' : '>=1.0.0'}}})
+    # Everyone gets their own copy
+    config['requires']['baz'] = {}
+    self.assertEqual(list(reader.read('foo', commit)['requires']), ['bar'])
+    reader.close()
+    self.assertTrue(exists(join(self.test_dir, '.metadata', commit + '.json')))
+
+    # Later runs don't need git at all
+    shutil.rmtree(self.repository)
+    reader = ConfigReader(self.test_dir)
+    self.assertEqual(reader.read('foo', commit)['version'], '1.1.0')
+    reader.close()
+
+  def test_missing(self):
+    reader = ConfigReader(self.test_dir)
+    try:
+      self.assertRaises(Exception, reader.read, 'foo', self.commits['gone'])
+      self.assertFalse(exists(join(self.test_dir, '.metadata',
+                                   self.commits['gone'] + '.json')))
+    finally:
+      reader.close()
+
+  def test_not_json(self):
+    reader = ConfigReader(self.test_dir)
+    commit = self.commits['1.2.0']
+    try:
+      self.assertEqual(reader.read('foo', commit)['released'],
+                       datetime.date(2020, 1, 1))
+    finally:
+      reader.close()
+    self.assertEqual(os.listdir(join(self.test_dir, '.metadata')), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,223 @@
+import unittest
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from os.path import join
+
+if sys.version_info[0] > 2:
+  raise unittest.SkipTest("clyde2 only runs on Python 2")
+
+from clyde2.generators.ninja_build import (Configuration, generate_file, pool_depths,
+                                           list_sources, LINK_POOL, HEAVY_COMPILE_POOL,
+                                           SOURCES_LIST)
+from clydepm.common import memory_jobs, default_jobs
+
+
+def library(name, path, type = 'library', cflags = '-O2', libraries = None, **extra):
+  info = {'name' : name, 'path' : path, 'type' : type, 'cflags' : cflags,
+          'sources' : [join(path, 'src', name + '.cpp')],
+          'libraries' : libraries or {}}
+  info.update(extra)
+  return {name : info}
+
+
+class NinjaBuildTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def tree(self, cflags = '-O2', variant = 'src', **extra):
+    """
+    An application app using a library a, as create_build_tree makes it
+    """
+    a = library('a', join(self.test_dir, 'deps', 'a'), **extra)
+    return library('app', self.test_dir, 'application', cflags, a, variant = variant)
+
+  def read(self, filename = 'build.ninja'):
+    with open(join(self.test_dir, filename)) as f:
+      return f.read().replace('$\n    ', '')
+
+  def builds(self, filename = 'build.ninja'):
+    """
+    The build statements in filename, as a dictionary of output to
+    its rule and inputs
+    """
+    builds = {}
+    for line in self.read(filename).splitlines():
+      if line.startswith('build '):
+        outputs, inputs = line[len('build '):].split(': ', 1)
+        inputs = inputs.split()
+        builds[outputs] = (inputs[0], inputs[1:])
+    return builds
+
+
+class TestConfigurations(NinjaBuildTestCase):
+
+  def test_configurations(self):
+    configurations = [
+      Configuration('src-linux', self.tree()),
+      Configuration('test-linux', self.tree('-O0', 'test')),
+      Configuration('src-arm', self.tree(), prefix = 'arm-none-eabi-')]
+    self.assertTrue(generate_file(configurations, root = self.test_dir))
+    builds = self.builds()
+
+    # a is compiled the same way by both linux configurations
+    objects = dict((name, builds[join('prefix', name, 'lib', 'a.a')][1])
+                   for name in ['src-linux', 'test-linux', 'src-arm'])
+    self.assertEqual(objects['src-linux'], objects['test-linux'])
+    self.assertNotEqual(objects['src-linux'], objects['src-arm'])
+    self.assertEqual(self.read().count('build {0}: '.format(objects['src-linux'][0])), 1)
+    for name, inputs in objects.items():
+      self.assertEqual(len(inputs), 1)
+      self.assertTrue(inputs[0].startswith('build/'))
+    apps = [output for output in builds if output.endswith('app.o')]
+    self.assertEqual(len(apps), 3)
+    self.assertEqual(len(set(apps)), 3)
+
+    # Everything else is kept apart
+    self.assertEqual(builds['prefix/src-linux/bin/app'][0], 'main')
+    self.assertEqual(builds['prefix/test-linux/bin/test-app'][0], 'main')
+    self.assertEqual(builds['prefix/src-arm/bin/app'][0], 'main_src-arm')
+    self.assertEqual(builds['prefix/src-arm/lib/a.a'][0], 'link_src-arm')
+    self.assertIn('rule cpp_src-arm\n  command = arm-none-eabi-g++', self.read())
+    self.assertNotIn('rule cpp_test-linux', self.read())
+
+    self.assertEqual(builds['src-linux'], ('phony', ['prefix/src-linux/bin/app']))
+    self.assertEqual(builds['test-linux'],
+                     ('phony', ['prefix/test-linux/bin/test-app']))
+    self.assertEqual(builds['src-arm'], ('phony', ['prefix/src-arm/bin/app']))
+    self.assertIn('\ndefault prefix/src-linux/bin/app\n', self.read())
+
+  def test_single_configuration(self):
+    generate_file([Configuration('src-linux', self.tree())], root = self.test_dir)
+    builds = self.builds()
+    self.assertEqual(builds['prefix/bin/app'],
+                     ('main', ['prefix/lib/a.a', 'build/src/app.o']))
+    self.assertNotIn('src-linux', builds)
+    self.assertNotIn('default', self.read())
+
+
+
+class TestPools(NinjaBuildTestCase):
+
+  def test_default_depth(self):
+    configurations = [Configuration('src-linux', self.tree())]
+    self.assertEqual(pool_depths(configurations, {LINK_POOL : 1,
+                                                  HEAVY_COMPILE_POOL : 1 << 60}),
+                     {LINK_POOL : default_jobs(), HEAVY_COMPILE_POOL : 1})
+    self.assertEqual(pool_depths(configurations, {LINK_POOL : 1 << 30}),
+                     {LINK_POOL : memory_jobs(1 << 30)})
+
+    generate_file(configurations, root = self.test_dir,
+                  pool_memory = {LINK_POOL : 1 << 60, HEAVY_COMPILE_POOL : 1})
+    self.assertIn('pool link_pool\n  depth = 1\n', self.read())
+    self.assertIn('pool heavy_compile\n  depth = {0}\n'.format(default_jobs()),
+                  self.read())
+
+  def test_override(self):
+    tree = self.tree(pools = {LINK_POOL : 3})
+    tree['app']['pools'] = {LINK_POOL : '2', HEAVY_COMPILE_POOL : 5}
+    other = self.tree(pools = {LINK_POOL : 4})
+    memory = {LINK_POOL : 1, HEAVY_COMPILE_POOL : 1}
+    # The smallest depth asked for by any package in any configuration
+    self.assertEqual(pool_depths([Configuration('src-linux', tree),
+                                  Configuration('test-linux', other)], memory),
+                     {LINK_POOL : 2, HEAVY_COMPILE_POOL : 5})
+    self.assertEqual(pool_depths([Configuration('test-linux', other)], memory),
+                     {LINK_POOL : 4, HEAVY_COMPILE_POOL : default_jobs()})
+
+  def test_unknown_pool(self):
+    configurations = [Configuration('src-linux', self.tree(pools = {'swimming' : 1}))]
+    with self.assertRaises(Exception) as raised:
+      generate_file(configurations, root = self.test_dir)
+    self.assertEqual(str(raised.exception),
+                     "Unknown pools swimming in config.yaml. "
+                     "Pools are heavy_compile, link_pool")
+
+  def test_jobs(self):
+    heavy = join(self.test_dir, 'deps', 'a', 'src', 'a.cpp')
+    generate_file([Configuration('src-linux', self.tree(heavy = set([heavy])))],
+                  root = self.test_dir)
+    text = self.read()
+    self.assertIn('rule main\n  command = g++ -MMD -MF $inc $out.d $cflags $in -o $out\n'
+                  '  pool = link_pool\n', text)
+    self.assertIn('rule link\n  command = ld $ldflags -r -o $out $in\n'
+                  '  pool = link_pool\n', text)
+    self.assertIn('build build/deps/a/src/a.o: cpp deps/a/src/a.cpp\n'
+                  '  pool = heavy_compile\n', text)
+    self.assertIn('build build/src/app.o: cpp src/app.cpp\n  cflags', text)
+    for rule in ['cc', 'cpp']:
+      self.assertNotIn('pool', text.split('rule {0}\n'.format(rule))[1].split('\n\n')[0])
+
+
+
+class FakeObjectCache(object):
+
+  def wrapper_command(self):
+    return 'cache --'
+
+
+class TestGenerateFile(NinjaBuildTestCase):
+
+  def test_twice(self):
+    configurations = [Configuration('src-linux', self.tree())]
+    cache = FakeObjectCache()
+    self.assertTrue(generate_file(configurations, root = self.test_dir,
+                                  object_cache = cache))
+    first = self.read()
+    # Nothing from the first file is taken to be written already
+    self.assertTrue(generate_file([Configuration('src-linux', self.tree())],
+                                  root = self.test_dir, object_cache = cache,
+                                  filename = join(self.test_dir, 'other.ninja')))
+    self.assertEqual(self.read('other.ninja'), first)
+    self.assertEqual(self.builds()['prefix/bin/app'],
+                     ('main', ['prefix/lib/a.a', 'build/src/app.o']))
+
+    # The same configurations again come out the same
+    self.assertFalse(generate_file(configurations, root = self.test_dir,
+                                   object_cache = cache))
+    self.assertEqual(self.read(), first)
+    for rule in ['cc', 'cpp']:
+      self.assertIn('rule {0}\n  command = cache -- '.format(rule), first)
+    self.assertEqual(first.count('cache --'), 2)
+
+  def test_regenerate(self):
+    for path in ['src/app.cpp', 'src/notes.txt', 'deps/a/src/a.cpp',
+                 'deps/a/src/b.c', 'deps/a/config.yaml', 'config.yaml']:
+      path = join(self.test_dir, path)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write('')
+    inputs = [join(self.test_dir, 'config.yaml'),
+              join(self.test_dir, 'deps', 'a', 'config.yaml'), '/usr/bin/gcc']
+    generate_file([Configuration('src-linux', self.tree())], root = self.test_dir,
+                  regenerate_command = 'clyde2 gen', regenerate_inputs = inputs)
+    text = self.read()
+    builds = self.builds()
+    self.assertIn('rule regen\n  command = clyde2 gen\n', text)
+    self.assertIn('  generator = 1\n  restat = 1\n', text)
+    # Source directories change whenever a file in them is saved,
+    # so only the list of sources in them is an input
+    self.assertEqual(builds['build.ninja'], ('regen', [
+      '|', '/usr/bin/gcc', SOURCES_LIST, 'config.yaml', 'deps/a/config.yaml']))
+    self.assertEqual(builds[SOURCES_LIST], ('list_sources', ['deps/a/src', 'src']))
+
+    listing = 'deps/a/src/a.cpp\ndeps/a/src/b.c\nsrc/app.cpp\n'
+    self.assertEqual(list_sources(['src', 'deps/a/src'], self.test_dir), listing)
+    self.assertEqual(self.read(SOURCES_LIST), listing)
+    # ninja's command lists them the same way
+    command = text.split('rule list_sources\n  command = ')[1].split('\n')[0]
+    os.remove(join(self.test_dir, SOURCES_LIST))
+    subprocess.check_call(command.replace('$in', 'src deps/a/src').replace(
+      '$out', SOURCES_LIST), shell = True, cwd = self.test_dir)
+    self.assertEqual(self.read(SOURCES_LIST), listing)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import os
+import shutil
+import tempfile
+from distutils.spawn import find_executable
+from os.path import join
+
+from clydepm.object_cache import CompileCommand, ObjectCache, parse_size
+
+
+class TestCompileCommand(unittest.TestCase):
+
+  def test_key_flags_ignore_paths(self):
+    a = CompileCommand(['gcc', '-MMD', '-MF', 'a/build/foo.o.d', '-Ia/include',
+                        '-DFOO', '-O2', '-c', 'a/src/foo.c', '-o', 'a/build/foo.o'])
+    b = CompileCommand(['gcc', '-MMD', '-MF', 'b/build/foo.o.d', '-I', 'b/include',
+                        '-DFOO', '-O2', '-c', 'b/src/foo.c', '-o', 'b/build/foo.o'])
+    self.assertTrue(a.cacheable())
+    self.assertEqual(a.key_flags, ['-O2'])
+    self.assertEqual(a.key_flags, b.key_flags)
+
+  def test_preprocess_args(self):
+    c = CompileCommand(['g++', '-MMD', '-MF', 'foo.o.d', '-std=c++11',
+                        '-c', 'foo.cpp', '-o', 'foo.o'])
+    self.assertEqual(c.preprocess_args, ['g++', '-MMD', '-MF', 'foo.o.d',
+                                         '-std=c++11', 'foo.cpp', '-E', '-P',
+                                         '-MT', 'foo.o'])
+
+  def test_link_is_not_cacheable(self):
+    c = CompileCommand(['g++', 'foo.o', 'bar.o', '-o', 'app'])
+    self.assertFalse(c.cacheable())
+
+  def test_parse_size(self):
+    self.assertEqual(parse_size('5G'), 5 * 1024 ** 3)
+    self.assertEqual(parse_size('500m'), 500 * 1024 ** 2)
+    self.assertEqual(parse_size('1024'), 1024)
+
+
+@unittest.skipIf(find_executable('gcc') is None, "gcc isn't installed")
+class TestObjectCache(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.cache_dir = join(self.test_dir, 'objects')
+    self.checkouts = [self.checkout('a'), self.checkout('b')]
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def checkout(self, name):
+    root = join(self.test_dir, name)
+    for d in ['src', 'include', 'build']:
+      os.makedirs(join(root, d))
+    with open(join(root, 'include', 'foo.h'), 'w') as f:
+      f.write('#define FOO 42\n')
+    with open(join(root, 'src', 'foo.c'), 'w') as f:
+      f.write('#include "foo.h"\nint foo(void) { return FOO; }\n')
+    return root
+
+  def args(self, root):
+    output = join(root, 'build', 'foo.o')
+    return ['gcc', '-MMD', '-MF', output + '.d', '-I' + join(root, 'include'),
+            '-O2', '-c', join(root, 'src', 'foo.c'), '-o', output]
+
+  def compile(self, cache, root):
+    returncode, stdout, stderr = cache.compile(self.args(root))
+    self.assertEqual(returncode, 0)
+    with open(join(root, 'build', 'foo.o'), 'rb') as f:
+      return f.read()
+
+  def test_hit(self):
+    cache = ObjectCache(self.cache_dir)
+    a, b = self.checkouts
+    compiled = self.compile(cache, a)
+    stats = cache.read_stats()
+    self.assertEqual((stats['hits'], stats['misses']), (0, 1))
+    self.assertEqual(stats['size'], len(compiled))
+
+    # Another checkout of the same sources gets the same object
+    self.assertEqual(self.compile(cache, b), compiled)
+    stats = cache.read_stats()
+    self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+    self.assertEqual(stats['size'], len(compiled))
+
+    # ninja still needs to know what the object depends on
+    with open(join(b, 'build', 'foo.o.d')) as f:
+      depfile = f.read()
+    self.assertTrue(depfile.startswith(join(b, 'build', 'foo.o') + ':'))
+    self.assertIn(join(b, 'include', 'foo.h'), depfile)
+
+  def test_header_change(self):
+    cache = ObjectCache(self.cache_dir)
+    a, b = self.checkouts
+    self.compile(cache, a)
+    with open(join(b, 'include', 'foo.h'), 'w') as f:
+      f.write('#define FOO 43\n')
+    self.compile(cache, b)
+    self.assertEqual(cache.read_stats()['misses'], 2)
+
+  def test_trim(self):
+    # Too small to keep anything
+    cache = ObjectCache(self.cache_dir, max_size = 1)
+    a, b = self.checkouts
+    self.compile(cache, a)
+    self.assertEqual(cache.read_stats()['size'], 0)
+    objects = [f for root, dirs, files in os.walk(self.cache_dir)
+               for f in files if f.endswith('.o')]
+    self.assertEqual(objects, [])
+    self.compile(cache, b)
+    self.assertEqual(cache.read_stats()['misses'], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
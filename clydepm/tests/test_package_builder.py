@@ -0,0 +1,216 @@
+import unittest
+import os
+import shutil
+import io
+import subprocess
+import sys
+import tarfile
+import tempfile
+from os.path import join, exists
+
+if sys.version_info[0] > 2:
+  raise unittest.SkipTest("Package loads config.yaml the Python 2 way")
+
+from clydepm.package_builder import PackageBuilder
+from clydepm.command_line import make_package_descriptor
+
+CONFIG = """name: app
+version: 0.1.0
+type: application
+cflags: {gcc: ''}
+variants:
+  - test:
+      when: {variant: test}
+"""
+
+CONFIGURATION = {'General' : {
+  'install-mode' : 'copy',
+  'archive-codec' : 'gz',
+  'fetch-jobs' : '1',
+  'clone-strategy' : 'full',
+  'object-cache' : 'false',
+  'package-cache-url' : None}}
+
+
+def write_package(path, config, sources):
+  for d in ['src', 'test', 'include']:
+    os.makedirs(join(path, d))
+  with open(join(path, 'config.yaml'), 'w') as f:
+    f.write(config)
+  for filename, contents in sources.items():
+    with open(join(path, filename), 'w') as f:
+      f.write(contents)
+
+
+def make_configuration(test_dir):
+  configuration = {'General' : dict(CONFIGURATION['General'])}
+  configuration['General']['package-root'] = join(test_dir, 'root')
+  configuration['General']['git-root'] = join(test_dir, 'git')
+  return configuration
+
+
+class TestUpToDate(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.app = join(self.test_dir, 'app')
+    write_package(self.app, CONFIG,
+                  {join('src', 'main.c') : 'int main(){return 0;}',
+                   join('test', 't.c') : 'int helper(){return 1;}'})
+    self.configuration = make_configuration(self.test_dir)
+    self.old_cwd = os.getcwd()
+    os.chdir(self.app)
+
+  def tearDown(self):
+    os.chdir(self.old_cwd)
+    shutil.rmtree(self.test_dir)
+
+  def build(self, variant):
+    builder = PackageBuilder(self.configuration)
+    descriptor = make_package_descriptor(self.app, variant, 'linux')
+    return builder.get_package_by_descriptor(descriptor)
+
+  def binary(self, variant):
+    with open(self.build(variant).get_binary(), 'rb') as f:
+      return f.read()
+
+  def test_unchanged(self):
+    binary = self.build('src').get_binary()
+    os.utime(binary, (0, 0))
+    self.assertEqual(self.build('src').get_binary(), binary)
+    self.assertEqual(os.path.getmtime(binary), 0)
+
+  def test_switch_variant(self):
+    # Both variants link the same output/bin/app/app-0.1.0.out
+    self.assertNotIn(b'helper', self.binary('src'))
+    self.assertIn(b'helper', self.binary('test'))
+    self.assertNotIn(b'helper', self.binary('src'))
+
+  def test_store_does_not_share_sources(self):
+    header = join(self.app, 'include', 'app.h')
+    with open(header, 'w') as f:
+      f.write('int app;')
+    self.configuration['General']['install-mode'] = 'hardlink'
+    self.build('src')
+    stored = [join(root, f) for root, dirs, files in
+              os.walk(join(self.test_dir, 'root')) for f in files if f == 'app.h']
+    self.assertTrue(stored)
+    for path in stored:
+      self.assertNotEqual(os.stat(path).st_ino, os.stat(header).st_ino)
+
+  def test_missing_output(self):
+    binary = self.build('src').get_binary()
+    os.remove(binary)
+    self.build('src')
+    self.assertTrue(os.path.exists(binary))
+
+
+class TestParallelDeps(unittest.TestCase):
+  """
+  app depends on b and c, which both depend on d
+  """
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.app = join(self.test_dir, 'app')
+    for name, requires, source in [
+        ('d', [], 'int d(){return 4;}'),
+        ('b', ['d'], 'int d(); int b(){return d();}'),
+        ('c', ['d'], 'int d(); int c(){return d();}')]:
+      config = 'name: {0}\nversion: 0.1.0\ntype: library\n'.format(name)
+      config += self.requires(requires)
+      write_package(join(self.test_dir, name), config,
+                    {join('src', name + '.c') : source})
+    write_package(self.app,
+                  'name: app\nversion: 0.1.0\ntype: application\n' +
+                  self.requires(['b', 'c']),
+                  {join('src', 'main.c') :
+                   'int b(); int c(); int main(){return b() + c() - 8;}'})
+
+    self.builder = PackageBuilder(make_configuration(self.test_dir),
+                                  parallel_deps = True)
+    self.retrieved = []
+    get_package_by_descriptor = self.builder.get_package_by_descriptor
+    def counted(descriptor):
+      self.retrieved.append(descriptor['name'])
+      return get_package_by_descriptor(descriptor)
+    self.builder.get_package_by_descriptor = counted
+
+    self.old_cwd = os.getcwd()
+    os.chdir(self.app)
+
+  def tearDown(self):
+    os.chdir(self.old_cwd)
+    shutil.rmtree(self.test_dir)
+
+  def requires(self, names):
+    if not names:
+      return ''
+    return 'requires:\n' + ''.join(
+      '  {0}: {{version: local, local-path: {1}}}\n'.format(
+        name, join(self.test_dir, name)) for name in names)
+
+  def build(self):
+    descriptor = make_package_descriptor(self.app, 'src', 'linux')
+    return self.builder.get_package_by_descriptor(descriptor)
+
+  def test_diamond(self):
+    binary = self.build().get_binary()
+    self.assertEqual(sorted(self.retrieved), ['app', 'b', 'c', 'd'])
+    self.assertEqual(subprocess.call([binary]), 0)
+    self.assertEqual(self.builder.build_trace, [])
+
+  def test_failure_trace(self):
+    with open(join(self.test_dir, 'd', 'src', 'd.c'), 'w') as f:
+      f.write('int d(){return 4}')
+    with self.assertRaises(Exception):
+      self.build()
+    # Whichever of b and c got to d first
+    trace = self.builder.build_trace
+    self.assertEqual(trace[0], 'app')
+    self.assertIn(trace[1], ['b', 'c'])
+    self.assertEqual(trace[2:], ['d'])
+
+
+class TestStoreTarball(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.builder = PackageBuilder(make_configuration(self.test_dir))
+    self.sha = 'a' * 40
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def tarball(self, *names):
+    tarball = join(self.test_dir, self.sha + '.tar')
+    with tarfile.open(tarball, 'w') as tar:
+      for name in names:
+        info = tarfile.TarInfo(name)
+        info.size = 3
+        tar.addfile(info, io.BytesIO(b'foo'))
+    return tarball
+
+  def test_store(self):
+    self.assertTrue(self.builder.store_tarball(
+      self.tarball(self.sha + '/descriptor.yaml')))
+    self.assertEqual(self.builder.catalog.lookup(self.sha),
+                     join(self.builder.package_directory, self.sha))
+
+  def test_escape(self):
+    tarball = self.tarball(self.sha + '/descriptor.yaml', '../escaped.txt')
+    self.assertFalse(self.builder.store_tarball(tarball))
+    self.assertFalse(exists(join(self.builder.package_directory, '..',
+                                 'escaped.txt')))
+    self.assertFalse(exists(join(self.builder.package_directory, self.sha)))
+    self.assertFalse(exists(tarball))
+    self.assertEqual(self.builder.catalog.lookup(self.sha), None)
+
+  def test_no_package(self):
+    # Nothing under <sha>/, so there'd be nothing to catalog
+    self.assertFalse(self.builder.store_tarball(self.tarball()))
+    self.assertEqual(self.builder.catalog.lookup(self.sha), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
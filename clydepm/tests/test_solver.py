@@ -0,0 +1,98 @@
+import unittest
+import sys
+
+if sys.version_info[0] > 2:
+  raise unittest.SkipTest("clyde2 only runs on Python 2")
+
+from semantic_version import Version, Spec
+
+from clyde2.server import TestServer
+from clyde2.package import TestPackage
+from clyde2.solver import Solver, ResolutionError, generate_graph
+
+
+def make_server(graph):
+  """
+  graph is name -> version string -> list of (name, spec string)
+  """
+  server = TestServer()
+  for name, versions in graph.items():
+    for version, dependencies in versions.items():
+      server.add_package(TestPackage(name, Version(version), dependencies))
+  return server
+
+
+def versions(solution):
+  return dict((name, str(version)) for name, version in solution.items())
+
+
+class TestSolver(unittest.TestCase):
+
+  def test_simple(self):
+    server = make_server({
+      'a' : {'1.0.0' : [], '1.1.0' : [('b', '<2.0.0')]},
+      'b' : {'1.0.0' : [], '1.2.0' : [], '2.0.0' : []},
+      'unused' : {'1.0.0' : []}})
+    solver = Solver(server)
+    self.assertEqual(versions(solver.solve('top', [('a', '>=1.0.0')])),
+                     {'a' : '1.1.0', 'b' : '1.2.0'})
+    self.assertEqual(solver.conflicts, 0)
+
+  def test_backtracking(self):
+    # The newest a needs a c that b can't use, which only shows up
+    # once b is chosen too
+    server = make_server({
+      'a' : {'2.0.0' : [('c', '>=2.0.0')], '1.0.0' : [('c', '<2.0.0')]},
+      'b' : {'1.1.0' : [('c', '<2.0.0')], '1.0.0' : [('c', '>=3.0.0')]},
+      'c' : {'1.0.0' : [], '2.0.0' : []}})
+    solver = Solver(server)
+    solution = solver.solve('top', [('a', '>=1.0.0'), ('b', '>=1.0.0')])
+    self.assertEqual(versions(solution), {'a' : '1.0.0', 'b' : '1.1.0', 'c' : '1.0.0'})
+    self.assertTrue(solver.conflicts > 0)
+
+  def test_unsatisfiable(self):
+    server = make_server({
+      'a' : {'1.0.0' : [('c', '>=2.0.0')]},
+      'b' : {'1.0.0' : [('c', '<2.0.0')]},
+      'c' : {'1.0.0' : [], '2.0.0' : []},
+      'd' : {'1.0.0' : []}})
+    with self.assertRaises(ResolutionError) as raised:
+      Solver(server).solve('top', [('a', '>=1.0.0'), ('b', '>=1.0.0'),
+                                   ('d', '>=1.0.0')])
+    # d has nothing to do with it, so it's left out
+    self.assertEqual(raised.exception.explanation, [
+      "Could not resolve the dependencies of top:",
+      "  top requires a >=1.0.0",
+      "  top requires b >=1.0.0",
+      "  b 1.0.0 requires c <2.0.0",
+      "  a 1.0.0 requires c >=2.0.0",
+      "  a has versions 1.0.0",
+      "  b has versions 1.0.0",
+      "  c has versions 1.0.0, 2.0.0"])
+
+  def test_missing_package(self):
+    with self.assertRaises(ResolutionError) as raised:
+      Solver(make_server({})).solve('top', [('a', '>=1.0.0')])
+    self.assertEqual(raised.exception.explanation, [
+      "Could not resolve the dependencies of top:",
+      "  top requires a >=1.0.0",
+      "  a has versions none"])
+
+  def test_invalid_spec(self):
+    server = make_server({'a' : {'1.0.0' : [('b', 'newest')]},
+                          'b' : {'1.0.0' : []}})
+    with self.assertRaises(ResolutionError) as raised:
+      Solver(server).solve('top', [('a', '>=1.0.0')])
+    self.assertEqual(raised.exception.explanation, [
+      "a 1.0.0 requires version newest of b. This is an invalid specification"])
+
+  def test_generated_graph(self):
+    server = generate_graph(packages = 100, versions = 5)
+    solution = Solver(server).solve('root', [('p0', '>=0.0.0')])
+    for name, version in solution.items():
+      for dep, text in server.dependencies(name, version):
+        self.assertIn(solution[dep], Spec(text))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import join
+
+from semantic_version import Version
+
+from clyde2.tag_index import TagIndex, parse_tag_refs
+from clyde2.worktrees import git
+
+
+class TestParseTagRefs(unittest.TestCase):
+
+  def test_parse(self):
+    output = "\n".join([
+      "1111111111111111111111111111111111111111\trefs/tags/1.0.0",
+      "2222222222222222222222222222222222222222\trefs/tags/1.1.0",
+      # Annotated: the tag object, then the commit it points at
+      "3333333333333333333333333333333333333333\trefs/tags/1.1.0^{}",
+      "",
+      "4444444444444444444444444444444444444444 refs/heads/master",
+    ])
+    self.assertEqual(parse_tag_refs(output), {
+      '1.0.0' : '1111111111111111111111111111111111111111',
+      '1.1.0' : '3333333333333333333333333333333333333333'})
+
+  def test_peeled_first(self):
+    output = "\n".join([
+      "3333333333333333333333333333333333333333 refs/tags/1.1.0^{}",
+      "2222222222222222222222222222222222222222 refs/tags/1.1.0"])
+    self.assertEqual(parse_tag_refs(output),
+                     {'1.1.0' : '3333333333333333333333333333333333333333'})
+
+  def test_empty(self):
+    self.assertEqual(parse_tag_refs(''), {})
+
+
+class TestTagIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.origin = join(self.test_dir, 'origin')
+    os.makedirs(self.origin)
+    self.git('init', '-q')
+    self.commits = {}
+    for tag in ['1.0.0', 'latest', '1.1.0']:
+      self.commit(tag)
+    self.git_directory = join(self.test_dir, 'git')
+    os.makedirs(self.git_directory)
+    subprocess.check_call(['git', 'clone', '-q', self.origin,
+                           join(self.git_directory, 'foo')])
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def git(self, *args):
+    subprocess.check_call(['git', '-C', self.origin, '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com'] + list(args),
+                          stdout = subprocess.PIPE)
+
+  def commit(self, tag):
+    self.git('commit', '-q', '--allow-empty', '-m', tag)
+    # Annotated, so the peeled commit has to be picked
+    self.git('tag', '-a', '-m', tag, tag)
+    self.commits[tag] = git(self.origin, 'rev-parse', 'HEAD')
+
+  def expected(self, *tags):
+    return [(Version(tag), self.commits[tag]) for tag in tags]
+
+  def test_versions(self):
+    index = TagIndex(self.git_directory)
+    self.assertEqual(index.versions('foo'), self.expected('1.0.0', '1.1.0'))
+    stored = index.read('foo')
+    self.assertTrue(stored['remote'])
+    self.assertEqual(stored['tags']['latest'], self.commits['latest'])
+
+  def test_ttl(self):
+    TagIndex(self.git_directory).versions('foo')
+    self.commit('2.0.0')
+    # Trusted for an hour
+    self.assertEqual(TagIndex(self.git_directory).versions('foo'),
+                     self.expected('1.0.0', '1.1.0'))
+    self.assertEqual(TagIndex(self.git_directory, ttl = 0).versions('foo'),
+                     self.expected('1.0.0', '1.1.0', '2.0.0'))
+
+  def test_refresh(self):
+    TagIndex(self.git_directory).versions('foo')
+    self.git('tag', '-d', '1.0.0')
+    self.commit('1.2.0')
+    index = TagIndex(self.git_directory, refresh = True)
+    self.assertEqual(index.versions('foo'), self.expected('1.1.0', '1.2.0'))
+    # Fetched into the clone
+    git(join(self.git_directory, 'foo'), 'cat-file', '-e',
+        self.commits['1.2.0'] + '^{commit}')
+
+  def test_local(self):
+    self.commit('2.0.0')
+    index = TagIndex(self.git_directory)
+    # Only what the clone already has
+    self.assertEqual(index.versions('foo', fetch_remote = False),
+                     self.expected('1.0.0', '1.1.0'))
+    self.assertFalse(index.read('foo')['remote'])
+    # Not good enough for a run that fetches
+    self.assertEqual(index.versions('foo'),
+                     self.expected('1.0.0', '1.1.0', '2.0.0'))
+
+  def test_no_tags(self):
+    os.makedirs(join(self.git_directory, 'bar'))
+    git(join(self.git_directory, 'bar'), 'init', '-q')
+    self.assertEqual(TagIndex(self.git_directory).versions('bar', False), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import json
+import shutil
+import tempfile
+import threading
+from os.path import join
+
+from clydepm import tracing
+
+
+class TestTracing(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.filename = join(self.test_dir, 'trace.json')
+
+  def tearDown(self):
+    tracing.stop()
+    shutil.rmtree(self.test_dir)
+
+  def read_events(self):
+    with open(self.filename) as f:
+      return json.load(f)['traceEvents']
+
+  def test_disabled(self):
+    self.assertFalse(tracing.enabled())
+    with tracing.span('compile', 'foo.c'):
+      pass
+    self.assertIsNone(tracing.stop())
+
+  def test_spans_per_thread(self):
+    tracing.start(self.filename)
+
+    @tracing.traced('link')
+    def link():
+      pass
+
+    def compile(name):
+      with tracing.span('compile', name, {'flags' : '-O2'}):
+        pass
+
+    threads = [threading.Thread(target = compile, args = (n,))
+               for n in ['a.c', 'b.c']]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    link()
+    tracing.stop()
+
+    events = self.read_events()
+    spans = [e for e in events if e['ph'] == 'X']
+    self.assertEqual(sorted(e['name'] for e in spans), ['a.c', 'b.c', 'link'])
+    self.assertEqual(len(set(e['tid'] for e in spans)), 3)
+    names = [e for e in events if e['ph'] == 'M']
+    self.assertEqual(len(names), 3)
+
+  def test_error_recorded(self):
+    tracing.start(self.filename)
+    try:
+      with tracing.span('compile', 'bad.c'):
+        raise ValueError()
+    except ValueError:
+      pass
+    tracing.stop()
+    self.assertEqual(self.read_events()[0]['args']['error'], 'ValueError')
@@ -0,0 +1,93 @@
+import unittest
+import os
+import shutil
+import subprocess
+import tempfile
+from os.path import join, exists
+
+from clyde2.worktrees import WorktreePool, git
+
+
+class TestWorktreePool(unittest.TestCase):
+
+  def setUp(self):
+    self.test_dir = tempfile.mkdtemp()
+    self.repository = join(self.test_dir, 'foo')
+    os.makedirs(self.repository)
+    self.git('init', '-q')
+    self.commits = {}
+    for version in ['1.0.0', '1.1.0', '2.0.0']:
+      with open(join(self.repository, 'version.txt'), 'w') as f:
+        f.write(version)
+      self.git('add', 'version.txt')
+      self.git('commit', '-q', '-m', version)
+      self.git('tag', version)
+      self.commits[version] = git(self.repository, 'rev-parse', 'HEAD')
+
+  def tearDown(self):
+    shutil.rmtree(self.test_dir)
+
+  def git(self, *args):
+    subprocess.check_call(['git', '-C', self.repository, '-c', 'user.name=test',
+                           '-c', 'user.email=test@example.com'] + list(args),
+                          stdout = subprocess.PIPE)
+
+  def version(self, path):
+    with open(join(path, 'version.txt')) as f:
+      return f.read()
+
+  def worktrees(self):
+    listing = git(self.repository, 'worktree', 'list', '--porcelain')
+    return [line.split(' ', 1)[1] for line in listing.splitlines()
+            if line.startswith('worktree ')][1:]
+
+  def test_get(self):
+    pool = WorktreePool(self.test_dir)
+    path = pool.get('foo', '1.0.0')
+    self.assertEqual(path, join(self.test_dir, '.worktrees', 'foo',
+                                self.commits['1.0.0']))
+    self.assertEqual(self.version(path), '1.0.0')
+    # Side by side, and the clone itself isn't touched
+    self.assertEqual(self.version(pool.get('foo', '2.0.0')), '2.0.0')
+    self.assertEqual(self.version(path), '1.0.0')
+    self.assertEqual(self.version(self.repository), '2.0.0')
+
+    # Reused, by commit
+    with open(join(path, 'marker'), 'w') as f:
+      f.write('')
+    self.assertEqual(WorktreePool(self.test_dir).get('foo', self.commits['1.0.0']),
+                     path)
+    self.assertTrue(exists(join(path, 'marker')))
+
+  def test_unknown_version(self):
+    self.assertRaises(Exception, WorktreePool(self.test_dir).get, 'foo', '3.0.0')
+
+  def test_interrupted_add(self):
+    path = join(self.test_dir, '.worktrees', 'foo', self.commits['1.1.0'])
+    os.makedirs(path)
+    self.assertEqual(WorktreePool(self.test_dir).get('foo', '1.1.0'), path)
+    self.assertEqual(self.version(path), '1.1.0')
+
+  def test_evict(self):
+    first = WorktreePool(self.test_dir, max_worktrees = 1)
+    old = first.get('foo', '1.0.0')
+    # Everything handed out in one run stays, whatever the limit
+    newer = first.get('foo', '1.1.0')
+    self.assertTrue(exists(old))
+
+    second = WorktreePool(self.test_dir, max_worktrees = 2)
+    newest = second.get('foo', '2.0.0')
+    self.assertFalse(exists(old))
+    self.assertEqual(sorted(self.worktrees()), sorted([newer, newest]))
+    self.assertEqual(sorted(second.read_index()), sorted([newer, newest]))
+
+  def test_removed_by_hand(self):
+    pool = WorktreePool(self.test_dir, max_worktrees = 1)
+    path = pool.get('foo', '1.0.0')
+    shutil.rmtree(path)
+    WorktreePool(self.test_dir, max_worktrees = 1).get('foo', '2.0.0')
+    self.assertEqual(len(self.worktrees()), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,150 @@
+"""
+Timelines of where a build spends its time.
+
+Spans are recorded in the Chrome trace event format, which can be
+opened in chrome://tracing or https://ui.perfetto.dev. Each thread
+gets its own lane, so parallel compiles and dependency builds show
+up side by side.
+
+  from clydepm import tracing
+
+  tracing.start('trace.json')
+  with tracing.span('compile', 'foo.c', args = {'flags' : '-O2'}):
+    ...
+  tracing.stop()
+
+Tracing is off unless start() was called. span() then returns a
+shared do-nothing context manager, so leaving spans in hot paths
+costs one function call and one attribute check.
+"""
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+
+class NullSpan(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    return False
+
+
+_null_span = NullSpan()
+
+
+class Span(object):
+
+  def __init__(self, tracer, category, name, args):
+    self.tracer = tracer
+    self.category = category
+    self.name = name
+    self.args = args
+
+  def __enter__(self):
+    self.begin = time.time()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    end = time.time()
+    args = self.args
+    if type is not None:
+      args = dict(args or {}, error = type.__name__)
+    self.tracer.add(self.category, self.name, self.begin, end, args)
+    return False
+
+
+class Tracer(object):
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.pid = os.getpid()
+    self.start = time.time()
+    self.events = []
+    self.threads = {}
+    self.lock = threading.Lock()
+
+  def add(self, category, name, begin, end, args = None):
+    thread = threading.current_thread()
+    event = {
+      'ph'    : 'X',
+      'cat'   : category,
+      'name'  : name,
+      'ts'    : (begin - self.start) * 1e6,
+      'dur'   : (end - begin) * 1e6,
+      'pid'   : self.pid,
+      'tid'   : thread.ident
+    }
+    if args:
+      event['args'] = args
+    with self.lock:
+      self.events.append(event)
+      if thread.ident not in self.threads:
+        self.threads[thread.ident] = thread.name
+
+  def write(self):
+    with self.lock:
+      events = list(self.events)
+      for tid, name in self.threads.items():
+        events.append({'ph' : 'M', 'name' : 'thread_name', 'pid' : self.pid,
+                       'tid' : tid, 'args' : {'name' : name}})
+    temp = self.filename + '.tmp'
+    with open(temp, 'w') as f:
+      json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
+    os.rename(temp, self.filename)
+
+
+_tracer = None
+
+
+def start(filename):
+  """
+  Start recording spans, to be written to filename by stop()
+  """
+  global _tracer
+  _tracer = Tracer(filename)
+  return _tracer
+
+
+def stop():
+  """
+  Write out the trace, if one was started, and stop recording
+  """
+  global _tracer
+  tracer, _tracer = _tracer, None
+  if tracer is not None:
+    tracer.write()
+  return tracer
+
+
+def enabled():
+  return _tracer is not None
+
+
+def span(category, name, args = None):
+  """
+  Context manager that records the time spent inside it
+  """
+  if _tracer is None:
+    return _null_span
+  return Span(_tracer, category, name, args)
+
+
+def traced(category, name = None):
+  """
+  Decorator that records every call of a function as a span
+  """
+  def decorator(function):
+    span_name = name or function.__name__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+      if _tracer is None:
+        return function(*args, **kwargs)
+      with Span(_tracer, category, span_name, None):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorator